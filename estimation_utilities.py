@@ -2,14 +2,14 @@
 Collection of utility functions to implement llpestimation package,
 such as creation of dark leptonic scalar models (a type of LLP),
 or to generate interpolation functions from the tables.
+
+Only numpy and llpestimation are imported at load, matplotlib is
+imported by the plotting functions when they are called.
 """
 
 from llpestimation import LLPModel, LLPEstimator, LLPMedium, LLPProductionCrossSection
-from scipy.interpolate import interp1d
+from llpestimation import LLPCrossSectionTable, LLPTabulatedCrossSection, LLPLazyCrossSectionTable, LLPModelGrid
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from collections.abc import Callable
 
 ########## Helper functions for DLS ##########
 def calculate_DLS_lifetime(mass, eps):
@@ -21,27 +21,54 @@ def calculate_DLS_lifetime(mass, eps):
     GeV_to_s = 6.582e-25
     return GeV_to_s * 1 / width
 
-def generate_DLSModels(masses, epsilons, names, table_paths):
-    # @TODO: fix for hydrogen
+def generate_DLSModels(masses, epsilons, names, table_paths=None, table=None, medium_list=None):
+    """
+    Dark leptonic scalar models with cross sections from one shared LLPCrossSectionTable.
+    Give either the csv table_paths (one per model) or a table with masses as row keys,
+    e.g. from load_DLS_table_cache.
+    For several media, e.g. medium_list = south_pole_ice(), every entry of table_paths
+    is a list with one table per medium. The media are combined into one interactions
+    per cm table when it is loaded, so they cost nothing extra per muon.
+    Defaults to oxygen only, which are the tables in cross_section_tables.
+    """
+    if medium_list is None:
+        medium_list = [get_ice_oxygen()]
     llpmodel_list = []
-    oxygen = get_ice_oxygen()
-    for mass, eps, name, path in zip(masses, epsilons, names, table_paths):
+    if table is None:
+        # one stacked table for all models, tables are at eps = 1
+        row_paths = [(path,) if isinstance(path, str) else tuple(path) for path in table_paths]
+        table_rows = {paths: row for row, paths in enumerate(dict.fromkeys(row_paths))}
+        table = LLPCrossSectionTable.from_csv([list(paths) for paths in table_rows], medium_list)
+        rows = [table_rows[paths] for paths in row_paths]
+    else:
+        rows = [table.row_of(mass) for mass in masses]
+    for mass, eps, name, row in zip(masses, epsilons, names, rows):
         # lifetime
         tau = calculate_DLS_lifetime(mass, eps)
-        # tot_xsec function from interpolation tables
-        df = pd.read_csv(path, names=["E0", "totcs"])
-        func_tot_xsec = interp1d(df["E0"], eps**2*df["totcs"],kind="linear")
-        # create LLPProductionCrossSection
-        llp_xsec = LLPProductionCrossSection([func_tot_xsec], [oxygen])
+        # tot_xsec from shared table row, scaled with eps^2
+        llp_xsec = LLPTabulatedCrossSection(table, row, eps**2)
         # create new LLPModel
         llpmodel_list.append(LLPModel(name, mass, eps, tau, llp_xsec))
     return llpmodel_list
 
+def generate_DLSModelGrid(masses, epsilons, table, name = "DarkLeptonicScalar"):
+    """
+    Grid of dark leptonic scalar models over masses and epsilons for sensitivity scans.
+    table needs the masses as row keys, e.g. from load_DLS_table_cache.
+    Lifetime is computed once per mass at eps = 1, it scales as 1/eps^2.
+    """
+    taus_eps1 = [calculate_DLS_lifetime(mass, 1.0) for mass in masses]
+    rows = [table.row_of(mass) for mass in masses]
+    return LLPModelGrid(name, masses, epsilons, taus_eps1, table, rows)
+
 def generate_DLS_WW_oxygen_paths(masses, folder = None):
-    #folder = "/data/user/axelpo/LLP-at-IceCube/sensitivity-estimation/cross_section_tables/"
+    """
+    Paths of the WW oxygen cross section tables of the masses.
+    folder defaults to the cross_section_tables next to this file.
+    """
     import os
     if folder is None:
-        folder = os.getcwd() + "/cross_section_tables/"
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cross_section_tables", "")
     paths  = []
     for m in masses:
         m_str = "{:.3f}".format(m)
@@ -50,6 +77,85 @@ def generate_DLS_WW_oxygen_paths(masses, folder = None):
         paths.append(folder+"totcs_WW_m_"+m_str+".csv")
     return paths
 
+def compile_DLS_table_cache(masses, cache_path, folder = None):
+    """
+    Packs the WW oxygen tables of all masses into one binary file.
+    Later runs memory map it with load_DLS_table_cache instead of parsing csv files.
+    The file is written next to cache_path and moved into place, so processes
+    loading the cache meanwhile never memory map a half written file.
+    """
+    import os
+    import tempfile
+    paths = generate_DLS_WW_oxygen_paths(masses, folder)
+    table = LLPCrossSectionTable.from_csv([[path] for path in paths], [get_ice_oxygen()], row_keys=masses)
+    fd, tmp_path = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(os.path.abspath(cache_path)))
+    os.close(fd)
+    try:
+        table.save(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return table
+
+def load_DLS_table_cache(cache_path, masses = None, folder = None):
+    """
+    Memory maps the table cache written by compile_DLS_table_cache.
+    If masses are given, the cache is checked against the checksum of their csv tables
+    and (re)compiled if it is missing or stale.
+    """
+    import os
+    oxygen = get_ice_oxygen()
+    if masses is None:
+        return LLPCrossSectionTable.load(cache_path, [oxygen])
+    paths = generate_DLS_WW_oxygen_paths(masses, folder)
+    checksum = LLPCrossSectionTable.checksum_csv([[path] for path in paths])
+    if os.path.exists(cache_path):
+        try:
+            return LLPCrossSectionTable.load(cache_path, [oxygen], checksum=checksum)
+        except ValueError:
+            pass # stale cache, compile again
+    compile_DLS_table_cache(masses, cache_path, folder)
+    return LLPCrossSectionTable.load(cache_path, [oxygen], checksum=checksum)
+
+def lazy_DLS_table(cache_path, masses, folder = None):
+    """
+    Handle to the table cache of load_DLS_table_cache that is only loaded (and
+    compiled if missing or stale) when the first estimator uses it. Models can be
+    created from it with generate_DLSModels without touching the file.
+    """
+    from functools import partial
+    return LLPLazyCrossSectionTable(partial(load_DLS_table_cache, cache_path, masses, folder),
+                                    [get_ice_oxygen()], row_keys=masses)
+
+def build_DLS_estimator(masses, epsilons, names, cache_path, min_gap = 50.0):
+    """
+    Builds an LLPEstimator of dark leptonic scalar models from a compiled table cache.
+    All arguments are picklable, so this can be given to LLPParallelEstimator
+    and every worker memory maps the same cache file.
+    """
+    table = load_DLS_table_cache(cache_path)
+    models = generate_DLSModels(masses, epsilons, names, table=table)
+    return LLPEstimator(models, min_gap)
+
+def write_DLS_grid_spec(spec_path, masses, epsilons, min_gap = 50.0, name = "DarkLeptonicScalar"):
+    """
+    Writes a model grid spec for the llpestimation command with the WW oxygen tables.
+    Run it with: llpestimation spec.json --tables cross_section_tables --muons muons.npz --output p.npy
+    """
+    import json
+    oxygen = get_ice_oxygen()
+    spec = {"name": name,
+            "masses": [float(mass) for mass in masses],
+            "epsilons": [float(eps) for eps in epsilons],
+            "taus_eps1": [calculate_DLS_lifetime(mass, 1.0) for mass in masses],
+            "media": [{"name": oxygen.name, "number_density": oxygen.number_density, "Z": oxygen.Z, "A": oxygen.A}],
+            "tables": ["totcs_WW_m_{mass:g}.csv"],
+            "min_gap": min_gap}
+    with open(spec_path, "w") as f:
+        json.dump(spec, f, indent=1)
+    return spec
+
 ########## Create south pole ice ##########
 def south_pole_ice():
     """
@@ -68,6 +174,7 @@ def get_ice_oxygen():
 
 ########## Plotting ##########
 def plot_interpolation(df, interpfunc, mass, eps=1):
+    import matplotlib.pyplot as plt
     E0array = np.logspace(1,5,1000)
     totcsarray = [interpfunc(energy) for energy in E0array]
     # plot
@@ -1,4 +1,57 @@
-from .llpproductioncrosssection import LLPProductionCrossSection
-from .llpmedium import LLPMedium
-from .llpmodel import LLPModel
-from .llpestimator import LLPEstimator
\ No newline at end of file
+"""
+Estimation of detectable LLP event probabilities for atmospheric muons.
+
+The classes are imported from their modules on first access, so importing the
+package only costs the import of numpy. Modules with heavy standard library
+dependencies (asyncio, concurrent.futures, sqlite3, zipfile) are only loaded
+when their classes are used. Import time budget: creating models with
+estimation_utilities must not import pandas, scipy, matplotlib or these modules,
+and take less than 100 ms on top of numpy, see test_import_time.
+"""
+import importlib
+
+# public name -> module it is defined in
+_exports = {
+    "LLPProductionCrossSection": ".llpproductioncrosssection",
+    "LLPCrossSectionTable":      ".llpcrosssectiontable",
+    "LLPTabulatedCrossSection":  ".llpcrosssectiontable",
+    "LLPLazyCrossSectionTable":  ".llpcrosssectiontable",
+    "LLPMedium":                 ".llpmedium",
+    "LLPDensityProfile":         ".llpmedium",
+    "LLPModel":                  ".llpmodel",
+    "LLPModelSet":               ".llpmodelset",
+    "LLPMuonBatch":              ".llpmuonbatch",
+    "LLPEnergyLoss":             ".llpenergyloss",
+    "LLPMuonGenerator":          ".llpmuongenerator",
+    "LLPDetectorVolume":         ".llpgeometry",
+    "LLPCylinder":               ".llpgeometry",
+    "LLPPrism":                  ".llpgeometry",
+    "LLPRateAccumulator":        ".llpaccumulator",
+    "LLPInstrumentation":        ".llpinstrumentation",
+    "LLPEstimator":              ".llpestimator",
+    "LLPModelGrid":              ".llpmodelgrid",
+    "LLPGridEstimator":          ".llpgridestimator",
+    "LLPLookupEstimator":        ".llplookupestimator",
+    "LLPCachedEstimator":        ".llpcachedestimator",
+    "LLPParallelEstimator":      ".llpparallelestimator",
+    "LLPStreamingPipeline":      ".llpstreaming",
+    "iter_muon_chunks":          ".llpstreaming",
+    "default_chunk_size":        ".llpstreaming",
+    "LLPVertexSampler":          ".llpvertexsampler",
+    "LLPSignalEvents":           ".llpvertexsampler",
+    "LLPService":                ".llpservice",
+    "LLPServiceClient":          ".llpservice",
+    "generate_load":             ".llpservice",
+}
+
+__all__ = list(_exports)
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value # later lookups skip __getattr__
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,4 @@
+import sys
+from .llpcli import main
+
+sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Running per model sums of flux weighted detectable LLP probabilities.
+
+Keeps O(models) memory no matter how many muons are added, and
+accumulators from different processes can be merged.
+"""
+import numpy as np
+
+class LLPRateAccumulator():
+    """
+    Accumulates x = weight * probability of every muon, separately per model.
+    Sums are Kahan compensated and mean/variance are updated with Welford's
+    algorithm (Chan et al. for whole batches), so adding many small terms
+    to a large total does not lose precision.
+    """
+    def __init__(self, n_models: int, model_ids: list = None):
+        self.model_ids  = model_ids            # optional labels, ordered with the models
+        self.count      = 0                    # number of muons added
+        self.sum        = np.zeros(n_models)   # sum of x, i.e. the rate
+        self.sum_comp   = np.zeros(n_models)   # Kahan compensation of sum
+        self.sum_sq     = np.zeros(n_models)   # sum of x^2, i.e. variance of the rate
+        self.sum_sq_comp = np.zeros(n_models)  # Kahan compensation of sum_sq
+        self.mean       = np.zeros(n_models)   # running mean of x
+        self.m2         = np.zeros(n_models)   # running sum of squared deviations from mean
+
+    def add(self, probabilities: np.ndarray, weights: np.ndarray = None):
+        """
+        Adds a batch of muons.
+        :param probabilities: Detectable LLP probabilities, shape (n_muons, n_models).
+        :param weights: Flux weight per muon. Defaults to 1.
+        """
+        probabilities = np.asarray(probabilities, dtype=float)
+        if probabilities.ndim != 2 or probabilities.shape[1] != len(self.sum):
+            raise ValueError("probabilities must have shape (n_muons, n_models)")
+        n = len(probabilities)
+        if n == 0:
+            return
+        if weights is None:
+            x = probabilities
+        else:
+            weights = np.asarray(weights, dtype=float)
+            if weights.shape != (n,):
+                raise ValueError("Need one weight per muon")
+            x = probabilities * weights[:, None]
+
+        # batch statistics, numpy sums pairwise
+        batch_mean = np.mean(x, axis=0)
+        batch_m2   = np.sum((x - batch_mean)**2, axis=0)
+        self._kahan_add("sum", np.sum(x, axis=0))
+        self._kahan_add("sum_sq", np.sum(x**2, axis=0))
+        self._merge_moments(n, batch_mean, batch_m2)
+
+    def merge(self, other):
+        """
+        Adds the muons of another accumulator, e.g. from another process.
+        :param other: LLPRateAccumulator of the same models.
+        """
+        if len(other.sum) != len(self.sum):
+            raise ValueError("Can only merge accumulators of the same models")
+        if other.count == 0:
+            return
+        self._kahan_add("sum", other.sum)
+        self._kahan_add("sum", -other.sum_comp)
+        self._kahan_add("sum_sq", other.sum_sq)
+        self._kahan_add("sum_sq", -other.sum_sq_comp)
+        self._merge_moments(other.count, other.mean, other.m2)
+
+    @property
+    def rate(self) -> np.ndarray:
+        """ Weighted sum of probabilities per model. """
+        return self.sum - self.sum_comp
+
+    @property
+    def rate_variance(self) -> np.ndarray:
+        """ Variance of the rate per model, sum of squared weighted probabilities. """
+        return self.sum_sq - self.sum_sq_comp
+
+    @property
+    def variance(self) -> np.ndarray:
+        """ Sample variance of the weighted probability of a single muon per model. """
+        if self.count < 2:
+            return np.full(len(self.sum), np.nan)
+        return self.m2 / (self.count - 1)
+
+    def to_dict(self) -> dict:
+        """
+        Rate and rate variance mapped to model ids (or model index if no ids).
+        :return dict: {model id: (rate, rate variance)}.
+        """
+        keys = self.model_ids if self.model_ids is not None else range(len(self.sum))
+        return dict(zip(keys, zip(self.rate, self.rate_variance)))
+
+    def _kahan_add(self, name: str, value: np.ndarray):
+        total = getattr(self, name)
+        comp  = getattr(self, name + "_comp")
+        y = value - comp
+        t = total + y
+        setattr(self, name + "_comp", (t - total) - y)
+        setattr(self, name, t)
+
+    def _merge_moments(self, n: int, mean: np.ndarray, m2: np.ndarray):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2   = self.m2 + m2 + delta**2 * (self.count * n / total)
+        self.count = total
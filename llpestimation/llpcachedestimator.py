@@ -0,0 +1,205 @@
+"""
+Memoization of detectable LLP probabilities for repeated muon tracks.
+
+Tracks are keyed by a hash of their quantized lengths and energies together
+with a fingerprint of the estimator, kept in a bounded in-memory LRU cache
+and optionally in an sqlite file that later passes over the same data reuse.
+"""
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+from .llpmuonbatch import LLPMuonBatch
+
+class LLPCachedEstimator():
+    """
+    Wraps an estimator with an LRU cache of at most maxsize tracks.
+    Lengths are quantized to length_quantum meters and energies to a relative
+    energy_quantum, so tracks differing by less share one entry and get the
+    probabilities computed for the first of them.
+    The key also contains a fingerprint of the estimator (class, min_gap, dtype,
+    model ids, cross sections and e.g. the lookup grid, see LLPEstimator.update_fingerprint),
+    so a disk cache can be shared between estimators.
+    The caches can be used from other threads, e.g. the executor of LLPService.
+    Use as a context manager or call close() to write the disk cache.
+    """
+    def __init__(self,
+                 estimator,
+                 maxsize: int = 100000,
+                 length_quantum: float = 0.01,
+                 energy_quantum: float = 1e-4,
+                 disk_path: str = None,
+                 commit_every: int = 1000):
+        if maxsize < 0:
+            raise ValueError("maxsize can't be negative")
+        if length_quantum <= 0 or energy_quantum <= 0:
+            raise ValueError("Quanta must be positive")
+        self.estimator      = estimator      # LLPEstimator to compute misses with
+        self.maxsize        = maxsize        # largest number of tracks in memory
+        self.length_quantum = length_quantum # in m
+        self.energy_quantum = energy_quantum # relative
+        self.llpmodel_unique_ids = estimator.llpmodel_unique_ids
+        self.fingerprint = self.estimator_fingerprint(estimator)
+        self.cache = OrderedDict() # key -> probabilities, most recently used last
+
+        # counters
+        self.hits      = 0 # found in memory
+        self.disk_hits = 0 # found in the disk cache
+        self.misses    = 0 # computed
+        self.evictions = 0 # dropped from memory
+
+        # optional disk tier
+        self.commit_every = commit_every # disk writes per commit
+        self._n_uncommitted = 0
+        self._lock = threading.Lock() # guards the caches and the connection shared between threads
+        self.db = None
+        if disk_path is not None:
+            self.db = sqlite3.connect(disk_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS probabilities (key BLOB PRIMARY KEY, value BLOB)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Commits and closes the disk cache. """
+        with self._lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+    @staticmethod
+    def estimator_fingerprint(estimator) -> bytes:
+        """
+        Hash of what determines the probabilities of an estimator.
+        :param estimator: LLPEstimator.
+        :return bytes: Digest of everything the estimator adds in update_fingerprint.
+        """
+        sha = hashlib.blake2b(digest_size=16)
+        estimator.update_fingerprint(sha)
+        return sha.digest()
+
+    def stats(self) -> dict:
+        """ Cache counters and the number of tracks in memory. """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {"hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.cache),
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def clear(self):
+        """ Empties the in-memory cache, the disk cache is kept. """
+        with self._lock:
+            self.cache.clear()
+
+    def calc_llp_probability(self, length_list: list, energy_list: list) -> np.ndarray:
+        """
+        LLPEstimator.calc_llp_probability, looked up in the cache first.
+        :return np.ndarray: Detectable LLP probability per model.
+        """
+        length_array = np.asarray(length_list, dtype=float)
+        energy_array = np.asarray(energy_list, dtype=float)
+        if len(length_array) != len(energy_array):
+            raise ValueError("length_list and energy_list \
+                             must contain same number of elements")
+        key = self._track_key(*self._quantize(length_array, energy_array))
+        probabilities = self._get(key)
+        if probabilities is None:
+            probabilities = np.asarray(self.estimator.calc_llp_probability(length_array, energy_array), dtype=float)
+            self.misses += 1
+            self._put(key, probabilities)
+        return probabilities.copy()
+
+    def calc_llp_probability_batch(self, muons: LLPMuonBatch) -> np.ndarray:
+        """
+        LLPEstimator.calc_llp_probability_batch, looked up in the cache first.
+        All misses are computed in one batch, repeated tracks within the batch only once.
+        :return np.ndarray: Detectable LLP probabilities with shape (n_muons, n_models).
+        """
+        probabilities = np.empty((len(muons), len(self.llpmodel_unique_ids)))
+        lengths, energies = self._quantize(muons.lengths, muons.energies)
+        misses = {} # key -> muons with that key
+        for i in range(len(muons)):
+            first, last = muons.offsets[i], muons.offsets[i + 1]
+            key = self._track_key(lengths[first:last], energies[first:last])
+            if key in misses:
+                misses[key].append(i)
+                continue
+            cached = self._get(key)
+            if cached is None:
+                misses[key] = [i]
+            else:
+                probabilities[i] = cached
+
+        if misses:
+            first_muons = [muon_indices[0] for muon_indices in misses.values()]
+            tracks = [muons.track(i) for i in first_muons]
+            computed = self.estimator.calc_llp_probability_batch(
+                LLPMuonBatch.from_tracks([t[0] for t in tracks], [t[1] for t in tracks]))
+            for (key, muon_indices), result in zip(misses.items(), computed):
+                probabilities[muon_indices] = result
+                self.misses += 1
+                self.hits += len(muon_indices) - 1 # repeats within the batch
+                self._put(key, result.copy())
+        return probabilities
+
+    def _quantize(self, length_array: np.ndarray, energy_array: np.ndarray) -> tuple:
+        """ Integer lengths in units of length_quantum and log energies in units of energy_quantum. """
+        lengths = np.round(length_array / self.length_quantum).astype(np.int64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_energies = np.log(energy_array) / np.log1p(self.energy_quantum)
+        energies = np.where(energy_array > 0, np.round(np.nan_to_num(log_energies)), np.iinfo(np.int64).min)
+        return lengths, energies.astype(np.int64)
+
+    def _track_key(self, lengths: np.ndarray, energies: np.ndarray) -> bytes:
+        sha = hashlib.blake2b(self.fingerprint, digest_size=16)
+        sha.update(np.ascontiguousarray(lengths).tobytes())
+        sha.update(np.ascontiguousarray(energies).tobytes())
+        return sha.digest()
+
+    def _get(self, key: bytes):
+        with self._lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key: bytes):
+        probabilities = self.cache.get(key)
+        if probabilities is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return probabilities
+        if self.db is not None:
+            row = self.db.execute("SELECT value FROM probabilities WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                probabilities = np.frombuffer(row[0], dtype=np.float64).copy()
+                self.disk_hits += 1
+                self._remember(key, probabilities)
+                return probabilities
+        return None
+
+    def _put(self, key: bytes, probabilities: np.ndarray):
+        with self._lock:
+            self._put_locked(key, probabilities)
+
+    def _put_locked(self, key: bytes, probabilities: np.ndarray):
+        self._remember(key, probabilities)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO probabilities VALUES (?, ?)",
+                            (key, np.ascontiguousarray(probabilities, dtype=np.float64).tobytes()))
+            self._n_uncommitted += 1
+            if self._n_uncommitted >= self.commit_every:
+                self.db.commit()
+                self._n_uncommitted = 0
+
+    def _remember(self, key: bytes, probabilities: np.ndarray):
+        if self.maxsize == 0:
+            return
+        self.cache[key] = probabilities
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,146 @@
+"""
+Command line batch runner, installed as the llpestimation command
+(or run with python -m llpestimation).
+
+Builds an LLPEstimator for a model grid described by a JSON spec file,
+evaluates the muons of a muon file chunk by chunk with the serial, batch
+or process pool backend and writes the probabilities into a .npy file.
+The spec file contains
+
+    {"name": "DarkLeptonicScalar",
+     "masses": [0.107, 0.11],                # GeV
+     "epsilons": [1e-6, 5e-6],
+     "taus_eps1": [1.2e-19, 1.1e-19],        # lifetime in s at eps = 1, per mass
+     "media": [{"name": "O", "number_density": 3.08e22, "Z": 8, "A": 16}],
+     "tables": ["totcs_WW_m_{mass:g}.csv"],  # csv table per medium, relative to the table directory
+     "min_gap": 50.0}                        # m, optional
+
+Models are ordered mass-major like LLPModelGrid.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+from .llpmedium import LLPMedium
+from .llpcrosssectiontable import LLPCrossSectionTable
+from .llpmodelgrid import LLPModelGrid
+from .llpestimator import LLPEstimator
+from .llpmuonbatch import LLPMuonBatch
+from .llpstreaming import LLPStreamingPipeline, count_muons, default_chunk_size
+
+BACKENDS = ("serial", "batch", "process")
+
+def load_grid_spec(path: str) -> dict:
+    """
+    Reads and checks a model grid spec file.
+    :param path: JSON file, see the module docstring.
+    :return dict: The spec.
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    missing = [key for key in ("name", "masses", "epsilons", "taus_eps1", "media", "tables") if key not in spec]
+    if missing:
+        raise ValueError("Grid spec " + str(path) + " is missing " + ", ".join(missing))
+    if len(spec["taus_eps1"]) != len(spec["masses"]):
+        raise ValueError("Grid spec needs one lifetime per mass")
+    if len(spec["tables"]) != len(spec["media"]):
+        raise ValueError("Grid spec needs one table pattern per medium")
+    return spec
+
+def build_grid_estimator(spec: dict, table_dir: str) -> LLPEstimator:
+    """
+    LLPEstimator for all models of a grid spec. Module level, so process
+    pool workers can build their own estimator from the picklable spec.
+    :param spec: Grid spec, see load_grid_spec.
+    :param table_dir: Directory with the csv cross section tables.
+    :return LLPEstimator: Estimator with an LLPModelSet in mass-major order.
+    """
+    medium_list = [LLPMedium(m["name"], m["number_density"], m["Z"], m["A"]) for m in spec["media"]]
+    table_paths = [[os.path.join(table_dir, pattern.format(mass=mass)) for pattern in spec["tables"]]
+                   for mass in spec["masses"]]
+    table = LLPCrossSectionTable.from_csv(table_paths, medium_list, row_keys=spec["masses"])
+    grid = LLPModelGrid(spec["name"], spec["masses"], spec["epsilons"], spec["taus_eps1"],
+                        table, np.arange(len(spec["masses"])))
+    return LLPEstimator(grid.model_set(), spec.get("min_gap", 50.0))
+
+class _SerialEstimator():
+    """ Evaluates a batch one muon at a time with calc_llp_probability. """
+    def __init__(self, estimator: LLPEstimator):
+        self.estimator = estimator
+        self.llpmodel_unique_ids = estimator.llpmodel_unique_ids
+
+    def calc_llp_probability_batch(self, muons: LLPMuonBatch) -> np.ndarray:
+        probabilities = np.empty((len(muons), len(self.llpmodel_unique_ids)))
+        for i in range(len(muons)):
+            self.estimator.calc_llp_probability(*muons.track(i), out=probabilities[i])
+        return probabilities
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="llpestimation",
+                                     description="Detectable LLP probabilities of a model grid for a muon file.")
+    parser.add_argument("spec", help="JSON model grid spec")
+    parser.add_argument("--tables", required=True, help="directory with the csv cross section tables")
+    parser.add_argument("--muons", required=True, help="muon file (.npz, .h5/.hdf5 or .parquet)")
+    parser.add_argument("--output", required=True, help=".npy file for the probabilities, rows = muons")
+    parser.add_argument("--backend", choices=BACKENDS, default="batch",
+                        help="one muon at a time, vectorized chunks or chunks in a process pool (default: batch)")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="muons read and evaluated at a time (default: up to 10000, "
+                             "fewer for large model grids so a chunk's probabilities take at most 128 MiB)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes of the process backend (default: number of CPUs)")
+    parser.add_argument("--no-resume", action="store_true", help="start over instead of continuing a run")
+    return parser
+
+def main(argv: list = None) -> int:
+    """
+    Runs the command line interface.
+    :param argv: Arguments without the program name. Defaults to sys.argv[1:].
+    :return int: Exit status.
+    """
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    spec = load_grid_spec(args.spec)
+    start = time.perf_counter()
+    estimator = build_grid_estimator(spec, args.tables)
+    model_ids = estimator.llpmodel_unique_ids
+    chunk_size = args.chunk_size if args.chunk_size is not None else default_chunk_size(len(model_ids))
+    parallel = None
+    if args.backend == "serial":
+        estimator = _SerialEstimator(estimator)
+    elif args.backend == "process":
+        from .llpparallelestimator import LLPParallelEstimator
+        n_workers = args.workers if args.workers is not None else (os.cpu_count() or 1)
+        # split every chunk between the workers
+        parallel = LLPParallelEstimator(build_grid_estimator, (spec, args.tables), n_workers,
+                                        chunk_size=-(-chunk_size // n_workers))
+        parallel.llpmodel_unique_ids = model_ids
+        estimator = parallel
+    setup_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        n_computed = LLPStreamingPipeline(estimator, chunk_size).run(args.muons, args.output,
+                                                                     resume=not args.no_resume)
+    finally:
+        if parallel is not None:
+            parallel.close()
+    seconds = time.perf_counter() - start
+
+    n_muons = count_muons(args.muons)
+    rate = n_computed / seconds if seconds > 0 else float("inf")
+    print("llpestimation: {} models, {} of {} muons computed with the {} backend".format(
+        len(model_ids), n_computed, n_muons, args.backend))
+    print("setup {:.2f} s, run {:.2f} s, {:.1f} muons/s, {:.3g} muon-model evaluations/s".format(
+        setup_seconds, seconds, rate, rate*len(model_ids)))
+    print("probabilities written to " + args.output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+"""
+Stacked production cross section tables sharing one energy grid.
+
+Evaluates the interactions per cm of many models and media at once
+with a single searchsorted and a vectorized linear interpolation.
+Tables can be compiled once into a single binary .npy file that later
+runs memory map instead of parsing the csv tables.
+"""
+import copy
+import hashlib
+import numpy as np
+from functools import partial
+from .llpproductioncrosssection import LLPProductionCrossSection
+
+class LLPCrossSectionTable():
+    """
+    Total cross section tables for several rows (e.g. LLP masses) and media,
+    tabulated on a shared energy grid. Energy in GeV, cross section in cm^2.
+    Number densities of the media are folded in at construction, so evaluation
+    directly gives interactions per cm with rows = table rows, cols = energies.
+    """
+    def __init__(self,
+                 energies: np.ndarray,
+                 tot_xsec_tables: np.ndarray,
+                 medium_list: list,
+                 row_keys: np.ndarray = None,
+                 checksum: str = ""):
+        self.energies        = np.asarray(energies, dtype=float)        # shared grid in GeV, ascending
+        self.tot_xsec_tables = np.asarray(tot_xsec_tables, dtype=float) # shape (rows, media, energies) in cm^2
+        self.medium_list     = medium_list                              # LLPMediums, ordered with axis 1
+        self.row_keys        = row_keys                                 # optional label per row, e.g. mass in GeV
+        self.checksum        = checksum                                 # sha256 of the source tables, if known
+
+        if self.tot_xsec_tables.ndim != 3:
+            raise ValueError("tot_xsec_tables must have shape (rows, media, energies)")
+        if self.tot_xsec_tables.shape[1] != len(self.medium_list):
+            raise ValueError("Need one LLPMedium per cross section table column")
+        if self.tot_xsec_tables.shape[2] != len(self.energies) or len(self.energies) < 2:
+            raise ValueError("Cross section tables must be given on the energy grid")
+        if np.any(np.diff(self.energies) <= 0):
+            raise ValueError("Energy grid must be strictly increasing")
+        if self.row_keys is not None:
+            self.row_keys = np.asarray(self.row_keys, dtype=float)
+            if len(self.row_keys) != len(self.tot_xsec_tables):
+                raise ValueError("Need one row key per table row")
+
+        # fold in number densities: sum_media(n_i * sigma_i), units of cm^-1
+        number_densities = np.array([m.number_density for m in self.medium_list], dtype=float)
+        self.interactions_table = np.einsum("rme,m->re", self.tot_xsec_tables, number_densities)
+        # slopes between grid points, so interpolation only needs one lookup per table
+        self.interactions_slopes = np.diff(self.interactions_table, axis=1) / np.diff(self.energies)
+
+    @classmethod
+    def from_csv(cls, table_paths: list, medium_list: list, row_keys: np.ndarray = None):
+        """
+        Reads cross section tables from csv files with columns E0 [GeV], totcs [cm^2].
+        All files must use the same E0 grid.
+        :param table_paths: One list of paths per row, ordered with medium_list.
+        :param medium_list: LLPMediums the tables in each row correspond to.
+        :param row_keys: Optional label per row, e.g. the LLP mass.
+        :return LLPCrossSectionTable: Stacked table with one row per entry in table_paths.
+        """
+        energies = None
+        tot_xsec_tables = np.empty((len(table_paths), len(medium_list), 0))
+        for i, row_paths in enumerate(table_paths):
+            if len(row_paths) != len(medium_list):
+                raise ValueError("Need one table per medium for every row")
+            for j, path in enumerate(row_paths):
+                table = np.loadtxt(path, delimiter=",", ndmin=2)
+                if energies is None:
+                    energies = table[:, 0]
+                    tot_xsec_tables = np.empty((len(table_paths), len(medium_list), len(energies)))
+                elif len(table) != len(energies) or np.any(table[:, 0] != energies):
+                    raise ValueError("Cross section table " + str(path) + " does not use the shared energy grid")
+                tot_xsec_tables[i, j] = table[:, 1]
+        return cls(energies, tot_xsec_tables, medium_list, row_keys, cls.checksum_csv(table_paths))
+
+    @classmethod
+    def tabulate(cls, llp_xsecs: list, energies: np.ndarray, row_keys: np.ndarray = None):
+        """
+        Evaluates the per medium cross section functions of LLPProductionCrossSections
+        on an energy grid, so models with several media (e.g. oxygen and hydrogen)
+        are combined into one interactions per cm table when they are loaded.
+        :param llp_xsecs: LLPProductionCrossSections, all with the same media.
+        :param energies: Energy grid in GeV, ascending.
+        :param row_keys: Optional label per cross section.
+        :return LLPCrossSectionTable: Table with one row per cross section.
+        """
+        energies = np.asarray(energies, dtype=float)
+        if len(llp_xsecs) == 0:
+            raise ValueError("Need at least one cross section to tabulate")
+        medium_list = llp_xsecs[0].medium_list
+        media = [m.name for m in medium_list]
+        tot_xsec_tables = np.empty((len(llp_xsecs), len(medium_list), len(energies)))
+        for i, llp_xsec in enumerate(llp_xsecs):
+            if [m.name for m in llp_xsec.medium_list] != media:
+                raise ValueError("All cross sections must be given for media " + str(media))
+            for j, func_tot_xsec in enumerate(llp_xsec.func_tot_xsec_list):
+                tot_xsec_tables[i, j] = func_tot_xsec(energies)
+        return cls(energies, tot_xsec_tables, medium_list, row_keys)
+
+    @staticmethod
+    def checksum_csv(table_paths: list) -> str:
+        """
+        sha256 of the content of all csv tables, in row and medium order.
+        :param table_paths: One list of paths per row, as in from_csv.
+        :return str: Hex digest identifying the source tables.
+        """
+        sha = hashlib.sha256()
+        for row_paths in table_paths:
+            for path in row_paths:
+                with open(path, "rb") as f:
+                    sha.update(f.read())
+        return sha.hexdigest()
+
+    def save(self, path: str):
+        """
+        Writes the table into a single binary .npy file that can be memory mapped.
+        Stores the energy grid, row keys, medium names, tables and checksum.
+        :param path: File to write, should end with .npy.
+        """
+        n_rows, n_media, n_energies = self.tot_xsec_tables.shape
+        row_keys = np.full(n_rows, np.nan) if self.row_keys is None else self.row_keys
+        record = np.zeros(1, dtype=self._cache_dtype(n_rows, n_media, n_energies))
+        record["tot_xsec_tables"] = self.tot_xsec_tables
+        record["energies"]        = self.energies
+        record["row_keys"]        = row_keys
+        record["media"]           = [m.name for m in self.medium_list]
+        record["checksum"]        = self.checksum
+        np.save(path, record)
+
+    @classmethod
+    def load(cls, path: str, medium_list: list, mmap: bool = True, checksum: str = None):
+        """
+        Loads a table written with save. With mmap the tables are memory mapped, so
+        the file is not parsed and processes loading the same file share its pages.
+        :param path: File written by save.
+        :param medium_list: LLPMediums, names must match the media stored in the file.
+        :param mmap: Memory map the file instead of reading it.
+        :param checksum: If given, raise if the stored checksum of the source tables differs.
+        :return LLPCrossSectionTable: Table backed by the file.
+        """
+        record = np.load(path, mmap_mode="r" if mmap else None)
+        media = [name.decode() for name in record["media"][0]]
+        if media != [m.name for m in medium_list]:
+            raise ValueError("Table cache " + str(path) + " is for media " + str(media))
+        stored_checksum = record["checksum"][0].decode()
+        if checksum is not None and checksum != stored_checksum:
+            raise ValueError("Table cache " + str(path) + " does not match the source tables")
+        row_keys = np.array(record["row_keys"][0])
+        return cls(np.array(record["energies"][0]),
+                   record["tot_xsec_tables"][0],
+                   medium_list,
+                   None if np.all(np.isnan(row_keys)) else row_keys,
+                   stored_checksum)
+
+    @staticmethod
+    def _cache_dtype(n_rows: int, n_media: int, n_energies: int) -> np.dtype:
+        """ Layout of the binary table file, floats first so all fields stay aligned. """
+        return np.dtype([("tot_xsec_tables", np.float64, (n_rows, n_media, n_energies)),
+                         ("energies", np.float64, (n_energies,)),
+                         ("row_keys", np.float64, (n_rows,)),
+                         ("media", "S16", (n_media,)),
+                         ("checksum", "S64")])
+
+    def row_of(self, key: float) -> int:
+        """
+        Row with the given row key, e.g. the row of an LLP mass.
+        :param key: Row key to look up.
+        :return int: Index of the row.
+        """
+        if self.row_keys is None:
+            raise ValueError("Table has no row keys")
+        rows = np.flatnonzero(np.isclose(self.row_keys, key, rtol=1e-9, atol=0))
+        if len(rows) == 0:
+            raise KeyError("No table row for key " + str(key))
+        return int(rows[0])
+
+    def __len__(self) -> int:
+        return len(self.tot_xsec_tables)
+
+    def take(self, rows: np.ndarray, scales: np.ndarray = None):
+        """
+        New table with the given rows, optionally scaled (e.g. by eps^2).
+        Used to fold model specific factors into the table once, up front.
+        :param rows: Row indices, may repeat.
+        :param scales: Factor per selected row. Defaults to 1.
+        :return LLPCrossSectionTable: Table with len(rows) rows.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        tot_xsec_tables = self.tot_xsec_tables[rows]
+        if scales is not None:
+            tot_xsec_tables = tot_xsec_tables * np.asarray(scales, dtype=float)[:, None, None]
+        row_keys = None if self.row_keys is None else self.row_keys[rows]
+        return LLPCrossSectionTable(self.energies, tot_xsec_tables, self.medium_list, row_keys)
+
+    def astype(self, dtype):
+        """
+        Copy of the table that interpolates the interactions per cm in dtype,
+        e.g. np.float32 to halve the memory traffic. tot_xsec stays float64.
+        :param dtype: Floating point type of the energy grid and interactions table.
+        :return LLPCrossSectionTable: Table sharing the cross section tables with this one.
+        """
+        table = copy.copy(self)
+        table.energies            = self.energies.astype(dtype)
+        table.interactions_table  = self.interactions_table.astype(dtype)
+        table.interactions_slopes = self.interactions_slopes.astype(dtype)
+        return table
+
+    def interactions_per_cm(self, energy: np.ndarray, workspace = None,
+                            out: np.ndarray = None, work: np.ndarray = None) -> np.ndarray:
+        """
+        Total cross section weighted with number density for all rows and media.
+        Energies below the grid give 0, energies above the grid are not allowed.
+        :param energy: Energies of the muon in GeV.
+        :param workspace: Optional LLPWorkspace set to len(energy) steps. The result \
+            is written into workspace.matrix without allocating.
+        :param out: Optional buffer with shape (rows, len(energy)) for the result, \
+            for one dimensional energies.
+        :param work: Scratch buffer with the same shape as out, required with out.
+        :return np.ndarray: Interactions per cm with shape (rows, *energy.shape).
+        """
+        if workspace is not None:
+            return self._interpolate_workspace(energy, workspace)
+        if out is not None:
+            return self._interpolate_into(energy, out, work)
+        return self._interpolate(self.interactions_table, energy, self.interactions_slopes)
+
+    def tot_xsec(self, energy: np.ndarray, row: int = 0, medium: int = 0, scale: float = 1.0) -> np.ndarray:
+        """
+        Total cross section of a single row and medium.
+        :param energy: Energy of the muon in GeV.
+        :param row: Table row.
+        :param medium: Index of the medium in medium_list.
+        :param scale: Factor multiplied to the cross section (e.g. eps^2).
+        :return np.ndarray: Cross section in cm^2, same shape as energy.
+        """
+        return scale * self._interpolate(self.tot_xsec_tables[row, medium][None, :], energy)[0]
+
+    def _interpolate(self, values: np.ndarray, energy: np.ndarray, slopes: np.ndarray = None) -> np.ndarray:
+        """
+        Linear interpolation of all rows of values at once.
+        :param values: Table with rows = rows, cols = energy grid.
+        :param energy: Energies in GeV.
+        :param slopes: Precomputed slopes of values between grid points.
+        :return np.ndarray: Interpolated values with shape (rows, *energy.shape).
+        """
+        energy = np.asarray(energy, dtype=float)
+        if energy.size and np.max(energy) > self.energies[-1]:
+            raise ValueError("Energy above cross section table range of " + str(self.energies[-1]) + " GeV")
+        # lower grid point of each energy, clipped so the last grid point is included
+        idx = np.clip(np.searchsorted(self.energies, energy, side="right") - 1, 0, len(self.energies) - 2)
+        if slopes is None:
+            slopes = np.diff(values, axis=1) / np.diff(self.energies)
+        result = values[:, idx] + (energy - self.energies[idx]) * slopes[:, idx]
+        # no production below the table
+        return np.where(energy < self.energies[0], 0.0, result)
+
+    def _interpolate_into(self, energy: np.ndarray, out: np.ndarray, work: np.ndarray) -> np.ndarray:
+        """
+        Same as _interpolate of the interactions table, with the (rows x energies)
+        values gathered into out and work instead of new arrays.
+        :param energy: Energies in GeV, one dimensional.
+        :param out: Buffer for the result with shape (rows, len(energy)).
+        :param work: Scratch buffer with the same shape as out.
+        :return np.ndarray: out with interactions per cm, rows = table rows.
+        """
+        energy = np.asarray(energy, dtype=float)
+        if energy.size and np.max(energy) > self.energies[-1]:
+            raise ValueError("Energy above cross section table range of " + str(self.energies[-1]) + " GeV")
+        idx = np.clip(np.searchsorted(self.energies, energy, side="right") - 1, 0, len(self.energies) - 2)
+        np.take(self.interactions_table, idx, axis=1, out=out)
+        np.take(self.interactions_slopes, idx, axis=1, out=work)
+        np.multiply(work, energy - self.energies[idx], out=work, casting="same_kind")
+        np.add(out, work, out=out)
+        # no production below the table
+        out[:, energy < self.energies[0]] = 0.0
+        return out
+
+    def _interpolate_workspace(self, energy: np.ndarray, workspace) -> np.ndarray:
+        """
+        Same as _interpolate of the interactions table, but only writes into the workspace buffers.
+        The grid index is the number of grid points <= energy, counted with same shape
+        operations since searchsorted has no out buffer.
+        :param energy: Energies in GeV, one dimensional.
+        :param workspace: LLPWorkspace for this table set to len(energy) steps.
+        :return np.ndarray: workspace.matrix with interactions per cm, rows = table rows.
+        """
+        if len(energy) and np.max(energy) > self.energies[-1]:
+            raise ValueError("Energy above cross section table range of " + str(self.energies[-1]) + " GeV")
+        idx = workspace.step_index
+        np.copyto(workspace.energies, energy[:, None])
+        np.greater_equal(workspace.energies, workspace.grid, out=workspace.compare)
+        np.add.reduce(workspace.compare.view(np.uint8), axis=1, out=workspace.grid_count)
+        np.copyto(idx, workspace.grid_count)
+        np.subtract(idx, 1, out=idx)
+        np.clip(idx, 0, len(self.energies) - 2, out=idx)
+        # values[idx] + (energy - energies[idx]) * slopes[idx]
+        np.take(self.energies, idx, out=workspace.step_work, mode="clip")
+        np.subtract(energy, workspace.step_work, out=workspace.step_work)
+        np.take(self.interactions_table, idx, axis=1, out=workspace.matrix, mode="clip")
+        np.take(self.interactions_slopes, idx, axis=1, out=workspace.work, mode="clip")
+        np.einsum("ij,j->ij", workspace.work, workspace.step_work, out=workspace.decay)
+        np.add(workspace.matrix, workspace.decay, out=workspace.matrix)
+        # no production below the table
+        np.less(energy, self.energies[0], out=workspace.step_mask)
+        np.copyto(workspace.matrix, 0.0, where=workspace.step_mask)
+        return workspace.matrix
+
+class LLPLazyCrossSectionTable():
+    """
+    Handle to an LLPCrossSectionTable that is only loaded when it is first used,
+    e.g. by the first estimator of the models. Attribute access is forwarded to the
+    loaded table. With row_keys given, rows are looked up without loading.
+    """
+    def __init__(self, loader, medium_list: list, row_keys: np.ndarray = None):
+        self.loader      = loader      # callable returning the LLPCrossSectionTable
+        self.medium_list = medium_list # LLPMediums of the table, known without loading
+        self.row_keys    = None if row_keys is None else np.asarray(row_keys, dtype=float)
+        self._table      = None
+
+    @classmethod
+    def from_cache(cls, path: str, medium_list: list, row_keys: np.ndarray = None,
+                   mmap: bool = True, checksum: str = None):
+        """
+        Handle to a table file written with LLPCrossSectionTable.save.
+        :param path: File written by save.
+        :param medium_list: LLPMediums, names must match the media stored in the file.
+        :param row_keys: Row keys of the file, if known.
+        :param mmap: Memory map the file when loading.
+        :param checksum: If given, raise on load if the stored checksum differs.
+        :return LLPLazyCrossSectionTable: Handle that loads the file on first use.
+        """
+        return cls(partial(LLPCrossSectionTable.load, path, medium_list, mmap, checksum), medium_list, row_keys)
+
+    @property
+    def loaded(self) -> bool:
+        return self._table is not None
+
+    def load(self) -> LLPCrossSectionTable:
+        """
+        Loads the table, only on the first call.
+        :return LLPCrossSectionTable: The loaded table.
+        """
+        if self._table is None:
+            self._table = self.loader()
+        return self._table
+
+    def row_of(self, key: float) -> int:
+        """ LLPCrossSectionTable.row_of, without loading if the row keys are known. """
+        if self.row_keys is None:
+            return self.load().row_of(key)
+        rows = np.flatnonzero(np.isclose(self.row_keys, key, rtol=1e-9, atol=0))
+        if len(rows) == 0:
+            raise KeyError("No table row for key " + str(key))
+        return int(rows[0])
+
+    def __len__(self) -> int:
+        return len(self.row_keys) if self.row_keys is not None else len(self.load())
+
+    def __getattr__(self, name: str):
+        # only called for attributes not set on the handle
+        if name.startswith("__") or name in ("loader", "_table"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+class LLPTabulatedCrossSection(LLPProductionCrossSection):
+    """
+    Production cross section given by one row of an LLPCrossSectionTable.
+    Lets the LLPEstimator evaluate all models sharing a table in one pass.
+    The table can be an LLPLazyCrossSectionTable, it is loaded at the first evaluation.
+    """
+    def __init__(self, table: LLPCrossSectionTable, row: int, scale: float = 1.0):
+        self.table = table # shared LLPCrossSectionTable
+        self.row   = row   # row of this cross section in table
+        self.scale = scale # factor multiplied to the table, e.g. eps^2
+        func_tot_xsec_list = [partial(self.tot_xsec, medium=i) for i in range(len(table.medium_list))]
+        super().__init__(func_tot_xsec_list, table.medium_list)
+
+    def tot_xsec(self, energy: float, medium: int = 0) -> float:
+        """
+        Total cross section of one medium.
+        :param energy: Energy of the muon in GeV.
+        :param medium: Index of the medium in medium_list.
+        :return float: Cross section in cm^2.
+        """
+        return self.table.tot_xsec(energy, self.row, medium, self.scale)
+
+    def interactions_per_cm(self, energy: float) -> float:
+        """
+        Total cross section weighted with number density for all elements in medium.
+        :param energy: Energy of the muon in GeV.
+        :return float: Total xsec times num density, units of cm^-1.
+        """
+        table = self.table
+        row = slice(self.row, self.row + 1)
+        result = self.scale * table._interpolate(table.interactions_table[row], energy,
+                                                 table.interactions_slopes[row])[0]
+        return result if np.ndim(result) else float(result)
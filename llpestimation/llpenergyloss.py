@@ -0,0 +1,76 @@
+"""
+Continuous muon energy loss dE/dx = -(a + b E) in closed form.
+
+a describes ionization and b the radiative losses. Integrating gives
+E(x) = (E0 + a/b) exp(-b x) - a/b, so energies along whole batches of
+tracks are computed without stepping through the medium.
+"""
+import numpy as np
+from .llpmuonbatch import LLPMuonBatch
+
+class LLPEnergyLoss():
+    """
+    Continuous energy loss of muons with dE/dx = -(a + b E).
+    Defaults are approximate values for ice. Energy in GeV, lengths in m.
+    """
+    def __init__(self, a: float = 0.24, b: float = 3.3e-4):
+        if a <= 0 or b < 0:
+            raise ValueError("Energy loss needs a > 0 and b >= 0")
+        self.a = a # ionization loss in GeV/m
+        self.b = b # radiative loss in 1/m
+
+    def energy(self, energy: np.ndarray, distance: np.ndarray) -> np.ndarray:
+        """
+        Energy after travelling a distance, 0 after the muon stopped.
+        :param energy: Initial energies in GeV.
+        :param distance: Distances in m, broadcast with energy.
+        :return np.ndarray: Energies in GeV.
+        """
+        energy = np.asarray(energy, dtype=float)
+        distance = np.asarray(distance, dtype=float)
+        if self.b == 0:
+            final = energy - self.a*distance
+        else:
+            # E0 exp(-bx) - a/b (1 - exp(-bx)), stable for small b x
+            final = energy*np.exp(-self.b*distance) + (self.a/self.b)*np.expm1(-self.b*distance)
+        return np.maximum(final, 0.0)
+
+    def range(self, energy: np.ndarray) -> np.ndarray:
+        """
+        Distance after which a muon with the given energy stops.
+        :param energy: Initial energies in GeV.
+        :return np.ndarray: Ranges in m.
+        """
+        energy = np.asarray(energy, dtype=float)
+        if self.b == 0:
+            return energy / self.a
+        return np.log1p(self.b*energy/self.a) / self.b
+
+    def initial_energy(self, energy: np.ndarray, distance: np.ndarray) -> np.ndarray:
+        """
+        Energy a muon had a distance before it reached the given energy.
+        :param energy: Energies in GeV.
+        :param distance: Distances in m, broadcast with energy.
+        :return np.ndarray: Initial energies in GeV.
+        """
+        return self.energy(energy, -np.asarray(distance, dtype=float))
+
+    def muon_batch(self, energies: np.ndarray, track_lengths: np.ndarray, step_length: float) -> LLPMuonBatch:
+        """
+        Ragged batch of tracks split into steps of at most step_length, both track ends included.
+        :param energies: Energies at the start of the tracks in GeV.
+        :param track_lengths: Lengths of the tracks in m, at most the range of the muons.
+        :param step_length: Longest step in m.
+        :return LLPMuonBatch: Lengths from the start of each track and the energies there.
+        """
+        if step_length <= 0:
+            raise ValueError("step_length must be positive")
+        energies = np.asarray(energies, dtype=float)
+        track_lengths = np.asarray(track_lengths, dtype=float)
+        counts = np.ceil(track_lengths / step_length).astype(np.intp) + 1
+        offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        muon_index = np.repeat(np.arange(len(counts)), counts)
+        step_index = np.arange(offsets[-1]) - offsets[muon_index]
+        lengths = np.minimum(step_index*step_length, track_lengths[muon_index])
+        return LLPMuonBatch(lengths, self.energy(energies[muon_index], lengths), offsets)
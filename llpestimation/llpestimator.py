@@ -4,23 +4,173 @@ for a list of LLPModels given a muon represented
 by a list of energies along length segments in the detector.
 """
 import numpy as np
+from .llpmuonbatch import LLPMuonBatch
+from .llpcrosssectiontable import LLPTabulatedCrossSection
+from .llpmodel import SPEED_OF_LIGHT, decay_factor_matrix
+from .llpworkspace import LLPWorkspace
+from .llpaccumulator import LLPRateAccumulator
+from .llpmodelset import LLPModelSet
+from .llpinstrumentation import LLPInstrumentation
 
 class LLPEstimator():
     """
-    Class to calculate detectable LLP probability for a list of LLPModels.
+    Class to calculate detectable LLP probability for a list of LLPModels or an LLPModelSet.
     Calculates detectable LLP probability for each model given a
     muon track (list of ordered length steps and energies).
     Input expected in meters and GeV. Internally computes with centimeters.
+    With debug the inputs are checked for unphysical boosts (E < m) like in LLPModel.get_lifetime.
+    With max_steps, scratch buffers for tracks of up to max_steps steps are allocated once
+    and calc_llp_probability does not allocate (requires models on one LLPCrossSectionTable).
+    Stage timers and counters are collected after enable_instrumentation, see LLPInstrumentation.
+    With dtype np.float32 the cross section table, integrand matrix and decay factor are
+    computed in single precision, lengths, l2 - min_gap and step lengths are still computed
+    and sums over steps accumulated in float64 (with max_steps this sum uses small
+    temporary buffers). Probabilities that underflow
+    in float32 show up with relative error 1 in validate_precision, which compares
+    the reduced precision against float64.
+    Media with a depth dependent density (see LLPDensityProfile) are given as a
+    density_scale per step, which only scales the step lengths of the sum.
+    The batch methods evaluate blocks of whole muons whose (models x steps) buffers
+    take at most max_block_bytes together (a single longer muon gets its own block),
+    so their memory does not grow with the batch size.
     """
-    def __init__(self, llpmodels: list, min_gap_meters: float = 50.0):
+    def __init__(self,
+                 llpmodels,
+                 min_gap_meters: float = 50.0,
+                 debug: bool = False,
+                 max_steps: int = None,
+                 dtype = np.float64,
+                 max_block_bytes: int = 2**25):
+        if max_block_bytes < 1:
+            raise ValueError("max_block_bytes must be positive")
         self.min_gap   = min_gap_meters*100.0 # shortest detectable LLP gap [m -> cm]
         self.llpmodels = llpmodels            # make sure this stay ordered
+        self.debug     = debug                # validate inputs on every call
+        self.dtype     = np.dtype(dtype)      # floating point type of the integrand calculation
+        self.max_block_bytes = max_block_bytes # memory of the (models x steps) buffers of the batch methods
 
-        # for quicker access later
-        self.llpmodel_unique_ids = [m.unique_id for m in self.llpmodels]
-        self.llp_funcs = [(m.interactions_per_cm, m.decay_factor) for m in self.llpmodels]
+        if isinstance(self.llpmodels, LLPModelSet):
+            # columnar models, no LLPModel objects are created
+            self.llpmodel_unique_ids = self.llpmodels.unique_ids
+            self.llp_funcs  = None
+            self.xsec_table = self.llpmodels.stacked_table()
+            self.masses     = self.llpmodels.masses
+            taus            = self.llpmodels.taus
+        else:
+            # for quicker access later
+            self.llpmodel_unique_ids = [m.unique_id for m in self.llpmodels]
+            self.llp_funcs = [(m.interactions_per_cm, m.decay_factor) for m in self.llpmodels]
+            # models sharing one LLPCrossSectionTable are evaluated in one interpolation
+            self.xsec_table = self._stack_xsec_tables(self.llpmodels)
+            self.masses     = np.array([m.mass for m in self.llpmodels], dtype=float)
+            taus            = np.array([m.tau for m in self.llpmodels], dtype=float)
+        if self.xsec_table is not None and self.dtype != np.float64:
+            self.xsec_table = self.xsec_table.astype(self.dtype)
+        # per model constants of the decay factor, c*tau/m in cm/GeV
+        self.c_tau_over_mass = (SPEED_OF_LIGHT * taus / self.masses)[:, None].astype(self.dtype)
+        # timers and counters, None when switched off
+        self.instrumentation = None
+        # preallocated buffers for calc_llp_probability
+        self.workspace = None
+        if max_steps is not None:
+            if self.xsec_table is None:
+                raise ValueError("max_steps requires all models to share one LLPCrossSectionTable")
+            self.workspace = LLPWorkspace(len(self.llpmodels), max_steps, self.xsec_table.energies, self.dtype)
 
-    def calc_llp_probability(self, length_list: list, energy_list: list) -> list:
+    @staticmethod
+    def _stack_xsec_tables(llpmodels: list):
+        """
+        Stacks the cross section rows of all models into one table, with each
+        model's scale folded in. Only possible if all models use LLPTabulatedCrossSection
+        on the same LLPCrossSectionTable.
+        :param llpmodels: List of LLPModels.
+        :return LLPCrossSectionTable: One row per model, or None if models can't be stacked.
+        """
+        xsecs = [m.llp_xsec for m in llpmodels]
+        if len(xsecs) == 0 or not all(isinstance(x, LLPTabulatedCrossSection) for x in xsecs):
+            return None
+        table = xsecs[0].table
+        if any(x.table is not table for x in xsecs):
+            return None
+        return table.take([x.row for x in xsecs], [x.scale for x in xsecs])
+
+    def enable_instrumentation(self, instrumentation: LLPInstrumentation = None) -> LLPInstrumentation:
+        """
+        Starts collecting stage timers and counters, can be called at any time.
+        :param instrumentation: LLPInstrumentation to fill, e.g. shared between estimators. \
+            A new one is created if not given.
+        :return LLPInstrumentation: The instrumentation that is filled.
+        """
+        self.instrumentation = LLPInstrumentation() if instrumentation is None else instrumentation
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        """ Stops collecting timers and counters. """
+        self.instrumentation = None
+
+    def update_fingerprint(self, sha):
+        """
+        Adds what determines the probabilities of the estimator to a hash, used to key
+        LLPCachedEstimator entries. Subclasses with more settings extend it.
+        :param sha: hashlib hash object to update.
+        """
+        sha.update(type(self).__qualname__.encode())
+        sha.update(np.float64(self.min_gap).tobytes())
+        sha.update(self.dtype.str.encode())
+        sha.update("\n".join(self.llpmodel_unique_ids).encode())
+        if self.xsec_table is not None:
+            sha.update(np.ascontiguousarray(self.xsec_table.interactions_table).tobytes())
+        else:
+            # evaluate the cross sections of all models on a few energies
+            probe = np.geomspace(10.0, 1000.0, 8)
+            for model in self.llpmodels:
+                sha.update(np.asarray(model.interactions_per_cm(probe), dtype=float).tobytes())
+
+    def subset(self, key):
+        """
+        New LLPEstimator with only some of the models and the same settings.
+        :param key: Index, slice, bool mask or index array into the models.
+        :return LLPEstimator: Estimator for the selected models, in the selected order.
+        """
+        indices = np.atleast_1d(np.arange(len(self.llpmodels))[key])
+        if isinstance(self.llpmodels, LLPModelSet):
+            llpmodels = self.llpmodels[indices]
+        else:
+            llpmodels = [self.llpmodels[i] for i in indices]
+        max_steps = None if self.workspace is None else self.workspace.max_steps
+        return LLPEstimator(llpmodels, self.min_gap/100.0, self.debug, max_steps, self.dtype)
+
+    def validate_precision(self, muons: LLPMuonBatch = None, reference = None) -> np.ndarray:
+        """
+        Compares the probabilities of this estimator with a float64 calculation,
+        e.g. to check that float32 is accurate enough for the models.
+        :param muons: Reference LLPMuonBatch. Defaults to 100 muons with 10 - 1000 m \
+            tracks and 100 GeV - 10 TeV energies, losing up to 40% of their energy.
+        :param reference: Estimator to compare with. Defaults to a float64 LLPEstimator \
+            of the same models and minimum gap.
+        :return np.ndarray: Largest relative error over the muons, per model.
+        """
+        if muons is None:
+            rng = np.random.default_rng(0)
+            counts = rng.integers(2, 200, size=100)
+            initial_energies = np.exp(rng.uniform(np.log(100.0), np.log(10000.0), 100))
+            muons = LLPMuonBatch.from_tracks(
+                [np.linspace(0, length, n) for length, n in zip(rng.uniform(10, 1000, 100), counts)],
+                [np.linspace(e, e*(1 - loss), n) for e, loss, n in zip(initial_energies, rng.uniform(0, 0.4, 100), counts)])
+        if reference is None:
+            reference = LLPEstimator(self.llpmodels, self.min_gap/100.0)
+        probabilities = self.calc_llp_probability_batch(muons)
+        expected = reference.calc_llp_probability_batch(muons)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative = np.abs(probabilities - expected) / np.abs(expected)
+        relative[probabilities == expected] = 0.0
+        return np.max(relative, axis=0, initial=0.0)
+
+    def calc_llp_probability(self,
+                             length_list: list,
+                             energy_list: list,
+                             out: np.ndarray = None,
+                             density_scale: np.ndarray = None) -> list:
         """
         Computes the total detectable LLP probability for a muon track.
 
@@ -36,41 +186,595 @@ class LLPEstimator():
         :param energy_list: Energies of the muon from detector entry to exit in GeV. \
             Ordered with length_list.
 
+        :param out: Optional array with one element per model to write the probabilities into.
+
+        :param density_scale: Optional density of the medium at each step, relative to \
+            the density of the LLPMediums, e.g. from LLPDensityProfile.track_scale.
+
         :return list: Returns a list of detectable LLP probabilities. \
             Ordered with list of LLPModels.
         """
+        ins = self.instrumentation
+        if ins is not None:
+            ins.start()
+            ins.count("calc_llp_probability", len(length_list), len(self.llpmodels))
         if len(length_list) != len(energy_list):
             raise ValueError("length_list and energy_list \
                              must contain same number of elements")
+        if density_scale is not None and np.shape(density_scale) != (len(length_list),):
+            raise ValueError("Need one density_scale per length step")
+        if self.workspace is not None:
+            return self._calc_llp_probability_workspace(length_list, energy_list, out, density_scale)
         if min(energy_list) < 0.0:
             raise ValueError("Negative energies not allowed. \
                              If muon stopped, give a length and \
                              energy list that stops at stopping point.")
 
-        # @TODO: clever way using numpy functionality to compute the probabilities faster
-
         # numpify input
-        length_array = np.asarray(length_list)*100.0 # convert to cm
-        energy_array = np.asarray(energy_list)       # GeV
-        track_length = length_array[-1]              # from entry to exit of detector
+        length_array = np.asarray(length_list)*100.0              # convert to cm
+        energy_array = np.asarray(energy_list, dtype=self.dtype)  # GeV
+        track_length = length_array[-1]                           # from entry to exit of detector
 
         # parameters for calculations
         l2_array = track_length - length_array - self.min_gap # from prod. vertex to furthest decay vertex
         delta_L = np.append(np.diff(length_array), 0)         # step length, in cm
+        if density_scale is not None:
+            delta_L *= density_scale                          # interactions per cm scale with density
+        if ins is not None:
+            ins.lap("input")
 
         # compute probability:
         # sum( delta_L * decay_factor * sum_atoms(atom_number_density * tot_xsec_atom) )
-        # @TODO: make more readable
         # 2D matrix with rows = models, cols = thin target approx segments
-        matrix_for_calc = np.row_stack(
-            [inter_per_cm(energy_array) * decay(self.min_gap, l2_array, energy_array)
-                for inter_per_cm, decay in self.llp_funcs]
-        )
-        probabilities = matrix_for_calc @ delta_L # NxM*Mx1 where N is no. models and M is no. length steps
+        matrix_for_calc = self._calc_integrand_matrix(energy_array, l2_array)
+        if matrix_for_calc.dtype == np.float64:
+            probabilities = np.matmul(matrix_for_calc, delta_L, out=out) # NxM*Mx1 where N is no. models and M is no. length steps
+        else:
+            # sum reduced precision integrands in float64
+            probabilities = np.einsum("ij,j->i", matrix_for_calc, delta_L, dtype=np.float64, out=out)
+        if ins is not None:
+            ins.lap("reduction")
 
         # list of probabilities, ordered with self.llpmodels
         return probabilities
 
+    def _calc_llp_probability_workspace(self, length_list: np.ndarray, energy_list: np.ndarray,
+                                        out: np.ndarray = None, density_scale: np.ndarray = None) -> np.ndarray:
+        """
+        calc_llp_probability using only the preallocated workspace buffers.
+        Allocates nothing if inputs are float arrays and out is given.
+        """
+        ws = self.workspace.steps(len(length_list))
+        energy_array = np.asarray(energy_list, dtype=self.dtype) # GeV
+        if np.min(energy_array) < 0.0:
+            raise ValueError("Negative energies not allowed. \
+                             If muon stopped, give a length and \
+                             energy list that stops at stopping point.")
+        if self.debug:
+            self._validate_energies(energy_array)
+
+        # lengths in cm, l2 and step lengths as in calc_llp_probability
+        np.multiply(length_list, 100.0, out=ws.lengths)
+        np.subtract(ws.lengths[-1] - self.min_gap, ws.lengths, out=ws.l2)
+        np.subtract(ws.lengths[1:], ws.lengths[:-1], out=ws.delta_L[:-1])
+        ws.delta_L[-1] = 0.0
+        if density_scale is not None:
+            np.multiply(ws.delta_L, density_scale, out=ws.delta_L)
+        ins = self.instrumentation
+        if ins is not None:
+            ins.lap("input")
+
+        # interactions per cm into ws.matrix, decay factors into ws.decay
+        self.xsec_table.interactions_per_cm(energy_array, workspace=ws)
+        if ins is not None:
+            ins.lap("cross_section")
+        decay_factor_matrix(self.min_gap, ws.l2, energy_array, self.c_tau_over_mass,
+                            out=ws.decay, work=ws.work, step_work=ws.step_work, step_mask=ws.step_mask)
+        if ins is not None:
+            ins.lap("decay_factor")
+        np.multiply(ws.matrix, ws.decay, out=ws.matrix)
+        if ws.dtype == np.float64:
+            probabilities = np.matmul(ws.matrix, ws.delta_L, out=out)
+        else:
+            probabilities = np.einsum("ij,j->i", ws.matrix, ws.delta_L, dtype=np.float64, out=out)
+        if ins is not None:
+            ins.lap("reduction")
+        return probabilities
+
+    def calc_llp_probability_adaptive(self,
+                                      length_list: list,
+                                      energy_list: list,
+                                      rtol: float = 1e-3,
+                                      atol: float = 0.0,
+                                      min_intervals: int = 8,
+                                      density_scale: np.ndarray = None) -> tuple:
+        """
+        Computes the total detectable LLP probability for a muon track with adaptive step coarsening.
+
+        Instead of evaluating the integrand at every length step, the track is split into
+        min_intervals intervals of steps that are bisected (by step index) until the
+        estimate of the interval agrees with the estimate from its two halves.
+        All intervals of one bisection level are evaluated in one vectorized call, so the
+        cost scales with how much the integrand varies and not with the number of steps.
+        Intervals are estimated with the trapezoid rule corrected to the thin target sum,
+        -1/2 * slope * sum(delta_L^2) over the steps of the interval, which is exact for an
+        integrand that is linear in the interval. So the result converges to
+        calc_llp_probability and not to the integral, which differ by terms of the order
+        of the step length (about 10% on tracks only a few steps longer than 2*min_gap).
+
+        :param length_list: Lengths from 0 to end of detector in m. \
+            Trimmed for entry/exit margins. Last element should be total length.
+
+        :param energy_list: Energies of the muon from detector entry to exit in GeV. \
+            Ordered with length_list.
+
+        :param rtol: Relative tolerance on the probability of every model.
+
+        :param atol: Absolute tolerance on the probability of every model.
+
+        :param min_intervals: Number of intervals before any interval is accepted.
+
+        :param density_scale: Optional relative density at each step, as in calc_llp_probability.
+
+        :return tuple: (probabilities, error estimates, number of steps evaluated). \
+            Error estimates are per model, the summed change of the accepted intervals \
+            under their last bisection. They estimate the difference to calc_llp_probability \
+            but are not guaranteed bounds, an integrand that varies only between the \
+            evaluated steps is missed.
+        """
+        ins = self.instrumentation
+        if ins is not None:
+            ins.start()
+            ins.count("calc_llp_probability_adaptive", len(length_list), len(self.llpmodels))
+        if len(length_list) != len(energy_list):
+            raise ValueError("length_list and energy_list \
+                             must contain same number of elements")
+        if min(energy_list) < 0.0:
+            raise ValueError("Negative energies not allowed. \
+                             If muon stopped, give a length and \
+                             energy list that stops at stopping point.")
+
+        # numpify input, same as calc_llp_probability
+        length_array = np.asarray(length_list, dtype=float)*100.0 # convert to cm
+        energy_array = np.asarray(energy_list, dtype=self.dtype)  # GeV
+        l2_array     = length_array[-1] - length_array - self.min_gap # float64 like all lengths
+        if density_scale is not None:
+            if np.shape(density_scale) != (len(length_list),):
+                raise ValueError("Need one density_scale per length step")
+            density_scale = np.asarray(density_scale, dtype=float)
+        n_steps      = len(length_array)
+        n_models     = len(self.llpmodels)
+        probabilities = np.zeros(n_models)
+        errors        = np.zeros(n_models)
+        track_length  = length_array[-1] - length_array[0]
+        if n_steps < 2 or track_length <= 0.0:
+            return probabilities, errors, 0
+
+        # sum of squared step lengths up to every step, for the thin target correction
+        squared_steps = np.concatenate([[0.0], np.cumsum(np.diff(length_array)**2)])
+        # integrand at the evaluated steps, rows = models
+        integrand = np.empty((n_models, n_steps))
+        a = np.unique(np.linspace(0, n_steps - 1, min(min_intervals, n_steps - 1) + 1).astype(np.intp))
+        integrand[:, a] = self._calc_integrand_matrix(energy_array[a], l2_array[a])
+        if density_scale is not None:
+            integrand[:, a] *= density_scale[a]
+        n_evaluated = len(a)
+        a, b = a[:-1], a[1:]
+        coarse = self._interval_sums(integrand, length_array, squared_steps, a, b)
+        # intervals of a single step are exact
+        exact = (b - a) == 1
+        probabilities += np.sum(coarse[:, exact], axis=1)
+        a, b, coarse = a[~exact], b[~exact], coarse[:, ~exact]
+
+        while len(a):
+            # bisect all open intervals by step index
+            m = (a + b) // 2
+            integrand[:, m] = self._calc_integrand_matrix(energy_array[m], l2_array[m])
+            if density_scale is not None:
+                integrand[:, m] *= density_scale[m]
+            n_evaluated += len(m)
+            left  = self._interval_sums(integrand, length_array, squared_steps, a, m)
+            right = self._interval_sums(integrand, length_array, squared_steps, m, b)
+            fine  = left + right
+            error = np.abs(fine - coarse)
+
+            # share the tolerance of the current estimate between intervals by length
+            estimate = probabilities + np.sum(fine, axis=1)
+            tolerance = np.maximum(rtol*estimate, atol)[:, None] \
+                * ((length_array[b] - length_array[a]) / track_length)
+            exact  = (b - a) <= 2
+            accept = exact | np.all(error <= tolerance, axis=0)
+            probabilities += np.sum(fine[:, accept], axis=1)
+            errors += np.sum(error[:, accept & ~exact], axis=1)
+
+            # halves of the remaining intervals, single step halves are exact
+            refine = ~accept
+            a = np.concatenate([a[refine], m[refine]])
+            b = np.concatenate([m[refine], b[refine]])
+            coarse = np.concatenate([left[:, refine], right[:, refine]], axis=1)
+            exact = (b - a) == 1
+            probabilities += np.sum(coarse[:, exact], axis=1)
+            a, b, coarse = a[~exact], b[~exact], coarse[:, ~exact]
+
+        if ins is not None:
+            ins.lap("reduction")
+        return probabilities, errors, n_evaluated
+
+    @staticmethod
+    def _interval_sums(integrand: np.ndarray, length_array: np.ndarray, squared_steps: np.ndarray,
+                       a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """
+        Thin target sum over the steps a to b - 1 of intervals, from the integrand at a and b only.
+        Trapezoid rule with the correction -1/2 * slope * sum(delta_L^2), i.e.
+        f_a*(w + q)/2 + f_b*(w - q)/2 with width w and q = sum(delta_L^2)/w.
+        A single step gives f_a*delta_L like calc_llp_probability.
+        :param integrand: Integrand with rows = models, cols = steps, filled at a and b.
+        :param length_array: Lengths of the steps in cm.
+        :param squared_steps: Cumulative sum of squared step lengths, starting with 0.
+        :param a: First step of every interval.
+        :param b: Last step of every interval, after a.
+        :return np.ndarray: Sums with rows = models, cols = intervals.
+        """
+        width = length_array[b] - length_array[a]
+        q = np.divide(squared_steps[b] - squared_steps[a], width, out=np.zeros(len(width)), where=width > 0)
+        return 0.5*(integrand[:, a]*(width + q) + integrand[:, b]*(width - q))
+
+    def calc_llp_probability_batch(self, muons: LLPMuonBatch, density_scale: np.ndarray = None) -> np.ndarray:
+        """
+        Computes the total detectable LLP probability for a batch of muon tracks.
+
+        Same calculation as calc_llp_probability, but muons are evaluated in vectorized
+        blocks over the flat length and energy arrays, see max_block_bytes.
+
+        :param muons: LLPMuonBatch with lengths in m and energies in GeV. \
+            Each muon trimmed for entry/exit margins like in calc_llp_probability.
+
+        :param density_scale: Optional relative density at each step of the flat \
+            muons.lengths, as in calc_llp_probability.
+
+        :return np.ndarray: Detectable LLP probabilities with shape (n_muons, n_models). \
+            Columns ordered with list of LLPModels.
+        """
+        ins = self.instrumentation
+        if ins is not None:
+            ins.start()
+            ins.count("calc_llp_probability_batch", muons.step_counts, len(self.llpmodels))
+        if len(muons) == 0:
+            return np.zeros((0, len(self.llpmodels)))
+        self._validate_batch(muons, density_scale)
+
+        # rows = muons, cols = models ordered with self.llpmodels
+        probabilities = np.empty((len(muons), len(self.llpmodels)))
+        blocks = self._muon_blocks(muons, 3)
+        n_block_steps = max(muons.offsets[last] - muons.offsets[first] for first, last in blocks)
+        buffers = np.empty((3, len(self.llpmodels)*n_block_steps), dtype=self.dtype) # reused by all blocks
+        for first, last in blocks:
+            block = muons[first:last]
+            scale = None if density_scale is None else density_scale[muons.offsets[first]:muons.offsets[last]]
+            views = [buffer[:len(self.llpmodels)*block.n_steps].reshape(len(self.llpmodels), block.n_steps)
+                     for buffer in buffers]
+            matrix_for_calc = self._calc_integrand_batch(block, scale, *views)
+            # sum segments per muon
+            np.add.reduceat(matrix_for_calc, block.offsets[:-1], axis=1, dtype=np.float64,
+                            out=probabilities[first:last].T)
+            if ins is not None:
+                ins.lap("reduction")
+        return probabilities
+
+    def calc_llp_integrand_batch(self, muons: LLPMuonBatch, density_scale: np.ndarray = None) -> np.ndarray:
+        """
+        Contribution of every step of a batch of muons to the detectable LLP probability,
+        i.e. the terms of the sum in calc_llp_probability_batch. Used as the distribution
+        of production vertices in LLPVertexSampler. Not split into blocks, the result
+        has one column per step of the batch.
+
+        :param muons: LLPMuonBatch with lengths in m and energies in GeV.
+
+        :param density_scale: Optional relative density at each step of the flat \
+            muons.lengths, as in calc_llp_probability.
+
+        :return np.ndarray: delta_L * decay factor * interactions per cm with rows = models, \
+            cols = steps of the flat muons.lengths. The last step of each muon is 0.
+        """
+        self._validate_batch(muons, density_scale)
+        return self._calc_integrand_batch(muons, density_scale)
+
+    def _validate_batch(self, muons: LLPMuonBatch, density_scale: np.ndarray):
+        """ Checks the energies and density_scale of a batch. """
+        if muons.n_steps and np.min(muons.energies) < 0.0:
+            raise ValueError("Negative energies not allowed. \
+                             If muon stopped, give a length and \
+                             energy list that stops at stopping point.")
+        if density_scale is not None and np.shape(density_scale) != muons.lengths.shape:
+            raise ValueError("Need one density_scale per length step")
+
+    def _muon_blocks(self, muons: LLPMuonBatch, n_buffers: int) -> list:
+        """
+        Splits a batch into ranges of whole muons, so that n_buffers (models x steps)
+        buffers of a range take at most max_block_bytes. Muons longer than that get their own range.
+        :param muons: LLPMuonBatch to split.
+        :param n_buffers: Number of (models x steps) buffers the caller needs per block.
+        :return list: (first, last) muon indices of the blocks.
+        """
+        offsets = muons.offsets
+        step_bytes = n_buffers * max(len(self.llpmodels), 1) * self.dtype.itemsize
+        max_steps = max(self.max_block_bytes // step_bytes, 1)
+        blocks = []
+        first = 0
+        while first < len(muons):
+            last = int(np.searchsorted(offsets, offsets[first] + max_steps, side="right")) - 1
+            last = max(last, first + 1)
+            blocks.append((first, last))
+            first = last
+        return blocks
+
+    def _calc_integrand_batch(self, muons: LLPMuonBatch, density_scale: np.ndarray = None,
+                              out: np.ndarray = None, work: np.ndarray = None, decay: np.ndarray = None) -> np.ndarray:
+        """
+        calc_llp_integrand_batch without input checks, optionally into (models x steps) buffers.
+        """
+        ins = self.instrumentation
+        ends = muons.offsets[1:]
+
+        # numpify input
+        length_array  = muons.lengths*100.0 # convert to cm
+        energy_array  = muons.energies.astype(self.dtype, copy=False) # GeV
+        track_lengths = np.repeat(length_array[ends - 1], muons.step_counts) # per step
+
+        # parameters for calculations, same as single muon but per step of the batch
+        l2_array = track_lengths - length_array - self.min_gap # from prod. vertex to furthest decay vertex
+        delta_L = np.diff(length_array, append=0.0)            # step length, in cm
+        delta_L[ends - 1] = 0.0                                # last step of each muon
+        if density_scale is not None:
+            delta_L *= density_scale                           # interactions per cm scale with density
+        delta_L = delta_L.astype(self.dtype, copy=False)
+        if ins is not None:
+            ins.lap("input")
+
+        # 2D matrix with rows = models, cols = segments of all muons
+        matrix_for_calc = self._calc_integrand_matrix(energy_array, l2_array, out, work, decay)
+        matrix_for_calc *= delta_L
+        return matrix_for_calc
+
+    def calc_llp_probability_gaps(self,
+                                  length_list: list,
+                                  energy_list: list,
+                                  min_gaps_meters: np.ndarray,
+                                  density_scale: np.ndarray = None) -> np.ndarray:
+        """
+        Computes calc_llp_probability for several minimum detectable gap lengths in one pass.
+
+        The interactions per cm do not depend on the gap and are computed once,
+        only the decay factor is evaluated per gap.
+
+        :param length_list: Lengths from 0 to end of detector in m, as in calc_llp_probability.
+
+        :param energy_list: Energies of the muon from detector entry to exit in GeV.
+
+        :param min_gaps_meters: Shortest detectable gaps in m.
+
+        :param density_scale: Optional density of the medium at each step, relative to \
+            the density of the LLPMediums, as in calc_llp_probability.
+
+        :return np.ndarray: Detectable LLP probabilities with shape (n_gaps, n_models).
+        """
+        ins = self.instrumentation
+        if ins is not None:
+            ins.start()
+            ins.count("calc_llp_probability_gaps", len(length_list), len(self.llpmodels))
+        if len(length_list) != len(energy_list):
+            raise ValueError("length_list and energy_list \
+                             must contain same number of elements")
+        if density_scale is not None and np.shape(density_scale) != (len(length_list),):
+            raise ValueError("Need one density_scale per length step")
+        if min(energy_list) < 0.0:
+            raise ValueError("Negative energies not allowed. \
+                             If muon stopped, give a length and \
+                             energy list that stops at stopping point.")
+        length_array = np.asarray(length_list, dtype=float)*100.0 # convert to cm
+        energy_array = np.asarray(energy_list, dtype=self.dtype)  # GeV
+        remaining = length_array[-1] - length_array               # from prod. vertex to end of track
+        delta_L = np.append(np.diff(length_array), 0)             # step length, in cm
+        if density_scale is not None:
+            delta_L *= density_scale                              # interactions per cm scale with density
+        if ins is not None:
+            ins.lap("input")
+        probabilities = self._reduce_gaps(min_gaps_meters, remaining, energy_array, delta_L)[:, :, 0]
+        if ins is not None:
+            ins.lap("reduction")
+        return probabilities
+
+    def calc_llp_probability_batch_gaps(self,
+                                        muons: LLPMuonBatch,
+                                        min_gaps_meters: np.ndarray,
+                                        density_scale: np.ndarray = None) -> np.ndarray:
+        """
+        Computes calc_llp_probability_batch for several minimum detectable gap lengths in one pass.
+        :param muons: LLPMuonBatch with lengths in m and energies in GeV.
+        :param min_gaps_meters: Shortest detectable gaps in m.
+        :param density_scale: Optional relative density at each step of the flat muons.lengths.
+        :return np.ndarray: Detectable LLP probabilities with shape (n_muons, n_gaps, n_models).
+        """
+        ins = self.instrumentation
+        if ins is not None:
+            ins.start()
+            ins.count("calc_llp_probability_batch_gaps", muons.step_counts, len(self.llpmodels))
+        n_gaps = len(np.atleast_1d(min_gaps_meters))
+        if len(muons) == 0:
+            return np.zeros((0, n_gaps, len(self.llpmodels)))
+        if density_scale is not None and np.shape(density_scale) != muons.lengths.shape:
+            raise ValueError("Need one density_scale per length step")
+        if np.min(muons.energies) < 0.0:
+            raise ValueError("Negative energies not allowed. \
+                             If muon stopped, give a length and \
+                             energy list that stops at stopping point.")
+        # blocks of muons, the gap scan keeps about four (models x steps) arrays
+        probabilities = np.empty((len(muons), n_gaps, len(self.llpmodels)))
+        for first, last in self._muon_blocks(muons, 4):
+            block = muons[first:last]
+            ends = block.offsets[1:]
+            length_array = block.lengths*100.0 # convert to cm
+            energy_array = block.energies.astype(self.dtype, copy=False) # GeV
+            remaining = np.repeat(length_array[ends - 1], block.step_counts) - length_array
+            delta_L = np.diff(length_array, append=0.0) # step length, in cm
+            delta_L[ends - 1] = 0.0                     # last step of each muon
+            if density_scale is not None:
+                delta_L *= density_scale[muons.offsets[first]:muons.offsets[last]] # scales with density
+            if ins is not None:
+                ins.lap("input")
+            # rows = models, cols = muons for every gap
+            muon_index = np.repeat(np.arange(len(block)), block.step_counts)
+            block_probabilities = self._reduce_gaps(min_gaps_meters, remaining, energy_array, delta_L,
+                                                    muon_index, len(block))
+            probabilities[first:last] = block_probabilities.transpose(2, 0, 1)
+            if ins is not None:
+                ins.lap("reduction")
+        return probabilities
+
+    def _reduce_gaps(self, min_gaps_meters: np.ndarray, remaining: np.ndarray, energy_array: np.ndarray,
+                     delta_L: np.ndarray, muon_index: np.ndarray = None, n_muons: int = 1) -> np.ndarray:
+        """
+        Integrand of calc_llp_probability for every gap, summed over the steps of every muon.
+        Decay factor exp(-l1/d) - exp(-l2/d) with l1 = gap and l2 = remaining - gap,
+        written as exp(-l1/d) * -expm1(-(l2-l1)/d) like decay_factor_matrix, where
+        only -1/d has to be computed for all models and steps. Gaps are evaluated in
+        increasing order and steps closer than 2*gap to the end of their track, which
+        can't contribute to this or any larger gap, are dropped along the way.
+        :param min_gaps_meters: Shortest detectable gaps in m.
+        :param remaining: Length from every step to the end of its track in cm.
+        :param energy_array: Muon energy at each step in GeV.
+        :param delta_L: Step lengths in cm.
+        :param muon_index: Muon of every step, ascending. None for a single muon.
+        :param n_muons: Number of muons.
+        :return np.ndarray: Probabilities with shape (n_gaps, n_models, n_muons).
+        """
+        min_gaps = np.atleast_1d(np.asarray(min_gaps_meters, dtype=float))*100.0 # convert to cm
+        if min_gaps.ndim != 1:
+            raise ValueError("min_gaps_meters must be one dimensional")
+        if self.debug:
+            self._validate_energies(energy_array)
+        ins = self.instrumentation
+        # interactions per cm times step length, independent of the gap
+        if self.xsec_table is not None:
+            weighted = self.xsec_table.interactions_per_cm(energy_array)
+        else:
+            weighted = np.array([inter_per_cm(energy_array) for inter_per_cm, _ in self.llp_funcs], dtype=self.dtype)
+        weighted *= -delta_L.astype(self.dtype, copy=False) # sign of -expm1 folded in
+        if ins is not None:
+            ins.lap("cross_section")
+        # -1/d, infinite decay length where energy <= 0 gives decay factor 0
+        neg_inv_decay = np.einsum("i,j->ij", self.c_tau_over_mass[:, 0], energy_array)
+        neg_inv_decay[:, energy_array <= 0.0] = np.inf
+        np.divide(-1.0, neg_inv_decay, out=neg_inv_decay)
+        if muon_index is None:
+            muon_index = np.zeros(len(remaining), dtype=np.intp)
+            n_muons = 1
+        n_models = len(self.llpmodels)
+        buffers = np.empty((2, n_models*len(remaining)), dtype=neg_inv_decay.dtype)
+
+        # negative gaps are unphysical and stay 0, like in decay_factor_matrix
+        probabilities = np.zeros((len(min_gaps), n_models, n_muons))
+        for k in np.argsort(min_gaps, kind="stable"):
+            gap = min_gaps[k]
+            if gap < 0:
+                continue
+            span = remaining - 2*gap # l2 - l1
+            active = span > 0.0
+            if not np.any(active):
+                break
+            if np.count_nonzero(active) < 0.75*len(span):
+                # drop steps that only contribute to smaller gaps
+                neg_inv_decay, weighted = neg_inv_decay[:, active], weighted[:, active]
+                remaining, muon_index, span = remaining[active], muon_index[active], span[active]
+            n_steps = len(span)
+            decay = buffers[0, :n_models*n_steps].reshape(n_models, n_steps)
+            work = buffers[1, :n_models*n_steps].reshape(n_models, n_steps)
+            # unphysical events l2 <= l1 get expm1(0) = 0
+            np.multiply(neg_inv_decay, np.maximum(span, 0.0).astype(self.dtype, copy=False), out=decay)
+            np.expm1(decay, out=decay)
+            np.multiply(neg_inv_decay, gap, out=work)
+            np.exp(work, out=work)
+            np.multiply(decay, work, out=decay)
+            np.multiply(decay, weighted, out=decay)
+            # sum the steps of every muon that has steps left
+            if n_muons == 1:
+                np.einsum("ij->i", decay, dtype=np.float64, out=probabilities[k, :, 0])
+            else:
+                muons, starts = np.unique(muon_index, return_index=True)
+                probabilities[k][:, muons] = np.add.reduceat(decay, starts, axis=1, dtype=np.float64)
+        if ins is not None:
+            ins.lap("decay_factor")
+        return probabilities
+
+    def accumulate(self,
+                   muons: LLPMuonBatch,
+                   weights: np.ndarray = None,
+                   accumulator: LLPRateAccumulator = None) -> LLPRateAccumulator:
+        """
+        Adds flux weighted detectable LLP probabilities of a batch of muons to running
+        per model sums, instead of keeping the probability of every muon.
+
+        :param muons: LLPMuonBatch with lengths in m and energies in GeV.
+
+        :param weights: Flux weight per muon. Defaults to 1.
+
+        :param accumulator: LLPRateAccumulator to add to. A new one is created if not given.
+
+        :return LLPRateAccumulator: The accumulator with the batch added.
+        """
+        if accumulator is None:
+            accumulator = LLPRateAccumulator(len(self.llpmodels), self.llpmodel_unique_ids)
+        accumulator.add(self.calc_llp_probability_batch(muons), weights)
+        return accumulator
+
+    def _calc_integrand_matrix(self, energy_array: np.ndarray, l2_array: np.ndarray,
+                               out: np.ndarray = None, work: np.ndarray = None, decay: np.ndarray = None) -> np.ndarray:
+        """
+        Thin target integrand for all models and segments.
+        :param energy_array: Muon energy at each segment in GeV.
+        :param l2_array: Length from production vertex to furthest decay vertex in cm.
+        :param out: Optional buffer with shape (models, segments) for the result.
+        :param work: Optional scratch buffer with the same shape, required with out.
+        :param decay: Optional scratch buffer with the same shape, required with out.
+        :return np.ndarray: Matrix with rows = models, cols = segments. Units of cm^-1.
+        """
+        if self.debug:
+            self._validate_energies(energy_array)
+        ins = self.instrumentation
+        if out is None:
+            matrix = decay_factor_matrix(self.min_gap, l2_array, energy_array, self.c_tau_over_mass)
+            interactions = None
+        else:
+            matrix = decay_factor_matrix(self.min_gap, l2_array, energy_array, self.c_tau_over_mass,
+                                         out=decay, work=out)
+            interactions = (out, work)
+        if ins is not None:
+            ins.lap("decay_factor")
+        if self.xsec_table is not None:
+            # all models in one interpolation, rows ordered with self.llpmodels
+            if interactions is None:
+                matrix *= self.xsec_table.interactions_per_cm(energy_array)
+            else:
+                np.multiply(matrix, self.xsec_table.interactions_per_cm(energy_array, out=out, work=work), out=out)
+                matrix = out
+        else:
+            for row, (inter_per_cm, _) in zip(matrix, self.llp_funcs):
+                row *= inter_per_cm(energy_array)
+            if out is not None:
+                np.copyto(out, matrix)
+                matrix = out
+        if ins is not None:
+            ins.lap("cross_section")
+        return matrix
+
+    def _validate_energies(self, energy_array: np.ndarray):
+        """
+        Debug check that the LLP energies give physical Lorentz boosts for all models.
+        :param energy_array: Muon energy at each segment in GeV.
+        """
+        if energy_array.size and np.min(energy_array) < np.max(self.masses):
+            raise ValueError("Lorentz boost can't be smaller than 1.")
+
     def calc_llp_probability_with_id(self, length_list: list, energy_list: list) -> dict:
         """
         Returns the probabilities calculated in calc_llp_probability mapped to LLPModel unique_id.
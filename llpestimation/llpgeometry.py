@@ -0,0 +1,167 @@
+"""
+Detector volumes that turn straight muon tracks into the trimmed
+length and energy steps expected by the LLPEstimator.
+
+Tracks are given by origins, unit directions and energies at the origin
+in arrays over all muons. Intersections with the volume, trimming and
+step placement are computed for all muons at once, muons that miss the
+volume or stop before it are dropped.
+"""
+import numpy as np
+from .llpenergyloss import LLPEnergyLoss
+
+class LLPDetectorVolume():
+    """
+    Base class of detector volumes. Subclasses implement intersect.
+    Positions in m, with z pointing up.
+    """
+    def intersect(self, origins: np.ndarray, directions: np.ndarray) -> tuple:
+        """
+        Distances along the tracks where they enter and exit the volume.
+        :param origins: Track origins with shape (n_muons, 3).
+        :param directions: Unit directions with shape (n_muons, 3).
+        :return tuple: (t_in, t_out) distances from the origin, both with shape (n_muons,). \
+            Only positive distances count, so t_in is 0 for origins inside the volume. \
+            Muons that miss the volume have t_out <= t_in.
+        """
+        raise NotImplementedError
+
+    def muon_batch(self,
+                   origins: np.ndarray,
+                   directions: np.ndarray,
+                   energies: np.ndarray,
+                   step_length: float = 10.0,
+                   entry_margin: float = 0.0,
+                   exit_margin: float = 0.0,
+                   min_length: float = 0.0,
+                   energy_loss: LLPEnergyLoss = None) -> tuple:
+        """
+        Length and energy steps of the muons inside the volume.
+        Tracks are trimmed by the margins at entry and exit, stop where the muon
+        ranges out, and are split into steps of at most step_length.
+        :param origins: Track origins with shape (n_muons, 3) in m.
+        :param directions: Unit directions of the muons with shape (n_muons, 3).
+        :param energies: Muon energies at the origins in GeV.
+        :param step_length: Longest step in m.
+        :param entry_margin: Length in m trimmed at the start of the track in the volume.
+        :param exit_margin: Length in m trimmed at the end of the track in the volume.
+        :param min_length: Muons with shorter trimmed tracks are dropped.
+        :param energy_loss: LLPEnergyLoss along the track. Defaults to LLPEnergyLoss().
+        :return tuple: (LLPMuonBatch with lengths from the trimmed entry point, \
+            indices of the muons in the batch).
+        """
+        if step_length <= 0:
+            raise ValueError("step_length must be positive")
+        origins = np.asarray(origins, dtype=float)
+        directions = np.asarray(directions, dtype=float)
+        energies = np.asarray(energies, dtype=float)
+        if origins.ndim != 2 or origins.shape[1] != 3 or directions.shape != origins.shape:
+            raise ValueError("origins and directions must have shape (n_muons, 3)")
+        if energies.shape != (len(origins),):
+            raise ValueError("Need one energy per muon")
+        if energy_loss is None:
+            energy_loss = LLPEnergyLoss()
+
+        t_in, t_out = self.intersect(origins, directions)
+        start = t_in + entry_margin
+        # trimmed track ends at the exit or where the muon stops
+        end = np.minimum(t_out - exit_margin, energy_loss.range(energies))
+        with np.errstate(invalid="ignore"):
+            kept = np.flatnonzero((end - start > min_length) & (end - start > 0))
+        start, track_lengths = start[kept], end[kept] - start[kept]
+        entry_energies = energy_loss.energy(energies[kept], start)
+        return energy_loss.muon_batch(entry_energies, track_lengths, step_length), kept
+
+class LLPCylinder(LLPDetectorVolume):
+    """
+    Upright cylinder around center with the given radius and height.
+    """
+    def __init__(self, radius: float, height: float, center: tuple = (0.0, 0.0, 0.0)):
+        if radius <= 0 or height <= 0:
+            raise ValueError("Cylinder needs a positive radius and height")
+        self.radius = radius                             # in m
+        self.height = height                             # in m
+        self.center = np.asarray(center, dtype=float)    # in m
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray) -> tuple:
+        """ See LLPDetectorVolume.intersect. """
+        relative = np.asarray(origins, dtype=float) - self.center
+        directions = np.asarray(directions, dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # mantle: |o_xy + t d_xy|^2 = r^2
+            a = directions[:, 0]**2 + directions[:, 1]**2
+            b = relative[:, 0]*directions[:, 0] + relative[:, 1]*directions[:, 1]
+            c = relative[:, 0]**2 + relative[:, 1]**2 - self.radius**2
+            root = np.sqrt(b**2 - a*c)
+            parallel = a == 0 # vertical tracks are inside the mantle everywhere or nowhere
+            t_in = np.where(parallel, np.where(c <= 0, -np.inf, np.inf), (-b - root) / a)
+            t_out = np.where(parallel, np.where(c <= 0, np.inf, -np.inf), (-b + root) / a)
+            # caps
+            t_in, t_out = _clip_slab(t_in, t_out, relative[:, 2], directions[:, 2], -self.height/2, self.height/2)
+        # misses have nan from the root
+        miss = np.isnan(t_in) | np.isnan(t_out)
+        return np.where(miss, np.inf, np.maximum(t_in, 0.0)), np.where(miss, -np.inf, t_out)
+
+class LLPPrism(LLPDetectorVolume):
+    """
+    Upright prism with a convex polygon as footprint, e.g. the hexagon of IceCube.
+    vertices are the corners of the polygon in the xy plane, in counterclockwise order.
+    """
+    def __init__(self, vertices: np.ndarray, z_min: float, z_max: float):
+        self.vertices = np.asarray(vertices, dtype=float) # (n_corners, 2) in m
+        self.z_min    = z_min                             # bottom in m
+        self.z_max    = z_max                             # top in m
+        if self.vertices.ndim != 2 or self.vertices.shape[1] != 2 or len(self.vertices) < 3:
+            raise ValueError("Need at least 3 vertices in the xy plane")
+        if z_max <= z_min:
+            raise ValueError("z_max must be above z_min")
+        # outward normals and offsets of the edges, inside is normal . p <= offset
+        edges = np.roll(self.vertices, -1, axis=0) - self.vertices
+        self.normals = np.stack([edges[:, 1], -edges[:, 0]], axis=1)
+        self.normals /= np.linalg.norm(self.normals, axis=1)[:, None]
+        self.offsets = np.einsum("ij,ij->i", self.normals, self.vertices)
+        if np.any(np.einsum("ij,kj->ik", self.normals, self.vertices) > self.offsets[:, None] + 1e-9):
+            raise ValueError("Vertices must form a convex polygon in counterclockwise order")
+
+    @classmethod
+    def hexagon(cls, radius: float, z_min: float, z_max: float, center: tuple = (0.0, 0.0), angle: float = 0.0):
+        """
+        Prism with a regular hexagon as footprint.
+        :param radius: Distance of the corners from the center in m.
+        :param z_min: Bottom in m.
+        :param z_max: Top in m.
+        :param center: Center of the hexagon in the xy plane in m.
+        :param angle: Rotation of the first corner from the x axis in rad.
+        :return LLPPrism: Hexagonal prism.
+        """
+        phi = angle + np.arange(6)*np.pi/3
+        vertices = np.asarray(center, dtype=float) + radius*np.stack([np.cos(phi), np.sin(phi)], axis=1)
+        return cls(vertices, z_min, z_max)
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray) -> tuple:
+        """ See LLPDetectorVolume.intersect. """
+        origins = np.asarray(origins, dtype=float)
+        directions = np.asarray(directions, dtype=float)
+        # every side is a half space normal . (o + t d) <= offset
+        approach = directions[:, :2] @ self.normals.T
+        distance = self.offsets - origins[:, :2] @ self.normals.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = distance / approach
+            t_in = np.max(np.where(approach < 0, t, -np.inf), axis=1)
+            t_out = np.min(np.where(approach > 0, t, np.inf), axis=1)
+            # tracks parallel to a side outside of it miss
+            outside = np.any((approach == 0) & (distance < 0), axis=1)
+            t_out[outside] = -np.inf
+            t_in, t_out = _clip_slab(t_in, t_out, origins[:, 2], directions[:, 2], self.z_min, self.z_max)
+        return np.maximum(t_in, 0.0), t_out
+
+def _clip_slab(t_in: np.ndarray, t_out: np.ndarray, position: np.ndarray, direction: np.ndarray,
+               low: float, high: float) -> tuple:
+    """ Intersects the track intervals with low <= position + t direction <= high. """
+    t_low = (low - position) / direction
+    t_high = (high - position) / direction
+    parallel = direction == 0
+    inside = (position >= low) & (position <= high)
+    t_in = np.maximum(t_in, np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t_low, t_high)))
+    t_out = np.minimum(t_out, np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t_low, t_high)))
+    return t_in, t_out
@@ -0,0 +1,113 @@
+"""
+LLPEstimator for models on an LLPModelGrid.
+
+Evaluates the cross section once per mass and applies the
+coupling scaling analytically instead of once per grid point.
+"""
+import numpy as np
+from .llpestimator import LLPEstimator
+from .llpmodelgrid import LLPModelGrid
+from .llpmuonbatch import LLPMuonBatch
+from .llpmodel import SPEED_OF_LIGHT
+
+class LLPGridEstimator(LLPEstimator):
+    """
+    LLPEstimator over all models of an LLPModelGrid, ordered mass-major.
+    The interactions per cm are interpolated for the n_mass eps = 1 table rows only
+    and scaled with eps^2. The lifetime tau_eps1/eps^2 makes the inverse decay length
+    eps^2 * m/(c*tau_eps1*E), which is computed once per (mass, step) and broadcast
+    over eps, only the exponentials are evaluated for every grid point.
+    The stacked table of all grid points is only built when a method needs it
+    (calc_llp_probability_batch_gaps, update_fingerprint).
+    All LLPEstimator methods work and return the flat model axis, the *_grid
+    methods reshape it to (masses, epsilons).
+    """
+    def __init__(self, grid: LLPModelGrid, min_gap_meters: float = 50.0, debug: bool = False,
+                 dtype = np.float64, max_block_bytes: int = 2**25):
+        if max_block_bytes < 1:
+            raise ValueError("max_block_bytes must be positive")
+        # same attributes as LLPEstimator, without stacking the table rows of every grid point
+        self.min_gap   = min_gap_meters*100.0 # shortest detectable LLP gap [m -> cm]
+        self.llpmodels = grid.model_set()     # columnar models, mass-major
+        self.debug     = debug                # validate inputs on every call
+        self.dtype     = np.dtype(dtype)      # floating point type of the integrand calculation
+        self.max_block_bytes = max_block_bytes # memory of the (models x steps) buffers of the batch methods
+        self.llpmodel_unique_ids = self.llpmodels.unique_ids
+        self.llp_funcs = None
+        self.masses    = self.llpmodels.masses
+        self.c_tau_over_mass = (SPEED_OF_LIGHT * self.llpmodels.taus / self.masses)[:, None].astype(self.dtype)
+        self.instrumentation = None
+        self.workspace = None
+        self._xsec_table = None # stacked table of all grid points, built on first use
+
+        self.grid = grid
+        self.grid_table = grid.table.take(grid.rows).astype(self.dtype) # one row per mass at eps = 1
+        self.eps_squared = (grid.epsilons**2).astype(self.dtype)
+        # -m/(c*tau) at eps = 1 per mass in GeV/cm, -1/d = eps^2 * this / E
+        self.neg_inv_c_tau_eps1 = (-grid.masses / (SPEED_OF_LIGHT * grid.taus_eps1))[:, None].astype(self.dtype)
+
+    @property
+    def xsec_table(self):
+        """ LLPCrossSectionTable with one row per grid point, built on first access. """
+        if self._xsec_table is None:
+            self._xsec_table = self.llpmodels.stacked_table().astype(self.dtype)
+        return self._xsec_table
+
+    def calc_llp_probability_grid(self, length_list: list, energy_list: list) -> np.ndarray:
+        """
+        calc_llp_probability with models arranged on the grid.
+        :return np.ndarray: Detectable LLP probabilities with shape (n_masses, n_epsilons).
+        """
+        return self.calc_llp_probability(length_list, energy_list).reshape(self.grid.shape)
+
+    def calc_llp_probability_batch_grid(self, muons: LLPMuonBatch) -> np.ndarray:
+        """
+        calc_llp_probability_batch with models arranged on the grid.
+        :return np.ndarray: Detectable LLP probabilities with shape (n_muons, n_masses, n_epsilons).
+        """
+        return self.calc_llp_probability_batch(muons).reshape((len(muons),) + self.grid.shape)
+
+    def _calc_integrand_matrix(self, energy_array: np.ndarray, l2_array: np.ndarray,
+                               out: np.ndarray = None, work: np.ndarray = None, decay: np.ndarray = None) -> np.ndarray:
+        """
+        Thin target integrand for all grid points and segments, see LLPEstimator._calc_integrand_matrix.
+        The decay factor is exp(-l1/d) * -expm1(-(l2-l1)/d) like in decay_factor_matrix.
+        :param energy_array: Muon energy at each segment in GeV.
+        :param l2_array: Length from production vertex to furthest decay vertex in cm.
+        :param out: Optional buffer with shape (models, segments) for the result.
+        :param work: Optional scratch buffer with the same shape.
+        :param decay: Unused, the decay factor is computed in out.
+        :return np.ndarray: Matrix with rows = models, cols = segments. Units of cm^-1.
+        """
+        if self.debug:
+            self._validate_energies(energy_array)
+        ins = self.instrumentation
+        energy_array = np.asarray(energy_array, dtype=self.dtype)
+        shape = self.grid.shape + (len(energy_array),)
+        matrix = np.empty(shape, dtype=self.dtype) if out is None else out.reshape(shape)
+        work = np.empty(shape, dtype=self.dtype) if work is None else work.reshape(shape)
+
+        # -1/d at eps = 1 once per (mass, step), 0 for energy <= 0 (infinite decay length)
+        # and for unphysical segments l2 <= l1, which makes their decay factor expm1(0) = 0
+        with np.errstate(divide="ignore"):
+            neg_inv_decay = self.neg_inv_c_tau_eps1 / energy_array
+        neg_inv_decay[:, (energy_array <= 0.0) | (l2_array <= self.min_gap)] = 0.0
+        span = np.maximum(l2_array - self.min_gap, 0.0).astype(self.dtype) # l2 - l1
+        # expm1(-(l2-l1)/d) and exp(-l1/d) for every eps, -1/d scales with eps^2
+        # (einsum broadcasts over eps faster than multiply)
+        np.einsum("ms,e->mes", neg_inv_decay*span, self.eps_squared, out=matrix)
+        np.expm1(matrix, out=matrix)
+        np.einsum("ms,e->mes", neg_inv_decay, self.min_gap*self.eps_squared, out=work)
+        np.exp(work, out=work)
+        matrix *= work
+        if self.min_gap < 0:
+            matrix.fill(0.0)
+        if ins is not None:
+            ins.lap("decay_factor")
+        # interactions per cm once per mass, scaled to every eps of the grid, sign of -expm1 folded in
+        interactions = self.grid_table.interactions_per_cm(energy_array).astype(self.dtype, copy=False)
+        np.einsum("ms,e->mes", interactions, -self.eps_squared, out=work)
+        matrix *= work
+        if ins is not None:
+            ins.lap("cross_section")
+        return matrix.reshape(len(self.llpmodels), len(energy_array))
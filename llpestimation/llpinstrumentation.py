@@ -0,0 +1,108 @@
+"""
+Low overhead instrumentation of the LLPEstimator hot path.
+
+Collects per stage timers, call/muon/model counters and a histogram
+of the number of steps per track, exported as a dict or in the
+Prometheus text format. Estimators without instrumentation only pay
+for a None check per stage.
+"""
+import time
+from bisect import bisect_left
+import numpy as np
+
+class LLPInstrumentation():
+    """
+    Timers and counters filled by an estimator, see LLPEstimator.enable_instrumentation.
+    Stages are timed as laps: lap(stage) adds the time since the previous lap (or start)
+    to stage. Steps per track are counted in bins with upper edges steps_bins,
+    powers of two by default, plus one overflow bin.
+    """
+    def __init__(self, steps_bins: np.ndarray = None):
+        self.steps_bins = 2**np.arange(21) if steps_bins is None else np.asarray(steps_bins) # upper bin edges
+        self._steps_bins_list = self.steps_bins.tolist() # for single tracks without numpy overhead
+        self.reset()
+
+    def reset(self):
+        """ Sets all timers and counters to 0. """
+        self.stage_seconds     = {} # stage -> total seconds
+        self.stage_laps        = {} # stage -> number of laps
+        self.calls             = {} # estimator method -> number of calls
+        self.muons             = 0  # tracks evaluated
+        self.steps             = 0  # length steps evaluated
+        self.model_evaluations = 0  # tracks times models
+        self.steps_histogram   = np.zeros(len(self.steps_bins) + 1, dtype=np.int64) # last bin is overflow
+        self._last = time.perf_counter()
+
+    def start(self):
+        """ Starts timing, the next lap is measured from here. """
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str):
+        """
+        Adds the time since the last lap to stage.
+        :param stage: Name of the stage, e.g. decay_factor.
+        """
+        now = time.perf_counter()
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + (now - self._last)
+        self.stage_laps[stage] = self.stage_laps.get(stage, 0) + 1
+        self._last = now
+
+    def count(self, method: str, step_counts, n_models: int):
+        """
+        Counts one call of an estimator method.
+        :param method: Name of the method.
+        :param step_counts: Number of steps of each track, or of the single track.
+        :param n_models: Number of models evaluated per track.
+        """
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if np.ndim(step_counts) == 0:
+            # single track
+            self.muons += 1
+            self.steps += int(step_counts)
+            self.model_evaluations += n_models
+            self.steps_histogram[bisect_left(self._steps_bins_list, step_counts)] += 1
+            return
+        self.muons += len(step_counts)
+        self.steps += int(np.sum(step_counts))
+        self.model_evaluations += len(step_counts) * n_models
+        self.steps_histogram += np.bincount(np.searchsorted(self.steps_bins, step_counts),
+                                            minlength=len(self.steps_histogram))
+
+    def to_dict(self) -> dict:
+        """
+        All timers and counters.
+        :return dict: Plain python values, e.g. for json.
+        """
+        return {"stage_seconds": dict(self.stage_seconds),
+                "stage_laps": dict(self.stage_laps),
+                "calls": dict(self.calls),
+                "muons": self.muons,
+                "steps": self.steps,
+                "model_evaluations": self.model_evaluations,
+                "steps_bins": self.steps_bins.tolist(),
+                "steps_histogram": self.steps_histogram.tolist()}
+
+    def to_prometheus(self, prefix: str = "llpestimation") -> str:
+        """
+        Timers and counters in the Prometheus text exposition format.
+        :param prefix: Prefix of the metric names.
+        :return str: Metrics, one sample per line.
+        """
+        lines = ["# TYPE " + prefix + "_stage_seconds_total counter"]
+        lines += [prefix + '_stage_seconds_total{stage="' + stage + '"} ' + repr(seconds)
+                  for stage, seconds in self.stage_seconds.items()]
+        lines.append("# TYPE " + prefix + "_calls_total counter")
+        lines += [prefix + '_calls_total{method="' + method + '"} ' + str(calls)
+                  for method, calls in self.calls.items()]
+        for name in ("muons", "steps", "model_evaluations"):
+            lines.append("# TYPE " + prefix + "_" + name + "_total counter")
+            lines.append(prefix + "_" + name + "_total " + str(getattr(self, name)))
+        # cumulative buckets
+        lines.append("# TYPE " + prefix + "_steps_per_track histogram")
+        cumulative = np.cumsum(self.steps_histogram)
+        for edge, count in zip(self.steps_bins, cumulative):
+            lines.append(prefix + '_steps_per_track_bucket{le="' + str(edge) + '"} ' + str(count))
+        lines.append(prefix + '_steps_per_track_bucket{le="+Inf"} ' + str(cumulative[-1]))
+        lines.append(prefix + "_steps_per_track_sum " + str(self.steps))
+        lines.append(prefix + "_steps_per_track_count " + str(self.muons))
+        return "\n".join(lines) + "\n"
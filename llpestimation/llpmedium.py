@@ -1,3 +1,5 @@
+import numpy as np
+
 class LLPMedium():
     """
     Struct to hold number density of nuclei.
@@ -6,4 +8,45 @@ class LLPMedium():
         self.name           = name           # e.g. "O" or "H"
         self.number_density = number_density # nuclei per cm^3
         self.Z              = Z              # atomic number
-        self.A              = A              # mass number
\ No newline at end of file
+        self.A              = A              # mass number
+
+class LLPDensityProfile():
+    """
+    Mass density of the medium as a function of depth, relative to the density
+    the LLPMedium number densities are given at. All media scale together, so the
+    interactions per cm of a step at depth z are interactions_per_cm(E) * scale(z).
+    Depth in m, increasing downwards. Density is linearly interpolated between
+    the given depths and constant outside of them.
+    """
+    def __init__(self, depths: np.ndarray, densities: np.ndarray, reference_density: float):
+        self.depths            = np.asarray(depths, dtype=float)    # in m, ascending
+        self.densities         = np.asarray(densities, dtype=float) # in g/cm^3
+        self.reference_density = reference_density                  # density of the LLPMedium number densities
+
+        if self.depths.ndim != 1 or self.depths.shape != self.densities.shape or len(self.depths) == 0:
+            raise ValueError("Need one density per depth")
+        if np.any(np.diff(self.depths) <= 0):
+            raise ValueError("Depths must be strictly increasing")
+        if reference_density <= 0 or np.any(self.densities < 0):
+            raise ValueError("Densities must be positive")
+        self.scales = self.densities / reference_density # relative density at each depth
+
+    def scale(self, depth: np.ndarray) -> np.ndarray:
+        """
+        Density relative to the reference density.
+        :param depth: Depths in m.
+        :return np.ndarray: Relative density, same shape as depth.
+        """
+        return np.interp(depth, self.depths, self.scales)
+
+    def track_scale(self, length_list: np.ndarray, entry_depth, cos_zenith) -> np.ndarray:
+        """
+        Relative density at the steps of straight muon tracks, e.g. as density_scale
+        of LLPEstimator.calc_llp_probability.
+        :param length_list: Lengths along the track in m, or flat lengths of an LLPMuonBatch.
+        :param entry_depth: Depth of the track at length 0 in m, per step for a batch.
+        :param cos_zenith: Cosine of the zenith angle, 1 for a vertically downgoing muon. \
+            Per step for a batch.
+        :return np.ndarray: Relative density per step.
+        """
+        return self.scale(entry_depth + np.asarray(length_list, dtype=float)*cos_zenith)
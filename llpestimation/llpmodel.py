@@ -7,6 +7,65 @@ cross section.
 import numpy as np
 from .llpproductioncrosssection import LLPProductionCrossSection
 
+SPEED_OF_LIGHT = 29979245800.0 # cm/s
+
+def decay_factor_matrix(l1: float,
+                        l2: np.ndarray,
+                        energy: np.ndarray,
+                        c_tau_over_mass: np.ndarray,
+                        out: np.ndarray = None,
+                        work: np.ndarray = None,
+                        step_work: np.ndarray = None,
+                        step_mask: np.ndarray = None) -> np.ndarray:
+    """
+    LLPModel.decay_factor for many models and segments in one broadcast.
+
+    Uses exp(-l1/d) - exp(-l2/d) = -exp(-l1/d) * expm1(-(l2-l1)/d) with decay
+    length d = c*tau*E/m, which stays accurate when l2-l1 << d. Unphysical
+    segments are set to 0. Does not check for E < m, see LLPEstimator debug mode.
+    With all buffers given nothing is allocated: broadcasts between (models x segments)
+    and per segment arrays go through einsum/copyto, which unlike broadcasting
+    ufuncs do not allocate iteration buffers.
+
+    :param l1: Minimum length before decay in cm. Same as minimum detectable gap length.
+    :param l2: Maximum length before decay in cm, one per segment.
+    :param energy: Energy of the LLP in GeV, one per segment.
+    :param c_tau_over_mass: c*tau/m in cm/GeV with shape (models, 1). \
+        With float32 c_tau_over_mass and energy the result is float32.
+    :param out: Optional buffer with shape (models, segments) for the result.
+    :param work: Optional scratch buffer with the same shape as out.
+    :param step_work: Optional float scratch buffer with one entry per segment.
+    :param step_mask: Optional bool scratch buffer with one entry per segment.
+    :return np.ndarray: Decay factors with rows = models, cols = segments.
+    """
+    shape = (len(c_tau_over_mass), len(energy))
+    dtype = np.result_type(c_tau_over_mass, energy, np.float32) # float32 inputs compute in float32
+    out       = np.empty(shape, dtype=dtype) if out is None else out
+    work      = np.empty(shape, dtype=dtype) if work is None else work
+    step_work = np.empty(len(energy), dtype=dtype) if step_work is None else step_work
+    step_mask = np.empty(len(energy), dtype=bool) if step_mask is None else step_mask
+    # -1/d, infinite decay length where energy <= 0 gives decay factor 0
+    np.einsum("i,j->ij", c_tau_over_mass[:, 0], energy, out=work)
+    np.less_equal(energy, 0.0, out=step_mask)
+    np.copyto(work, np.inf, where=step_mask)
+    np.divide(-1.0, work, out=work)
+    # -expm1(-(l2-l1)/d), l2 < l1 is unphysical and clipped to avoid overflow
+    np.subtract(l2, l1, out=step_work)
+    np.maximum(step_work, 0.0, out=step_work)
+    np.einsum("ij,j->ij", work, step_work, out=out)
+    np.expm1(out, out=out)
+    np.negative(out, out=out)
+    # exp(-l1/d)
+    np.multiply(work, l1, out=work)
+    np.exp(work, out=work)
+    np.multiply(out, work, out=out)
+    # set unphysical events to 0, l2 <= 0 is included in l2 <= l1 for l1 >= 0
+    np.less_equal(l2, l1, out=step_mask)
+    np.copyto(out, 0.0, where=step_mask)
+    if np.any(l1 < 0):
+        out.fill(0.0)
+    return out
+
 class LLPModel():
     """
     LLP model parameters and production cross section function used in LLP estimation.
@@ -61,7 +120,7 @@ class LLPModel():
         :return float: Between 0-1. Fraction of the decay pdf within length l1 and l2.
         """
         # decay length
-        c_gamma_tau = 29979245800.0 * self.get_lifetime(energy/self.mass) # c [cm/s] * gamma * tau
+        c_gamma_tau = SPEED_OF_LIGHT * self.get_lifetime(energy/self.mass) # c [cm/s] * gamma * tau
         # integrate decay pdf from l1 to l2
         prob = np.exp(-l1/c_gamma_tau) - np.exp(-l2/c_gamma_tau)
         # check that we have physical lengths and energies
@@ -75,27 +134,34 @@ class LLPModel():
         return prob
 
     def get_unique_id(self) -> str:
-        # @TODO: how to include the cross section function?
         """
         Encodes the model in a underscore separated string.
         Used to reconstruct the LLPModel (except cross section function)."
         """
-        parameters_str = [self.name, str(self.mass), str(self.eps), str(self.tau)]
+        return self.make_unique_id(self.name, self.mass, self.eps, self.tau)
+
+    @staticmethod
+    def make_unique_id(name: str, mass: float, eps: float, tau: float) -> str:
+        """
+        Unique id of a model with the given parameters, without creating the model.
+        """
+        parameters_str = [name, str(mass), str(eps), str(tau)]
         unique_id = "_".join(parameters_str)
         return unique_id
 
     @classmethod
-    def from_unique_id(cls, unique_id: str):
-        # @TODO: how to id cross section function? leave out?
+    def from_unique_id(cls, unique_id: str, llp_xsec: LLPProductionCrossSection = None):
         """
         Returns a new LLPModel object from a unique id.
+        The id does not contain the cross section, pass it as llp_xsec or see
+        LLPModelSet.save for storing models together with their cross section.
         """
         parameters_str = unique_id.split("_")
         return cls(parameters_str[0],
                    float(parameters_str[1]),
                    float(parameters_str[2]),
                    float(parameters_str[3]),
-                   None)
+                   llp_xsec)
 
     def print_summary(self):
         """
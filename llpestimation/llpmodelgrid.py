@@ -0,0 +1,66 @@
+"""
+Class that represents LLP models on a (mass x coupling) grid.
+
+Production cross section scales as eps^2 and the lifetime as 1/eps^2,
+so the grid only needs the eps = 1 values per mass.
+"""
+import numpy as np
+from .llpmodel import LLPModel
+from .llpcrosssectiontable import LLPCrossSectionTable, LLPTabulatedCrossSection
+from .llpmodelset import LLPModelSet
+
+class LLPModelGrid():
+    """
+    Grid of LLPModels of one kind over masses and couplings eps.
+    Cross section per mass given by a row of an LLPCrossSectionTable at eps = 1,
+    lifetime per mass given at eps = 1. Models are ordered mass-major,
+    i.e. model i has mass index i // n_eps and eps index i % n_eps.
+    """
+    def __init__(self,
+                 name: str,
+                 masses: np.ndarray,
+                 epsilons: np.ndarray,
+                 taus_eps1: np.ndarray,
+                 table: LLPCrossSectionTable,
+                 rows: np.ndarray):
+        self.name      = name                                  # such as DarkLeptonicScalar, etc.
+        self.masses    = np.asarray(masses, dtype=float)       # in GeV
+        self.epsilons  = np.asarray(epsilons, dtype=float)     # couplings to SM
+        self.taus_eps1 = np.asarray(taus_eps1, dtype=float)    # lifetime in s at eps = 1, per mass
+        self.table     = table                                 # cross sections at eps = 1
+        self.rows      = np.asarray(rows, dtype=np.intp)       # table row per mass
+
+        if len(self.taus_eps1) != len(self.masses) or len(self.rows) != len(self.masses):
+            raise ValueError("Need one lifetime and one table row per mass")
+
+    @property
+    def shape(self) -> tuple:
+        """ (number of masses, number of couplings) """
+        return (len(self.masses), len(self.epsilons))
+
+    def __len__(self) -> int:
+        return len(self.masses) * len(self.epsilons)
+
+    def models(self) -> list:
+        """
+        LLPModels of all grid points, mass-major order.
+        :return list: LLPModels with lifetime tau_eps1/eps^2 and cross section scaled by eps^2.
+        """
+        return [LLPModel(self.name, mass, eps, tau_eps1 / eps**2,
+                         LLPTabulatedCrossSection(self.table, row, eps**2))
+                for mass, tau_eps1, row in zip(self.masses, self.taus_eps1, self.rows)
+                for eps in self.epsilons]
+
+    def model_set(self) -> LLPModelSet:
+        """
+        All grid points as an LLPModelSet, mass-major order, without creating LLPModels.
+        :return LLPModelSet: Same models as models().
+        """
+        eps_squared = np.tile(self.epsilons**2, len(self.masses))
+        return LLPModelSet(self.name,
+                           np.repeat(self.masses, len(self.epsilons)),
+                           np.tile(self.epsilons, len(self.masses)),
+                           np.repeat(self.taus_eps1, len(self.epsilons)) / eps_squared,
+                           self.table,
+                           np.repeat(self.rows, len(self.epsilons)),
+                           eps_squared)
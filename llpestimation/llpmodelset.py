@@ -0,0 +1,160 @@
+"""
+Columnar collection of LLP models sharing one cross section table.
+
+Stores the model parameters in numpy arrays instead of one LLPModel
+object per model, so large scans stay small in memory and can be
+indexed, sliced and saved without building the models.
+"""
+import numpy as np
+from .llpmodel import LLPModel
+from .llpcrosssectiontable import LLPCrossSectionTable, LLPTabulatedCrossSection
+
+class LLPModelSet():
+    """
+    Models with name, mass, eps, tau and a cross section given by a scaled row
+    of one LLPCrossSectionTable, one array entry per model.
+    Indexing with an int gives an LLPModel, indexing with a slice, bool mask or
+    index array gives a new LLPModelSet on the same table.
+    The unique id -> position index is built on the first lookup.
+    """
+    def __init__(self,
+                 names,
+                 masses: np.ndarray,
+                 epsilons: np.ndarray,
+                 taus: np.ndarray,
+                 table: LLPCrossSectionTable,
+                 rows: np.ndarray,
+                 scales: np.ndarray = None):
+        self.masses   = np.atleast_1d(np.asarray(masses, dtype=float))   # in GeV
+        self.epsilons = np.atleast_1d(np.asarray(epsilons, dtype=float)) # couplings to SM
+        self.taus     = np.atleast_1d(np.asarray(taus, dtype=float))     # lifetimes in s
+        self.table    = table                                            # shared cross section table
+        self.rows     = np.atleast_1d(np.asarray(rows, dtype=np.intp))   # table row per model
+        n_models = len(self.masses)
+        # factor multiplied to the table row per model, e.g. eps^2
+        self.scales = np.ones(n_models) if scales is None else np.atleast_1d(np.asarray(scales, dtype=float))
+        # such as DarkLeptonicScalar, one name for all models or one per model
+        self.names = np.full(n_models, names) if isinstance(names, str) else np.asarray(names, dtype=str)
+        self._index = None # unique id -> position, built on first lookup
+
+        if any(len(column) != n_models for column in (self.epsilons, self.taus, self.rows, self.scales, self.names)):
+            raise ValueError("Need the same number of names, masses, epsilons, taus, rows and scales")
+        if n_models and (np.min(self.rows) < 0 or np.max(self.rows) >= len(self.table)):
+            raise ValueError("Table rows out of range for a table with " + str(len(self.table)) + " rows")
+
+    @classmethod
+    def from_models(cls, llpmodels: list):
+        """
+        Collects LLPModels into a set. All models must use LLPTabulatedCrossSection
+        on the same LLPCrossSectionTable.
+        :param llpmodels: List of LLPModels.
+        :return LLPModelSet: Set with the models in the same order.
+        """
+        xsecs = [m.llp_xsec for m in llpmodels]
+        if len(xsecs) == 0 or not all(isinstance(x, LLPTabulatedCrossSection) for x in xsecs):
+            raise ValueError("LLPModelSet needs models with LLPTabulatedCrossSection")
+        table = xsecs[0].table
+        if any(x.table is not table for x in xsecs):
+            raise ValueError("LLPModelSet needs models on the same LLPCrossSectionTable")
+        return cls([m.name for m in llpmodels],
+                   [m.mass for m in llpmodels],
+                   [m.eps for m in llpmodels],
+                   [m.tau for m in llpmodels],
+                   table,
+                   [x.row for x in xsecs],
+                   [x.scale for x in xsecs])
+
+    def __len__(self) -> int:
+        return len(self.masses)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            i = int(key)
+            return LLPModel(str(self.names[i]), float(self.masses[i]), float(self.epsilons[i]), float(self.taus[i]),
+                            LLPTabulatedCrossSection(self.table, int(self.rows[i]), float(self.scales[i])))
+        return LLPModelSet(self.names[key], self.masses[key], self.epsilons[key], self.taus[key],
+                           self.table, self.rows[key], self.scales[key])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def unique_ids(self) -> list:
+        """ LLPModel unique ids, ordered with the models. """
+        return [LLPModel.make_unique_id(name, mass, eps, tau)
+                for name, mass, eps, tau in zip(self.names.tolist(), self.masses.tolist(),
+                                                self.epsilons.tolist(), self.taus.tolist())]
+
+    def index(self, unique_id: str) -> int:
+        """
+        Position of a model in the set.
+        :param unique_id: LLPModel unique id.
+        :return int: Index of the model.
+        """
+        if self._index is None:
+            self._index = {uid: i for i, uid in enumerate(self.unique_ids)}
+        if unique_id not in self._index:
+            raise KeyError("No model with unique id " + unique_id)
+        return self._index[unique_id]
+
+    def select(self, unique_ids: list):
+        """
+        Subset of the models with the given unique ids.
+        :param unique_ids: LLPModel unique ids, sets the order of the subset.
+        :return LLPModelSet: The selected models.
+        """
+        return self[np.array([self.index(uid) for uid in unique_ids], dtype=np.intp)]
+
+    def models(self) -> list:
+        """
+        LLPModel objects of all models in the set.
+        :return list: LLPModels with LLPTabulatedCrossSection on the shared table.
+        """
+        return list(self)
+
+    def stacked_table(self) -> LLPCrossSectionTable:
+        """
+        Table with one row per model and the model scales folded in, see LLPEstimator.
+        :return LLPCrossSectionTable: Stacked table ordered with the models.
+        """
+        return self.table.take(self.rows, self.scales)
+
+    def save(self, path: str):
+        """
+        Writes the model parameters into a .npz file. The cross section is stored
+        as a reference to the table: row key (or row) and scale per model, and
+        the checksum of the table source files.
+        :param path: File to write, should end with .npz.
+        """
+        row_keys = np.full(len(self), np.nan) if self.table.row_keys is None else self.table.row_keys[self.rows]
+        np.savez(path,
+                 names=self.names,
+                 masses=self.masses,
+                 epsilons=self.epsilons,
+                 taus=self.taus,
+                 rows=self.rows,
+                 row_keys=row_keys,
+                 scales=self.scales,
+                 checksum=np.array(self.table.checksum))
+
+    @classmethod
+    def load(cls, path: str, table: LLPCrossSectionTable):
+        """
+        Loads a set written with save onto a cross section table. Rows are found
+        by row key if the table has row keys, so the table may be ordered differently.
+        :param path: File written by save.
+        :param table: LLPCrossSectionTable the models refer to.
+        :return LLPModelSet: The models on table.
+        """
+        with np.load(path) as data:
+            checksum = str(data["checksum"])
+            if checksum and table.checksum and checksum != table.checksum:
+                raise ValueError("Model set " + str(path) + " was saved with different cross section tables")
+            row_keys = data["row_keys"]
+            if table.row_keys is not None and not np.any(np.isnan(row_keys)):
+                unique_keys, inverse = np.unique(row_keys, return_inverse=True)
+                rows = np.array([table.row_of(key) for key in unique_keys], dtype=np.intp)[inverse]
+            else:
+                rows = data["rows"]
+            return cls(data["names"], data["masses"], data["epsilons"], data["taus"],
+                       table, rows, data["scales"])
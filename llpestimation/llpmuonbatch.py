@@ -0,0 +1,99 @@
+"""
+Ragged batch of muon tracks used for vectorized LLP estimation.
+
+Stores many muons in flat length and energy arrays together with
+offsets marking where each muon starts and ends.
+"""
+import numpy as np
+
+class LLPMuonBatch():
+    """
+    Ragged batch of muon tracks.
+    Muon i is given by lengths[offsets[i]:offsets[i+1]] and the same slice of energies.
+    Input expected in meters and GeV, same as LLPEstimator.calc_llp_probability.
+    """
+    def __init__(self, lengths: np.ndarray, energies: np.ndarray, offsets: np.ndarray):
+        self.lengths  = np.asarray(lengths, dtype=float)   # flat lengths of all muons in m
+        self.energies = np.asarray(energies, dtype=float)  # flat energies of all muons in GeV
+        self.offsets  = np.asarray(offsets, dtype=np.intp) # n_muons + 1 indices into flat arrays
+
+        if self.lengths.ndim != 1 or self.energies.ndim != 1 or self.offsets.ndim != 1:
+            raise ValueError("lengths, energies and offsets must be one dimensional")
+        if len(self.lengths) != len(self.energies):
+            raise ValueError("lengths and energies must contain same number of elements")
+        if len(self.offsets) < 1 or self.offsets[0] != 0 or self.offsets[-1] != len(self.lengths):
+            raise ValueError("offsets must start at 0 and end at the total number of steps")
+        if np.any(np.diff(self.offsets) < 1):
+            raise ValueError("Every muon needs at least one length step.")
+
+    @classmethod
+    def from_tracks(cls, length_lists: list, energy_lists: list):
+        """
+        Creates a batch from per muon length and energy lists.
+        :param length_lists: List of length lists, one per muon, in m.
+        :param energy_lists: List of energy lists, one per muon, in GeV.
+        :return LLPMuonBatch: Ragged batch of all muons.
+        """
+        if len(length_lists) != len(energy_lists):
+            raise ValueError("length_lists and energy_lists \
+                             must contain same number of muons")
+        counts  = [len(lengths) for lengths in length_lists]
+        offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        if len(counts) == 0:
+            return cls(np.empty(0), np.empty(0), offsets)
+        return cls(np.concatenate(length_lists), np.concatenate(energy_lists), offsets)
+
+    @classmethod
+    def from_arrays(cls, lengths: np.ndarray, energies: np.ndarray):
+        """
+        Creates a batch from muons with the same number of steps.
+        :param lengths: Lengths in m with shape (n_muons, n_steps).
+        :param energies: Energies in GeV with shape (n_muons, n_steps).
+        :return LLPMuonBatch: Batch sharing memory with C contiguous inputs.
+        """
+        lengths = np.asarray(lengths, dtype=float)
+        energies = np.asarray(energies, dtype=float)
+        if lengths.ndim != 2 or lengths.shape != energies.shape:
+            raise ValueError("lengths and energies must have shape (n_muons, n_steps)")
+        n_muons, n_steps = lengths.shape
+        return cls(lengths.reshape(-1), energies.reshape(-1), np.arange(n_muons + 1, dtype=np.intp)*n_steps)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: slice):
+        """
+        Returns a new batch with a contiguous range of muons.
+        :param index: Slice with step 1 over the muons.
+        :return LLPMuonBatch: Batch sharing memory with this one.
+        """
+        if not isinstance(index, slice):
+            raise TypeError("LLPMuonBatch only supports slicing, use track(i) for a single muon")
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("LLPMuonBatch slices must be contiguous")
+        stop = max(start, stop)
+        first, last = self.offsets[start], self.offsets[stop]
+        return LLPMuonBatch(self.lengths[first:last],
+                            self.energies[first:last],
+                            self.offsets[start:stop + 1] - first)
+
+    @property
+    def n_steps(self) -> int:
+        """ Total number of length steps of all muons. """
+        return len(self.lengths)
+
+    @property
+    def step_counts(self) -> np.ndarray:
+        """ Number of length steps per muon. """
+        return np.diff(self.offsets)
+
+    def track(self, i: int) -> tuple:
+        """
+        Length and energy arrays of a single muon.
+        :param i: Index of the muon in the batch.
+        :return tuple: (lengths, energies) of muon i.
+        """
+        first, last = self.offsets[i], self.offsets[i + 1]
+        return self.lengths[first:last], self.energies[first:last]
@@ -0,0 +1,99 @@
+"""
+Vectorized generator of muon tracks for benchmarks and rate estimates.
+
+Energies at detector entry are sampled from a power law flux by inverse
+transform, track lengths uniformly, and energies along the tracks follow
+the closed form continuous loss of LLPEnergyLoss. No per muon Python loop.
+"""
+import numpy as np
+from .llpmuonbatch import LLPMuonBatch
+from .llpenergyloss import LLPEnergyLoss
+
+class LLPMuonGenerator():
+    """
+    Muons with entry energies following E^-gamma in energy_range (GeV) and track
+    lengths uniform in length_range (m). Muons that stop in the detector end at
+    their stopping point. Tracks are sampled from the flux, so every muon has
+    the same weight. Seeded with seed for reproducible samples.
+    """
+    def __init__(self,
+                 gamma: float = 3.7,
+                 energy_range: tuple = (100.0, 1e5),
+                 length_range: tuple = (100.0, 1000.0),
+                 energy_loss: LLPEnergyLoss = None,
+                 seed = None):
+        if not 0 < energy_range[0] < energy_range[1]:
+            raise ValueError("energy_range must be increasing and positive")
+        if not 0 < length_range[0] <= length_range[1]:
+            raise ValueError("length_range must be increasing and positive")
+        self.gamma        = gamma                                                  # spectral index of the flux
+        self.energy_range = energy_range                                           # entry energies in GeV
+        self.length_range = length_range                                           # track lengths in m
+        self.energy_loss  = LLPEnergyLoss() if energy_loss is None else energy_loss # loss along the tracks
+        self.rng          = np.random.default_rng(seed)
+
+    def sample_energies(self, n_muons: int) -> np.ndarray:
+        """
+        Entry energies from the power law by inverse transform sampling.
+        :param n_muons: Number of muons.
+        :return np.ndarray: Energies in GeV.
+        """
+        u = self.rng.random(n_muons)
+        low, high = self.energy_range
+        if self.gamma == 1:
+            return low*(high/low)**u
+        exponent = 1.0 - self.gamma
+        return (low**exponent + u*(high**exponent - low**exponent))**(1.0/exponent)
+
+    def sample_tracks(self, n_muons: int) -> tuple:
+        """
+        Entry energies and track lengths, cut at the range of the muon.
+        :param n_muons: Number of muons.
+        :return tuple: (energies in GeV, track lengths in m).
+        """
+        energies = self.sample_energies(n_muons)
+        track_lengths = self.rng.uniform(*self.length_range, n_muons)
+        return energies, np.minimum(track_lengths, self.energy_loss.range(energies))
+
+    def tracks(self, n_muons: int, n_steps: int) -> tuple:
+        """
+        Muons with n_steps equally spaced steps each, as 2D arrays.
+        :param n_muons: Number of muons.
+        :param n_steps: Steps per muon, both track ends included.
+        :return tuple: (lengths in m, energies in GeV), both with shape (n_muons, n_steps).
+        """
+        if n_steps < 2:
+            raise ValueError("Need at least 2 steps per muon")
+        energies, track_lengths = self.sample_tracks(n_muons)
+        lengths = track_lengths[:, None] * np.linspace(0.0, 1.0, n_steps)
+        return lengths, self.energy_loss.energy(energies[:, None], lengths)
+
+    def muon_batch(self, n_muons: int, step_length: float = None, n_steps: int = None) -> LLPMuonBatch:
+        """
+        Muons as an LLPMuonBatch, with steps of at most step_length (ragged)
+        or with n_steps steps per muon.
+        :param n_muons: Number of muons.
+        :param step_length: Longest step in m.
+        :param n_steps: Steps per muon, instead of step_length.
+        :return LLPMuonBatch: The muons.
+        """
+        if (step_length is None) == (n_steps is None):
+            raise ValueError("Give either step_length or n_steps")
+        if n_steps is not None:
+            return LLPMuonBatch.from_arrays(*self.tracks(n_muons, n_steps))
+        energies, track_lengths = self.sample_tracks(n_muons)
+        return self.energy_loss.muon_batch(energies, track_lengths, step_length)
+
+    def iter_batches(self, n_muons: int, batch_size: int, step_length: float = None, n_steps: int = None):
+        """
+        Generates n_muons in batches, so large samples never have to fit into memory.
+        :param n_muons: Total number of muons.
+        :param batch_size: Muons per batch.
+        :param step_length: Longest step in m, see muon_batch.
+        :param n_steps: Steps per muon, see muon_batch.
+        :return: Generator of LLPMuonBatch.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        for start in range(0, n_muons, batch_size):
+            yield self.muon_batch(min(batch_size, n_muons - start), step_length, n_steps)
@@ -0,0 +1,107 @@
+"""
+Parallel driver for LLPEstimator over large muon batches.
+
+Shards an LLPMuonBatch into fixed size chunks that are evaluated
+in a process pool. Every worker builds its own LLPEstimator once.
+"""
+import numpy as np
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from .llpmuonbatch import LLPMuonBatch
+from .llpaccumulator import LLPRateAccumulator
+
+# estimator of the current worker process, built once by _init_worker
+_worker_estimator = None
+
+def _init_worker(build_estimator: Callable, build_args: tuple):
+    global _worker_estimator
+    _worker_estimator = build_estimator(*build_args)
+
+def _calc_chunk(lengths: np.ndarray, energies: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    return _worker_estimator.calc_llp_probability_batch(LLPMuonBatch(lengths, energies, offsets))
+
+def _accumulate_chunk(lengths: np.ndarray, energies: np.ndarray, offsets: np.ndarray,
+                      weights: np.ndarray) -> LLPRateAccumulator:
+    return _worker_estimator.accumulate(LLPMuonBatch(lengths, energies, offsets), weights)
+
+class LLPParallelEstimator():
+    """
+    Computes detectable LLP probabilities for muon batches in a pool of worker processes.
+
+    Workers build their LLPEstimator from build_estimator(*build_args), so only this
+    picklable description is sent to the workers and not the models themselves.
+    Chunks are fixed by chunk_size and merged in input order, so results do not
+    depend on the number of workers.
+    Use as a context manager or call close() to shut down the workers.
+    """
+    def __init__(self,
+                 build_estimator: Callable,
+                 build_args: tuple = (),
+                 n_workers: int = None,
+                 chunk_size: int = 1000):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.build_estimator = build_estimator # module level function returning an LLPEstimator
+        self.build_args      = build_args      # picklable arguments for build_estimator
+        self.chunk_size      = chunk_size      # muons per task
+        self.executor = ProcessPoolExecutor(max_workers=n_workers,
+                                            initializer=_init_worker,
+                                            initargs=(build_estimator, build_args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Shuts down the worker processes. """
+        self.executor.shutdown()
+
+    def calc_llp_probability_batch(self, muons: LLPMuonBatch) -> np.ndarray:
+        """
+        Same as LLPEstimator.calc_llp_probability_batch, evaluated in the worker processes.
+        :param muons: LLPMuonBatch with lengths in m and energies in GeV.
+        :return np.ndarray: Detectable LLP probabilities with shape (n_muons, n_models).
+        """
+        chunks = [muons[start:start + self.chunk_size] for start in range(0, len(muons), self.chunk_size)]
+        results = self.executor.map(_calc_chunk,
+                                    [chunk.lengths for chunk in chunks],
+                                    [chunk.energies for chunk in chunks],
+                                    [chunk.offsets for chunk in chunks])
+        results = list(results) # ordered with chunks
+        if len(results) == 0:
+            # no muons, let a worker tell the number of models
+            return self.executor.submit(_calc_chunk, np.empty(0), np.empty(0), np.zeros(1, dtype=np.intp)).result()
+        return np.concatenate(results)
+
+    def accumulate(self,
+                   muons: LLPMuonBatch,
+                   weights: np.ndarray = None,
+                   accumulator: LLPRateAccumulator = None) -> LLPRateAccumulator:
+        """
+        Same as LLPEstimator.accumulate, evaluated in the worker processes.
+        Workers only send back one accumulator per chunk, merged in chunk order.
+        :param muons: LLPMuonBatch with lengths in m and energies in GeV.
+        :param weights: Flux weight per muon. Defaults to 1.
+        :param accumulator: LLPRateAccumulator to add to. A new one is created if not given.
+        :return LLPRateAccumulator: The accumulator with the batch added.
+        """
+        weights = np.ones(len(muons)) if weights is None else np.asarray(weights, dtype=float)
+        starts = range(0, len(muons), self.chunk_size)
+        chunks = [muons[start:start + self.chunk_size] for start in starts]
+        results = self.executor.map(_accumulate_chunk,
+                                    [chunk.lengths for chunk in chunks],
+                                    [chunk.energies for chunk in chunks],
+                                    [chunk.offsets for chunk in chunks],
+                                    [weights[start:start + self.chunk_size] for start in starts])
+        for chunk_accumulator in results:
+            if accumulator is None:
+                accumulator = chunk_accumulator
+            else:
+                accumulator.merge(chunk_accumulator)
+        if accumulator is None:
+            # no muons, let a worker create an empty accumulator for its models
+            accumulator = self.executor.submit(_accumulate_chunk, np.empty(0), np.empty(0),
+                                               np.zeros(1, dtype=np.intp), np.empty(0)).result()
+        return accumulator
@@ -2,6 +2,8 @@ class LLPProductionCrossSection():
     """
     Class that contains an ordered list of production cross sections
     and medium. Cross section takes GeV as input and outputs cm^2.
+    Every medium is interpolated separately, use LLPCrossSectionTable.tabulate
+    to combine the media of many models into one table.
     """
     def __init__(self, func_tot_xsec_list: list, medium_list: list):
         self.func_tot_xsec_list = func_tot_xsec_list # input GeV energy, returns cm^2
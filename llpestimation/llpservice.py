@@ -0,0 +1,353 @@
+"""
+Asyncio service that answers detectable LLP probability queries from a warm estimator.
+
+Clients send one JSON object per line over a Unix socket or localhost TCP:
+{"id": 1, "lengths": [...], "energies": [...]} is answered with
+{"id": 1, "probabilities": [...]} (or {"id": 1, "error": "..."}), and
+{"id": 2, "command": "stats"} with the service statistics.
+Queries arriving within max_delay seconds of each other are evaluated
+together as one LLPMuonBatch. Lines may be up to line_limit bytes long, longer
+queries are answered with an error (with the id if it is the first key).
+"""
+import asyncio
+import json
+import re
+import time
+from collections import deque
+import numpy as np
+from .llpmuonbatch import LLPMuonBatch
+
+DEFAULT_LINE_LIMIT = 2**24 # bytes per JSON line, a 100000 step track takes about 4 MB
+_LEADING_ID = re.compile(rb'\s*\{\s*"id"\s*:\s*(-?\d+)')
+
+class LLPService():
+    """
+    Holds one estimator and coalesces concurrent queries into micro-batches.
+    A batch is evaluated once max_batch_size queries are waiting or max_delay seconds
+    after its first query arrived, in a worker thread so the event loop keeps
+    accepting queries. estimator is an LLPEstimator or anything with
+    calc_llp_probability_batch, such as LLPParallelEstimator.
+    """
+    def __init__(self, estimator, max_batch_size: int = 256, max_delay: float = 0.002,
+                 n_latencies: int = 10000, line_limit: int = DEFAULT_LINE_LIMIT):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.estimator      = estimator      # computes probabilities for an LLPMuonBatch
+        self.max_batch_size = max_batch_size # largest number of queries per batch
+        self.max_delay      = max_delay      # seconds the first query of a batch waits for more
+        self.line_limit     = line_limit     # longest accepted query line in bytes
+        self.model_ids      = getattr(estimator, "llpmodel_unique_ids", None)
+        self.servers        = []             # asyncio servers started by start_unix/start_tcp
+
+        # statistics
+        self.n_queries   = 0                          # answered queries
+        self.n_errors    = 0                          # queries answered with an error
+        self.n_batches   = 0                          # evaluated batches
+        self.latencies   = deque(maxlen=n_latencies)  # seconds from arrival to answer, most recent
+        self.start_time  = time.perf_counter()
+
+        self._queue = None   # (lengths, energies, future, arrival time), created in the running loop
+        self._batcher = None # task running _run_batches
+        self._running = []   # queries of the batch evaluated in the executor
+
+    async def start_unix(self, path: str):
+        """
+        Listens on a Unix socket.
+        :param path: Path of the socket file.
+        """
+        self._start_batcher()
+        self.servers.append(await asyncio.start_unix_server(self._handle_connection, path,
+                                                                 limit=self.line_limit))
+
+    async def start_tcp(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Listens on a TCP port.
+        :param host: Address to bind, localhost by default.
+        :param port: Port to bind, 0 picks a free port.
+        :return int: The bound port.
+        """
+        self._start_batcher()
+        server = await asyncio.start_server(self._handle_connection, host, port, limit=self.line_limit)
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        """ Serves until cancelled. """
+        await asyncio.gather(*(server.serve_forever() for server in self.servers))
+
+    async def close(self):
+        """ Stops listening and cancels the batcher, waiting and running queries get an error. """
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+        waiting = [query[2] for query in self._running]
+        self._running = []
+        while self._queue is not None and not self._queue.empty():
+            waiting.append(self._queue.get_nowait()[2])
+        for future in waiting:
+            if not future.done():
+                future.set_exception(RuntimeError("LLPService closed"))
+
+    async def query(self, lengths, energies) -> np.ndarray:
+        """
+        Probabilities of one muon, evaluated in the next batch.
+        :param lengths: Lengths from 0 to end of detector in m.
+        :param energies: Energies of the muon in GeV, ordered with lengths.
+        :return np.ndarray: Detectable LLP probability per model.
+        """
+        lengths  = np.asarray(lengths, dtype=float)
+        energies = np.asarray(energies, dtype=float)
+        if lengths.ndim != 1 or lengths.shape != energies.shape or len(lengths) == 0:
+            raise ValueError("lengths and energies must be one dimensional with the same number of elements")
+        self._start_batcher()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((lengths, energies, future, time.perf_counter()))
+        return await future
+
+    def stats(self) -> dict:
+        """
+        Throughput and latency of the answered queries.
+        :return dict: Counters, queries per second since start, mean batch size and \
+            latency percentiles in seconds over the most recent queries.
+        """
+        elapsed = time.perf_counter() - self.start_time
+        latencies = np.array(self.latencies)
+        percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) else [np.nan]*3
+        return {"n_queries": self.n_queries,
+                "n_errors": self.n_errors,
+                "n_batches": self.n_batches,
+                "mean_batch_size": self.n_queries / self.n_batches if self.n_batches else 0.0,
+                "queries_per_second": self.n_queries / elapsed if elapsed > 0 else 0.0,
+                "latency_p50": float(percentiles[0]),
+                "latency_p90": float(percentiles[1]),
+                "latency_p99": float(percentiles[2])}
+
+    def _start_batcher(self):
+        if self._batcher is None:
+            self._queue = asyncio.Queue()
+            self._batcher = asyncio.get_running_loop().create_task(self._run_batches())
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # wait for a first query, then collect more until the batch is full or the window closes
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._running = batch
+            results = await loop.run_in_executor(None, self._evaluate, batch)
+            self._running = []
+            self.n_batches += 1
+            now = time.perf_counter()
+            for (_, _, future, arrival), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    self.n_errors += 1
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                self.n_queries += 1
+                self.latencies.append(now - arrival)
+
+    def _evaluate(self, batch: list) -> list:
+        """
+        Probabilities of all queries in a batch. If the batch fails, the queries are
+        evaluated one by one so only the bad ones get the error.
+        """
+        try:
+            muons = LLPMuonBatch.from_tracks([q[0] for q in batch], [q[1] for q in batch])
+            return list(self.estimator.calc_llp_probability_batch(muons))
+        except Exception:
+            return [self._evaluate_single(q) for q in batch]
+
+    def _evaluate_single(self, query: tuple):
+        try:
+            muons = LLPMuonBatch.from_tracks([query[0]], [query[1]])
+            return self.estimator.calc_llp_probability_batch(muons)[0]
+        except Exception as e:
+            return e
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # every line is answered in its own task, so queries of one connection share batches
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    line = e.partial # last line without newline, empty at the end
+                except asyncio.LimitOverrunError as e:
+                    # unlike readline, readuntil leaves the long line in the buffer to be skipped
+                    line = await self._skip_line(reader, e.consumed)
+                if not line:
+                    break
+                task = asyncio.create_task(self._answer(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def _skip_line(self, reader: asyncio.StreamReader, consumed: int) -> dict:
+        """
+        Drops a line longer than line_limit from the stream.
+        :return dict: Error for _answer, with the id if the line starts with it.
+        """
+        head = await reader.readexactly(consumed)
+        while True:
+            try:
+                await reader.readuntil(b"\n")
+                break
+            except asyncio.IncompleteReadError:
+                break
+            except asyncio.LimitOverrunError as e:
+                await reader.readexactly(e.consumed)
+        match = _LEADING_ID.match(head)
+        return {"id": int(match.group(1)) if match else None,
+                "error": "query longer than the line limit of " + str(self.line_limit) + " bytes"}
+
+    async def _answer(self, line, writer: asyncio.StreamWriter, lock: asyncio.Lock):
+        request_id = None
+        try:
+            if isinstance(line, dict):
+                response = line # error of a line longer than line_limit, see _skip_line
+            else:
+                request = json.loads(line)
+                request_id = request.get("id")
+                if request.get("command") == "stats":
+                    response = {"id": request_id, "stats": self.stats(), "model_ids": self.model_ids}
+                else:
+                    probabilities = await self.query(request["lengths"], request["energies"])
+                    response = {"id": request_id, "probabilities": probabilities.tolist()}
+        except Exception as e:
+            response = {"id": request_id, "error": repr(e)}
+        async with lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+class LLPServiceClient():
+    """
+    Client of an LLPService connection. Queries can be sent concurrently from many
+    tasks over one connection, answers are matched to queries by id.
+    Queries longer than the line_limit of the service are answered with an error.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader   = reader
+        self.writer   = writer
+        self._next_id = 0
+        self._pending = {} # request id -> future of the answer
+        self._receiver = asyncio.get_running_loop().create_task(self._receive())
+
+    @classmethod
+    async def connect_unix(cls, path: str, limit: int = DEFAULT_LINE_LIMIT):
+        """ Connects to an LLPService listening on a Unix socket, answers may be up to limit bytes. """
+        return cls(*await asyncio.open_unix_connection(path, limit=limit))
+
+    @classmethod
+    async def connect_tcp(cls, host: str = "127.0.0.1", port: int = 0, limit: int = DEFAULT_LINE_LIMIT):
+        """ Connects to an LLPService listening on a TCP port, answers may be up to limit bytes. """
+        return cls(*await asyncio.open_connection(host, port, limit=limit))
+
+    async def query(self, lengths, energies) -> np.ndarray:
+        """
+        Probabilities of one muon.
+        :param lengths: Lengths from 0 to end of detector in m.
+        :param energies: Energies of the muon in GeV, ordered with lengths.
+        :return np.ndarray: Detectable LLP probability per model.
+        """
+        response = await self._request({"lengths": np.asarray(lengths, dtype=float).tolist(),
+                                        "energies": np.asarray(energies, dtype=float).tolist()})
+        return np.array(response["probabilities"])
+
+    async def stats(self) -> dict:
+        """ Statistics of the service, see LLPService.stats. """
+        return (await self._request({"command": "stats"}))["stats"]
+
+    async def close(self):
+        """ Closes the connection. """
+        self.writer.close()
+        await self.writer.wait_closed()
+        self._receiver.cancel()
+        try:
+            await self._receiver
+        except asyncio.CancelledError:
+            pass
+
+    async def _request(self, request: dict) -> dict:
+        request_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        # id first, so the service can answer queries that are too long to parse
+        self.writer.write((json.dumps({"id": request_id, **request}) + "\n").encode())
+        await self.writer.drain()
+        response = await future
+        if "error" in response:
+            raise ValueError("LLPService error: " + response["error"])
+        return response
+
+    async def _receive(self):
+        try:
+            while line := await self.reader.readline():
+                response = json.loads(line)
+                future = self._pending.pop(response["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            self._fail_pending()
+
+    def _fail_pending(self):
+        # connection closed or unreadable, fail what is still waiting
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("LLPService connection closed"))
+        self._pending.clear()
+
+async def generate_load(client: LLPServiceClient, muons: LLPMuonBatch, n_queries: int,
+                        concurrency: int = 64) -> dict:
+    """
+    Load generator: sends n_queries queries, cycling through muons, with up to
+    concurrency queries in flight.
+    :param client: Connected LLPServiceClient.
+    :param muons: LLPMuonBatch to draw the queries from.
+    :param n_queries: Total number of queries.
+    :param concurrency: Number of queries in flight at a time.
+    :return dict: Queries per second and client side latency percentiles in seconds.
+    """
+    latencies = []
+    next_query = iter(range(n_queries))
+
+    async def worker():
+        for i in next_query:
+            lengths, energies = muons.track(i % len(muons))
+            start = time.perf_counter()
+            await client.query(lengths, energies)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    percentiles = np.percentile(latencies, [50, 90, 99]) if latencies else [np.nan]*3
+    return {"n_queries": len(latencies),
+            "queries_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+            "latency_p50": float(percentiles[0]),
+            "latency_p90": float(percentiles[1]),
+            "latency_p99": float(percentiles[2])}
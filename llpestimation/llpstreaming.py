@@ -0,0 +1,232 @@
+"""
+Streaming pipeline that runs an LLPEstimator over muon files chunk by chunk.
+
+Muon files store ragged tracks as flat lengths [m], energies [GeV] and
+offsets, like LLPMuonBatch. Supported are .npz (streamed without loading
+whole arrays), .h5/.hdf5 (needs h5py) and .parquet (needs pyarrow, one
+muon per row with list columns lengths and energies).
+Results are written incrementally into a .npy file with a progress file
+next to it, so an interrupted run continues from the last finished chunk.
+"""
+import json
+import os
+import zipfile
+import numpy as np
+from .llpmuonbatch import LLPMuonBatch
+
+MAX_CHUNK_SIZE      = 10000 # muons per chunk, bounds the memory of the muon data
+DEFAULT_CHUNK_BYTES = 2**27 # bytes of the (muons x models) probabilities of a chunk
+
+def default_chunk_size(n_models: int, max_chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> int:
+    """
+    Muons per chunk whose float64 probabilities take at most max_chunk_bytes,
+    up to MAX_CHUNK_SIZE. The estimator tiles the steps of a chunk itself
+    (LLPEstimator max_block_bytes), so the probabilities are what grows with the chunk.
+    :param n_models: Number of models, None if not known.
+    :param max_chunk_bytes: Memory budget of the probabilities of a chunk.
+    :return int: Chunk size, at least 1.
+    """
+    if not n_models:
+        return MAX_CHUNK_SIZE
+    return int(min(MAX_CHUNK_SIZE, max(1, max_chunk_bytes // (8*n_models))))
+
+class _NpyStream():
+    """
+    Sequential reader of a one dimensional .npy array from an open binary file.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        version = np.lib.format.read_magic(fileobj)
+        if version == (1, 0):
+            shape, fortran_order, self.dtype = np.lib.format.read_array_header_1_0(fileobj)
+        else:
+            shape, fortran_order, self.dtype = np.lib.format.read_array_header_2_0(fileobj)
+        if len(shape) != 1:
+            raise ValueError("Muon file arrays must be one dimensional")
+        self.size = shape[0]
+
+    def read(self, n: int) -> np.ndarray:
+        """ Next n elements of the array. """
+        data = self.fileobj.read(n*self.dtype.itemsize)
+        if len(data) != n*self.dtype.itemsize:
+            raise ValueError("Unexpected end of muon file")
+        return np.frombuffer(data, dtype=self.dtype)
+
+    def skip(self, n: int, block: int = 1 << 20):
+        """ Skips n elements, reading at most block elements at a time. """
+        while n > 0:
+            self.read(min(n, block))
+            n -= block
+
+def count_muons(path: str) -> int:
+    """
+    Number of muons in a muon file.
+    :param path: Path to .npz, .h5/.hdf5 or .parquet muon file.
+    :return int: Number of muons.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        with zipfile.ZipFile(path) as zf, zf.open("offsets.npy") as f:
+            return _NpyStream(f).size - 1
+    if ext in (".h5", ".hdf5"):
+        import h5py
+        with h5py.File(path, "r") as f:
+            return len(f["offsets"]) - 1
+    if ext == ".parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    raise ValueError("Unknown muon file format " + ext)
+
+def iter_muon_chunks(path: str, chunk_size: int, start: int = 0):
+    """
+    Reads a muon file in chunks of chunk_size muons.
+    Only one chunk is held in memory at a time.
+    :param path: Path to .npz, .h5/.hdf5 or .parquet muon file.
+    :param chunk_size: Number of muons per chunk.
+    :param start: Index of the first muon to read.
+    :return: Generator of (index of first muon, LLPMuonBatch).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        yield from _iter_npz(path, chunk_size, start)
+    elif ext in (".h5", ".hdf5"):
+        yield from _iter_hdf5(path, chunk_size, start)
+    elif ext == ".parquet":
+        yield from _iter_parquet(path, chunk_size, start)
+    else:
+        raise ValueError("Unknown muon file format " + ext)
+
+def _iter_npz(path: str, chunk_size: int, start: int):
+    with zipfile.ZipFile(path) as zf, \
+         zf.open("offsets.npy") as f_offsets, \
+         zf.open("lengths.npy") as f_lengths, \
+         zf.open("energies.npy") as f_energies:
+        offsets  = _NpyStream(f_offsets)
+        lengths  = _NpyStream(f_lengths)
+        energies = _NpyStream(f_energies)
+        n_muons  = offsets.size - 1
+        # skip already processed muons
+        first = int(offsets.read(1)[0])
+        if start > 0:
+            offsets.skip(start - 1)
+            last = int(offsets.read(1)[0])
+            lengths.skip(last - first)
+            energies.skip(last - first)
+            first = last
+        for chunk_start in range(start, n_muons, chunk_size):
+            chunk_offsets = offsets.read(min(chunk_size, n_muons - chunk_start)).astype(np.intp)
+            n_steps = int(chunk_offsets[-1]) - first
+            muons = LLPMuonBatch(lengths.read(n_steps),
+                                 energies.read(n_steps),
+                                 np.concatenate([[0], chunk_offsets - first]))
+            first = int(chunk_offsets[-1])
+            yield chunk_start, muons
+
+def _iter_hdf5(path: str, chunk_size: int, start: int):
+    import h5py
+    with h5py.File(path, "r") as f:
+        n_muons = len(f["offsets"]) - 1
+        for chunk_start in range(start, n_muons, chunk_size):
+            chunk_offsets = f["offsets"][chunk_start:min(chunk_start + chunk_size, n_muons) + 1].astype(np.intp)
+            first, last = chunk_offsets[0], chunk_offsets[-1]
+            yield chunk_start, LLPMuonBatch(f["lengths"][first:last],
+                                            f["energies"][first:last],
+                                            chunk_offsets - first)
+
+def _iter_parquet(path: str, chunk_size: int, start: int):
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(path)
+    # skip whole row groups before start using the file metadata, without reading them
+    metadata = parquet_file.metadata
+    group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    group_starts = np.cumsum([0] + group_rows)
+    first_group = int(np.searchsorted(group_starts, start, side="right")) - 1
+    if first_group >= len(group_rows):
+        return
+    chunk_start = int(group_starts[first_group])
+    for record_batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                                  row_groups=range(first_group, len(group_rows)),
+                                                  columns=["lengths", "energies"]):
+        n = record_batch.num_rows
+        if chunk_start + n > start:
+            lengths  = record_batch.column("lengths")
+            energies = record_batch.column("energies")
+            skip = max(start - chunk_start, 0)
+            offsets  = lengths.offsets.to_numpy()
+            muons = LLPMuonBatch(lengths.flatten().to_numpy(),
+                                 energies.flatten().to_numpy(),
+                                 offsets - offsets[0])[skip:]
+            yield chunk_start + skip, muons
+        chunk_start += n
+
+class LLPStreamingPipeline():
+    """
+    Runs an estimator over a muon file chunk by chunk and writes the probabilities
+    into an (n_muons x n_models) .npy file as it goes. Memory use is set by chunk_size,
+    not by the size of the input. Without chunk_size, it is derived from the number of
+    models with default_chunk_size. Progress is stored in output_path + ".progress.json"
+    after every chunk, and run continues from there if resume is True.
+    estimator can be an LLPEstimator or anything with calc_llp_probability_batch,
+    such as LLPParallelEstimator.
+    """
+    def __init__(self, estimator, chunk_size: int = None):
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.estimator  = estimator  # computes probabilities for an LLPMuonBatch
+        self.chunk_size = chunk_size # muons read and evaluated at a time, None for default_chunk_size
+
+    def run(self, input_path: str, output_path: str, resume: bool = True) -> int:
+        """
+        Computes probabilities for all muons in input_path.
+        :param input_path: Muon file, see iter_muon_chunks.
+        :param output_path: .npy file for the probabilities, rows = muons, cols = models.
+        :param resume: Continue an earlier run of the same input instead of starting over.
+        :return int: Number of muons computed in this run.
+        """
+        n_muons = count_muons(input_path)
+        progress_path = output_path + ".progress.json"
+        progress = {"input": os.path.abspath(input_path),
+                    "n_muons": n_muons,
+                    "model_ids": getattr(self.estimator, "llpmodel_unique_ids", None),
+                    "n_done": 0}
+        output = None
+        if resume and os.path.exists(progress_path) and os.path.exists(output_path):
+            with open(progress_path) as f:
+                previous = json.load(f)
+            if all(previous[key] == progress[key] for key in ("input", "n_muons", "model_ids")):
+                progress["n_done"] = previous["n_done"]
+                output = np.lib.format.open_memmap(output_path, mode="r+")
+        if output is None and os.path.exists(progress_path):
+            # starting over, the old progress must not vouch for the new output
+            os.remove(progress_path)
+
+        n_computed = 0
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            model_ids = progress["model_ids"]
+            chunk_size = default_chunk_size(len(model_ids) if model_ids is not None else None)
+        for chunk_start, muons in iter_muon_chunks(input_path, chunk_size, progress["n_done"]):
+            probabilities = self.estimator.calc_llp_probability_batch(muons)
+            if output is None:
+                output = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float64,
+                                                   shape=(n_muons, probabilities.shape[1]))
+            output[chunk_start:chunk_start + len(muons)] = probabilities
+            output.flush()
+            # only mark the chunk as done once its results are on disk
+            progress["n_done"] = chunk_start + len(muons)
+            self._write_progress(progress_path, progress)
+            n_computed += len(muons)
+
+        if output is None:
+            # no muons, replace any output of an earlier run
+            n_models = len(progress["model_ids"]) if progress["model_ids"] is not None else 0
+            np.save(output_path, np.zeros((n_muons, n_models)))
+            self._write_progress(progress_path, progress)
+        return n_computed
+
+    @staticmethod
+    def _write_progress(progress_path: str, progress: dict):
+        tmp_path = progress_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, progress_path)
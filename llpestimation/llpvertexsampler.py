@@ -0,0 +1,136 @@
+"""
+Sampling of production and decay vertices of detectable LLP events
+for signal Monte Carlo.
+
+The terms of the thin target sum in LLPEstimator.calc_llp_probability_batch
+are the probabilities to produce a detectable LLP at each step of the muons.
+Normalized per model they are the distribution of production vertices, which
+is sampled by inverse transform over the cumulative sum of all steps of the
+batch. The decay gap follows the exponential decay pdf truncated to the
+detectable range [min_gap, l2] of the production step and is sampled by
+inverse transform as well. Every event is accepted, no rejection loop.
+"""
+import numpy as np
+from .llpmuonbatch import LLPMuonBatch
+from .llpestimator import LLPEstimator
+
+class LLPSignalEvents():
+    """
+    Detectable LLP events of a batch of muons, n_events per model.
+    Arrays have shape (n_models, n_events) with rows ordered like the models of the estimator.
+    Models without detectable events have muon -1, nan vertices and weight 0.
+    """
+    def __init__(self,
+                 unique_ids: list,
+                 muon: np.ndarray,
+                 production: np.ndarray,
+                 decay: np.ndarray,
+                 energy: np.ndarray,
+                 weight: np.ndarray):
+        self.unique_ids = unique_ids # LLPModel unique_id of each row
+        self.muon       = muon       # index of the muon in the batch
+        self.production = production # production vertex, length from the start of the muon track in m
+        self.decay      = decay      # decay vertex, length from the start of the muon track in m
+        self.energy     = energy     # muon energy at the production vertex in GeV
+        self.weight     = weight     # weighted detectable probability per event, sums to rates over events
+
+    @property
+    def gap(self) -> np.ndarray:
+        """ Distance between production and decay vertex in m. """
+        return self.decay - self.production
+
+    @property
+    def rates(self) -> np.ndarray:
+        """ Sum of the muon weighted detectable LLP probabilities of the batch per model. """
+        return self.weight.sum(axis=1)
+
+class LLPVertexSampler():
+    """
+    Samples detectable LLP events for all models of an LLPEstimator.
+    Muons are chosen with probability proportional to their (optionally flux weighted)
+    detectable LLP probability, so every event of a model has the same weight.
+    Production vertices are at the length steps of the muons, like in the thin target sum.
+    Seeded with seed for reproducible samples.
+    The step distribution is a cumulative sum over all models and steps of the batch,
+    which resolves steps contributing down to about n_models*1e-16 of the model rate.
+    """
+    def __init__(self, estimator: LLPEstimator, seed = None):
+        self.estimator = estimator                   # integrand and models to sample
+        self.rng       = np.random.default_rng(seed)
+
+    def sample(self,
+               muons: LLPMuonBatch,
+               n_events: int,
+               muon_weights: np.ndarray = None,
+               density_scale: np.ndarray = None) -> LLPSignalEvents:
+        """
+        Samples n_events detectable LLP events per model from a batch of muons.
+        :param muons: LLPMuonBatch with lengths in m and energies in GeV, \
+            trimmed like in LLPEstimator.calc_llp_probability.
+        :param n_events: Events per model.
+        :param muon_weights: Optional non-negative weight per muon, e.g. a flux weight. Defaults to 1.
+        :param density_scale: Optional relative density at each step of the flat muons.lengths.
+        :return LLPSignalEvents: Events with weights summing to the weighted detectable \
+            LLP probability of the batch for each model.
+        """
+        if n_events < 1:
+            raise ValueError("n_events must be at least 1")
+        if muon_weights is not None:
+            muon_weights = np.asarray(muon_weights, dtype=float)
+            if muon_weights.shape != (len(muons),):
+                raise ValueError("Need one weight per muon")
+            if np.any(muon_weights < 0):
+                raise ValueError("Muon weights must not be negative")
+        estimator = self.estimator
+        n_models = len(estimator.llpmodel_unique_ids)
+        n_steps = muons.n_steps
+        if len(muons) == 0:
+            shape = (n_models, n_events)
+            return LLPSignalEvents(list(estimator.llpmodel_unique_ids), np.full(shape, -1),
+                                   np.full(shape, np.nan), np.full(shape, np.nan),
+                                   np.full(shape, np.nan), np.zeros(shape))
+
+        # probability to produce a detectable LLP at each step, rows = models, cols = steps
+        integrand = estimator.calc_llp_integrand_batch(muons, density_scale).astype(np.float64)
+        if muon_weights is not None:
+            integrand *= np.repeat(muon_weights, muons.step_counts)
+        rates = integrand.sum(axis=1)
+        # normalized per model, so the flat cumulative sum rises by 1 per model with events
+        with np.errstate(divide="ignore", invalid="ignore"):
+            integrand /= rates[:, None]
+        integrand[~(rates > 0)] = 0.0
+        cdf = np.zeros(n_models*n_steps + 1)
+        cdf[1:] = np.cumsum(integrand.reshape(-1))
+
+        # production steps by inverse transform, flat index into models x steps
+        first = np.arange(n_models)*n_steps
+        low = cdf[first]
+        high = cdf[first + n_steps]
+        target = low[:, None] + self.rng.random((n_models, n_events))*(high - low)[:, None]
+        # rounding must not move the target past the last step of the model
+        np.minimum(target, np.nextafter(high, -np.inf)[:, None], out=target)
+        step = np.searchsorted(cdf, target, side="right") - 1 - first[:, None]
+        np.clip(step, 0, n_steps - 1, out=step)
+
+        # decay gap from the decay pdf truncated to [min_gap, l2]
+        ends = muons.offsets[1:]
+        muon = np.searchsorted(ends, step, side="right")
+        production = muons.lengths[step]*100.0 # in cm
+        energy = muons.energies[step]
+        span = muons.lengths[ends - 1][muon]*100.0 - production - 2*estimator.min_gap # l2 - l1
+        decay_length = estimator.c_tau_over_mass.astype(np.float64)*energy # c*tau*E/m in cm
+        with np.errstate(over="ignore", invalid="ignore"):
+            # l1 - d log(1 - u (1 - exp(-(l2-l1)/d))), uniform in [l1, l2] for d >> l2 - l1
+            gap = estimator.min_gap - decay_length*np.log1p(self.rng.random(step.shape)*np.expm1(-span/decay_length))
+
+        empty = ~(rates > 0)
+        muon[empty] = -1
+        production[empty] = np.nan
+        gap[empty] = np.nan
+        energy[empty] = np.nan
+        return LLPSignalEvents(list(estimator.llpmodel_unique_ids),
+                               muon,
+                               production/100.0,
+                               (production + gap)/100.0,
+                               energy,
+                               np.repeat(rates[:, None]/n_events, n_events, axis=1))
@@ -0,0 +1,70 @@
+"""
+Preallocated scratch buffers for the LLPEstimator hot path.
+
+Sized once for a maximum number of length steps, so repeated
+probability calculations do not allocate new arrays.
+"""
+import numpy as np
+
+class LLPWorkspace():
+    """
+    Scratch buffers for n_models models and up to max_steps length steps.
+    Call steps(n) before a calculation to get views sized for n steps.
+    The (models x steps) views are contiguous, so no operation has to copy them.
+    energy_grid is the grid of the LLPCrossSectionTable the workspace is used with.
+    Floating point buffers are of type dtype, except the per step lengths, l2 and step
+    lengths, which stay float64 so differences of long track lengths keep their precision.
+    """
+    def __init__(self, n_models: int, max_steps: int, energy_grid: np.ndarray, dtype = np.float64):
+        if max_steps < 1:
+            raise ValueError("max_steps must be at least 1")
+        if len(energy_grid) > 255:
+            raise ValueError("Workspace supports energy grids with at most 255 points")
+        self.n_models  = n_models  # rows of the matrix buffers
+        self.max_steps = max_steps # largest number of steps a view can have
+        self.n         = 0         # number of steps of the current views
+        self.dtype     = np.dtype(dtype) # of the floating point buffers
+        n_energies     = len(energy_grid)
+
+        # per step buffers
+        self._lengths    = np.empty(max_steps, dtype=np.float64)
+        self._l2         = np.empty(max_steps, dtype=np.float64)
+        self._delta_L    = np.empty(max_steps, dtype=np.float64)
+        self._step_work  = np.empty(max_steps, dtype=dtype)
+        self._step_mask  = np.empty(max_steps, dtype=bool)
+        self._step_index = np.empty(max_steps, dtype=np.intp)
+        self._grid_count = np.empty(max_steps, dtype=np.uint8)
+        # steps x energy grid buffers for the cross section table lookup
+        self._n_energies = n_energies
+        self._energies   = np.empty(max_steps*n_energies, dtype=dtype)
+        self._grid       = np.tile(np.asarray(energy_grid, dtype=dtype), max_steps)
+        self._compare    = np.empty(max_steps*n_energies, dtype=bool)
+        # models x steps buffers
+        self._matrix = np.empty(n_models*max_steps, dtype=dtype)
+        self._decay  = np.empty(n_models*max_steps, dtype=dtype)
+        self._work   = np.empty(n_models*max_steps, dtype=dtype)
+
+    def steps(self, n: int):
+        """
+        Sets the buffer views to n steps.
+        :param n: Number of length steps of the next calculation.
+        :return LLPWorkspace: self, with views of length n.
+        """
+        if n > self.max_steps:
+            raise ValueError("Track has " + str(n) + " steps, workspace only fits " + str(self.max_steps))
+        if n != self.n:
+            self.n          = n
+            self.lengths    = self._lengths[:n]
+            self.l2         = self._l2[:n]
+            self.delta_L    = self._delta_L[:n]
+            self.step_work  = self._step_work[:n]
+            self.step_mask  = self._step_mask[:n]
+            self.step_index = self._step_index[:n]
+            self.grid_count = self._grid_count[:n]
+            self.energies   = self._energies[:n*self._n_energies].reshape(n, self._n_energies)
+            self.grid       = self._grid[:n*self._n_energies].reshape(n, self._n_energies)
+            self.compare    = self._compare[:n*self._n_energies].reshape(n, self._n_energies)
+            self.matrix     = self._matrix[:self.n_models*n].reshape(self.n_models, n)
+            self.decay      = self._decay[:self.n_models*n].reshape(self.n_models, n)
+            self.work       = self._work[:self.n_models*n].reshape(self.n_models, n)
+        return self
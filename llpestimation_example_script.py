@@ -1,23 +1,12 @@
 """
 Simple example application of llpestimation package.
 """
-from llpestimation import LLPModel, LLPEstimator, LLPMedium, LLPProductionCrossSection
+from llpestimation import LLPModel, LLPEstimator, LLPMedium, LLPProductionCrossSection, LLPMuonGenerator
 from estimation_utilities import *
 import numpy as np
 
-# create some muons
-def generate_atmospheric_muons(n = 10):
-    steps = 50
-    muons = []
-    for _ in range(n):
-        length = float(np.random.randint(100,1000)) # random length in detector in meters
-        energy = float(np.random.randint(500,2000)) # random energy of muon in GeV
-        energy_list = np.linspace(energy, energy*0.5, steps) # unrealistic but whatever
-        length_list = np.linspace(0, length, steps) # from 0 to end of detector
-        muons.append( (length_list, energy_list) )
-    return muons
-
-muons = generate_atmospheric_muons(10)
+# create some muons, power law flux with continuous energy loss in ice
+muon_batch = LLPMuonGenerator(energy_range=(500.0, 1e5), seed=1).muon_batch(10, n_steps=50)
 
 # create some dark leptonic scalar models (a type of LLP)
 masses      = [0.107, 0.110, 0.115, 0.13]
@@ -30,8 +19,9 @@ models = generate_DLSModels(masses, epsilons, names, table_paths)
 min_gap = 50.0 # if distance production to decay is too small, not detectable
 dls_est = LLPEstimator(models, min_gap) # dark leptonic scalar estimator
 
-# compute probabilities for the muons
-probabilities = [dls_est.calc_llp_probability_with_id(muon[0], muon[1]) for muon in muons]
-for p, m in zip(probabilities, muons):
-    print("Muon length [m] and energy [GeV]:", m[0][-1], m[1][0])
-    print("Probabilities:", p)
+# compute probabilities for all muons in one batch
+probabilities = dls_est.calc_llp_probability_batch(muon_batch) # rows = muons, cols = models
+for i, p in enumerate(probabilities):
+    length_list, energy_list = muon_batch.track(i)
+    print("Muon length [m] and energy [GeV]:", length_list[-1], energy_list[0])
+    print("Probabilities:", dict(zip(dls_est.llpmodel_unique_ids, p)))
@@ -0,0 +1,120 @@
+"""
+Benchmarks of the llpestimation hot paths with pytest-benchmark.
+
+Not collected by the normal test run, run it explicitly from any directory:
+
+    python -m pytest tests/benchmark_llpestimation.py --benchmark-save=baseline
+
+saves a baseline into .benchmarks/ for this machine. After a change, compare against it
+and fail if any benchmark got more than 15% slower on average:
+
+    python -m pytest tests/benchmark_llpestimation.py --benchmark-compare --benchmark-compare-fail=mean:15%
+"""
+
+import os
+import sys
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(tests_dir, ".."))
+
+from llpestimation import LLPEstimator, LLPGridEstimator, LLPLookupEstimator, LLPMuonBatch, LLPCrossSectionTable, LLPMuonGenerator
+from estimation_utilities import *
+
+import pytest
+pytest.importorskip("pytest_benchmark")
+
+table_folder = os.path.join(tests_dir, "..", "cross_section_tables") + "/"
+all_masses   = np.arange(0.107, 0.15, 0.001)
+min_gap      = 50.0
+
+@pytest.fixture(scope="module")
+def table(tmp_path_factory):
+    cache_path = str(tmp_path_factory.mktemp("tables") / "totcs_WW.npy")
+    return load_DLS_table_cache(cache_path, all_masses, table_folder)
+
+def create_models(table, n_models):
+    # cycle through the tabulated masses with different couplings
+    masses   = np.resize(all_masses, n_models)
+    epsilons = np.logspace(-6, -4, n_models)
+    names    = ["DarkLeptonicScalar" for m in masses]
+    return generate_DLSModels(masses, epsilons, names, table=table)
+
+def create_muon(steps):
+    # 1 TeV muon losing 300 GeV over 800 m (made up, not following actual energy loss formula)
+    return np.linspace(0, 800, steps), np.linspace(1000, 700, steps)
+
+########## single muon latency ##########
+def test_single_muon(benchmark, table):
+    est = LLPEstimator(create_models(table, len(all_masses)), min_gap)
+    length_list, energy_list = create_muon(100)
+    benchmark(est.calc_llp_probability, length_list, energy_list)
+
+def test_single_muon_workspace(benchmark, table):
+    est = LLPEstimator(create_models(table, len(all_masses)), min_gap, max_steps=100)
+    length_list, energy_list = create_muon(100)
+    out = np.empty(len(all_masses))
+    benchmark(est.calc_llp_probability, length_list, energy_list, out)
+
+def test_single_muon_lookup(benchmark, table):
+    est = LLPLookupEstimator(create_models(table, len(all_masses)), min_gap)
+    length_list, energy_list = create_muon(100)
+    benchmark(est.calc_llp_probability, length_list, energy_list)
+
+########## batch throughput ##########
+def test_batch_throughput(benchmark, table):
+    est = LLPEstimator(create_models(table, len(all_masses)), min_gap)
+    length_list, energy_list = create_muon(100)
+    muons = LLPMuonBatch.from_tracks([length_list]*1000, [energy_list]*1000)
+    benchmark(est.calc_llp_probability_batch, muons)
+
+def test_batch_throughput_generated(benchmark, table):
+    est = LLPEstimator(create_models(table, len(all_masses)), min_gap)
+    muons = LLPMuonGenerator(seed=1).muon_batch(1000, step_length=10.0)
+    benchmark(est.calc_llp_probability_batch, muons)
+
+########## minimum gap scan ##########
+def test_gap_scan(benchmark, table):
+    est = LLPEstimator(create_models(table, len(all_masses)), min_gap)
+    muons = LLPMuonGenerator(seed=1).muon_batch(1000, step_length=10.0)
+    benchmark(est.calc_llp_probability_batch_gaps, muons, np.linspace(10.0, 200.0, 20))
+
+########## mass x coupling grid ##########
+@pytest.mark.parametrize("grid_estimator", [False, True])
+def test_grid_scan(benchmark, table, grid_estimator):
+    # 44 masses x 100 couplings, the plain estimator on the same models for comparison
+    grid = generate_DLSModelGrid(all_masses, np.logspace(-6, -4, 100), table)
+    est = LLPGridEstimator(grid, min_gap) if grid_estimator else LLPEstimator(grid.model_set(), min_gap)
+    length_list, energy_list = create_muon(100)
+    muons = LLPMuonBatch.from_tracks([length_list]*100, [energy_list]*100)
+    benchmark(est.calc_llp_probability_batch, muons)
+
+########## muon generation ##########
+def test_generator_tracks(benchmark):
+    generator = LLPMuonGenerator(seed=1)
+    benchmark(generator.tracks, 100000, 20)
+
+def test_generator_ragged(benchmark):
+    generator = LLPMuonGenerator(seed=1)
+    benchmark(generator.muon_batch, 100000, 50.0)
+
+########## scaling with number of models and steps ##########
+@pytest.mark.parametrize("n_models", [1, 10, 100, 1000])
+def test_model_count_scaling(benchmark, table, n_models):
+    est = LLPEstimator(create_models(table, n_models), min_gap)
+    length_list, energy_list = create_muon(100)
+    benchmark(est.calc_llp_probability, length_list, energy_list)
+
+@pytest.mark.parametrize("steps", [10, 100, 1000, 10000])
+def test_step_count_scaling(benchmark, table, steps):
+    est = LLPEstimator(create_models(table, len(all_masses)), min_gap)
+    length_list, energy_list = create_muon(steps)
+    benchmark(est.calc_llp_probability, length_list, energy_list)
+
+########## table loading ##########
+def test_table_load_csv(benchmark):
+    paths = generate_DLS_WW_oxygen_paths(all_masses, table_folder)
+    benchmark(LLPCrossSectionTable.from_csv, [[path] for path in paths], [get_ice_oxygen()])
+
+def test_table_load_cache(benchmark, table, tmp_path):
+    cache_path = str(tmp_path / "totcs_WW.npy")
+    table.save(cache_path)
+    benchmark(LLPCrossSectionTable.load, cache_path, [get_ice_oxygen()])
@@ -0,0 +1,46 @@
+"""
+Benchmark the scaling of LLPParallelEstimator with the number of worker processes.
+"""
+
+import sys
+sys.path.append("..")
+
+from llpestimation import LLPEstimator, LLPMuonBatch, LLPParallelEstimator
+from estimation_utilities import *
+
+import os
+import tempfile
+import time
+
+masses      = np.arange(0.107, 0.15, 0.001)
+epsilons    = [1e-5 for m in masses]
+names       = ["DarkLeptonicScalar" for m in masses]
+min_gap     = 50.0
+cache_path  = os.path.join(tempfile.mkdtemp(), "totcs_WW.npy")
+compile_DLS_table_cache(masses, cache_path, folder = "../cross_section_tables/")
+build_args  = (masses, epsilons, names, cache_path, min_gap)
+
+# 1 TeV muon losing 300 GeV over 800 m (made up, not following actual energy loss formula)
+n_muons = 20000
+steps = 100
+length_list = np.linspace(0,800,steps)
+energy_list = np.linspace(1000,700,steps)
+muons = LLPMuonBatch.from_tracks([length_list]*n_muons, [energy_list]*n_muons)
+
+print("####### serial batch #######")
+est = build_DLS_estimator(*build_args)
+start = time.perf_counter()
+serial = est.calc_llp_probability_batch(muons)
+serial_time = time.perf_counter() - start
+print("{:.0f} muons/s".format(n_muons/serial_time))
+
+print("####### process pool #######")
+for n_workers in range(1, os.cpu_count() + 1):
+    with LLPParallelEstimator(build_DLS_estimator, build_args, n_workers, chunk_size=500) as parallel:
+        parallel.calc_llp_probability_batch(muons[:n_workers*500]) # warm up workers
+        start = time.perf_counter()
+        probabilities = parallel.calc_llp_probability_batch(muons)
+        elapsed = time.perf_counter() - start
+    assert np.array_equal(probabilities, serial)
+    print("{} workers: {:.0f} muons/s, speedup {:.2f} over serial".format(
+        n_workers, n_muons/elapsed, serial_time/elapsed))
@@ -0,0 +1,55 @@
+"""
+Load generator for LLPService. Starts a service on a Unix socket with a warm
+estimator and sends queries from several concurrent clients.
+"""
+
+import sys
+sys.path.append("..")
+
+from llpestimation import LLPMuonBatch, LLPService, LLPServiceClient, generate_load
+from estimation_utilities import *
+
+import asyncio
+import os
+import tempfile
+
+masses      = np.arange(0.107, 0.15, 0.001)
+epsilons    = [1e-5 for m in masses]
+names       = ["DarkLeptonicScalar" for m in masses]
+min_gap     = 50.0
+tmp_dir     = tempfile.mkdtemp()
+cache_path  = os.path.join(tmp_dir, "totcs_WW.npy")
+socket_path = os.path.join(tmp_dir, "llpservice.sock")
+compile_DLS_table_cache(masses, cache_path, folder = "../cross_section_tables/")
+
+# muons with different lengths and energies (made up, not following actual energy loss formula)
+rng = np.random.default_rng(1)
+n_muons = 1000
+counts = rng.integers(20, 200, size=n_muons)
+length_lists = [np.linspace(0, rng.uniform(100,1000), n) for n in counts]
+energy_lists = [np.linspace(e, 0.6*e, n) for e, n in zip(rng.uniform(500,5000,n_muons), counts)]
+muons = LLPMuonBatch.from_tracks(length_lists, energy_lists)
+
+async def main(n_clients, n_queries, concurrency, max_delay):
+    service = LLPService(build_DLS_estimator(masses, epsilons, names, cache_path, min_gap),
+                         max_batch_size=256, max_delay=max_delay)
+    await service.start_unix(socket_path)
+    clients = [await LLPServiceClient.connect_unix(socket_path) for _ in range(n_clients)]
+    results = await asyncio.gather(*(generate_load(client, muons, n_queries, concurrency) for client in clients))
+    stats = await clients[0].stats()
+    for client in clients:
+        await client.close()
+    await service.close()
+    os.remove(socket_path)
+    return results, stats
+
+for max_delay in [0.0, 0.001, 0.005]:
+    print("####### max_delay {} s #######".format(max_delay))
+    results, stats = asyncio.run(main(n_clients=4, n_queries=1000, concurrency=32, max_delay=max_delay))
+    print("clients: {:.0f} queries/s, latency p50 {:.2f} ms, p99 {:.2f} ms".format(
+        sum(r["queries_per_second"] for r in results),
+        np.median([r["latency_p50"] for r in results])*1e3,
+        max(r["latency_p99"] for r in results)*1e3))
+    print("service: {} queries in {} batches (mean size {:.1f}), latency p50 {:.2f} ms, p99 {:.2f} ms".format(
+        stats["n_queries"], stats["n_batches"], stats["mean_batch_size"],
+        stats["latency_p50"]*1e3, stats["latency_p99"]*1e3))
@@ -5,7 +5,7 @@ Profile the llpestimator to see where the bottlenecks are.
 import sys
 sys.path.append("..")
 
-from llpestimation import LLPModel, LLPEstimator, LLPMedium, LLPProductionCrossSection
+from llpestimation import LLPModel, LLPEstimator, LLPMedium, LLPProductionCrossSection, LLPMuonBatch, LLPMuonGenerator
 from estimation_utilities import *
 
 import timeit
@@ -22,10 +22,11 @@ min_gap = 50.0
 est = LLPEstimator(models, min_gap)
 
 
-# 1 TeV muon losing 300 GeV over 800 m (made up, not following actual energy loss formula)
+# muons from a power law flux with continuous energy loss in ice
 steps = 100
-length_list = np.linspace(0,800,steps)
-energy_list = np.linspace(1000,700,steps)
+generator = LLPMuonGenerator(energy_range=(500.0, 1e5), length_range=(800.0, 800.0), seed=1)
+lengths, energies = generator.tracks(1000, steps)
+length_list, energy_list = lengths[0], energies[0]
 
 # cProfile for the calculations
 print("####### cProfile for probability calculation #######")
@@ -35,3 +36,21 @@ with cProfile.Profile() as profile:
 profile_result = pstats.Stats(profile)
 profile_result.sort_stats(pstats.SortKey.TIME)
 profile_result.print_stats()
+
+# cProfile for the same muons evaluated as one batch
+print("####### cProfile for batch probability calculation #######")
+muon_batch = LLPMuonBatch.from_arrays(lengths, energies)
+with cProfile.Profile() as profile:
+    est.calc_llp_probability_batch(muon_batch)
+profile_result = pstats.Stats(profile)
+profile_result.sort_stats(pstats.SortKey.TIME)
+profile_result.print_stats()
+
+# built in stage timers, without the cProfile overhead
+print("####### LLPEstimator instrumentation #######")
+instrumentation = est.enable_instrumentation()
+for i in range(1000):
+    est.calc_llp_probability(length_list, energy_list)
+est.calc_llp_probability_batch(muon_batch)
+est.disable_instrumentation()
+print(instrumentation.to_prometheus())
@@ -2,12 +2,25 @@
 import sys
 sys.path.append("..")
 
-from llpestimation import LLPModel, LLPEstimator, LLPMedium, LLPProductionCrossSection
+from llpestimation import LLPModel, LLPEstimator, LLPMedium, LLPProductionCrossSection, LLPMuonBatch
+from llpestimation import LLPDensityProfile
+from llpestimation import LLPCrossSectionTable, LLPTabulatedCrossSection, LLPLazyCrossSectionTable, LLPParallelEstimator
+from llpestimation import LLPStreamingPipeline, iter_muon_chunks, default_chunk_size, LLPRateAccumulator
+from llpestimation import LLPService, LLPServiceClient, generate_load, LLPCachedEstimator, LLPInstrumentation
+from llpestimation import LLPModelGrid, LLPGridEstimator, LLPModelSet, LLPLookupEstimator
+from llpestimation import llpcli, LLPEnergyLoss, LLPCylinder, LLPPrism, LLPMuonGenerator
+from llpestimation import LLPVertexSampler
+import asyncio
+import math
+import subprocess
 from estimation_utilities import *
 import os
+import time
+import tracemalloc
 import numpy as np
 import pandas as pd
 import pytest
+from scipy.interpolate import interp1d
 
 def create_test_DLS_model():
     # parameters for test
@@ -39,6 +52,17 @@ def test_llpmedium():
 
     assert n_oxygen == oxygen.number_density
     assert n_hydrogen == hydrogen.number_density
+
+def test_llpdensityprofile():
+    profile = LLPDensityProfile([1000.0, 2000.0], [0.90, 0.92], 0.92)
+    assert np.allclose(profile.scale([0.0, 1000.0, 1500.0, 2000.0, 3000.0]),
+                       [0.90/0.92, 0.90/0.92, 0.91/0.92, 1.0, 1.0])
+    # vertical and horizontal tracks from 1500 m depth
+    lengths = np.linspace(0, 1000, 5)
+    assert np.allclose(profile.track_scale(lengths, 1500.0, 1.0), profile.scale(1500.0 + lengths))
+    assert np.allclose(profile.track_scale(lengths, 1500.0, 0.0), 0.91/0.92)
+    with pytest.raises(ValueError):
+        LLPDensityProfile([2000.0, 1000.0], [0.90, 0.92], 0.92)
 ############## END LLPMedium ##############
 
 ############## TEST LLPProductionCrossSection ##############
@@ -73,6 +97,279 @@ def test_llpxsec():
 ############## END LLPProductionCrossSection ##############
 
 
+############## TEST LLPMuonBatch ##############
+def test_llpmuonbatch():
+    muons = LLPMuonBatch.from_tracks([[0, 1, 2], [0, 5]], [[10, 9, 8], [20, 19]])
+    assert len(muons) == 2
+    assert muons.n_steps == 5
+    assert np.all(muons.offsets == [0, 3, 5])
+    assert np.all(muons.step_counts == [3, 2])
+    lengths, energies = muons.track(1)
+    assert np.all(lengths == [0, 5]) and np.all(energies == [20, 19])
+
+    # slicing gives a batch with shifted offsets
+    sub = muons[1:]
+    assert len(sub) == 1
+    assert np.all(sub.offsets == [0, 2])
+    assert np.all(sub.energies == [20, 19])
+
+    with pytest.raises(ValueError):
+        LLPMuonBatch([0, 1], [10], [0, 2]) # different lengths
+    with pytest.raises(ValueError):
+        LLPMuonBatch([0, 1], [10, 9], [0, 2, 2]) # empty muon
+############## END LLPMuonBatch ##############
+
+############## TEST LLPEnergyLoss ##############
+def test_llpenergyloss():
+    loss = LLPEnergyLoss(a=0.24, b=3.3e-4)
+    energies = np.array([10.0, 100.0, 1000.0, 1e5])
+    # closed form agrees with small steps of dE/dx = -(a + b E)
+    distances = np.linspace(0, 20, 2001)
+    stepped = energies.copy()
+    for step in np.diff(distances):
+        stepped = stepped - (loss.a + loss.b*stepped)*step
+    assert np.allclose(loss.energy(energies, distances[-1]), stepped, rtol=1e-4)
+    ranges = loss.range(energies)
+    assert np.allclose(loss.energy(energies, ranges), 0.0, atol=1e-9)
+    assert np.all(loss.energy(energies, ranges + 1.0) == 0.0)
+    assert np.allclose(loss.initial_energy(loss.energy(energies, 30.0), 30.0), energies)
+    # without radiative losses
+    assert np.allclose(LLPEnergyLoss(0.2, 0.0).energy(100.0, [100.0, 1000.0]), [80.0, 0.0])
+############## END LLPEnergyLoss ##############
+
+############## TEST LLPMuonGenerator ##############
+def test_llpmuongenerator():
+    generator = LLPMuonGenerator(gamma=2.7, energy_range=(100.0, 1e5), length_range=(100.0, 1000.0), seed=3)
+    # power law: P(E > x) = (x^(1-gamma) - high^(1-gamma)) / (low^(1-gamma) - high^(1-gamma))
+    energies = generator.sample_energies(200000)
+    assert np.all((energies >= 100.0) & (energies <= 1e5))
+    expected = (1000.0**-1.7 - 1e5**-1.7) / (100.0**-1.7 - 1e5**-1.7)
+    assert abs(np.mean(energies > 1000.0) - expected) < 5*np.sqrt(expected/len(energies))
+    assert np.allclose(np.log(LLPMuonGenerator(gamma=1, seed=3).sample_energies(100000)).mean(),
+                       0.5*(np.log(100.0) + np.log(1e5)), rtol=1e-2)
+
+    # equal steps, energies follow the continuous loss, stopped muons end at their range
+    lengths, step_energies = generator.tracks(1000, 20)
+    assert lengths.shape == step_energies.shape == (1000, 20)
+    loss = generator.energy_loss
+    initial = step_energies[:, 0]
+    assert np.allclose(step_energies, loss.energy(initial[:, None], lengths))
+    assert np.all(lengths[:, -1] <= np.minimum(1000.0, loss.range(initial)) + 1e-9)
+    assert np.all(step_energies >= 0)
+    assert np.array_equal(LLPMuonGenerator(seed=5).tracks(10, 5)[1], LLPMuonGenerator(seed=5).tracks(10, 5)[1])
+
+    # ragged batches with at most step_length per step
+    muons = generator.muon_batch(500, step_length=30.0)
+    assert len(muons) == 500
+    for i in [0, 250, 499]:
+        lengths, step_energies = muons.track(i)
+        assert lengths[0] == 0 and np.all(np.diff(lengths) <= 30.0) and np.all(np.diff(lengths) > 0)
+        assert np.allclose(step_energies, loss.energy(step_energies[0], lengths))
+    batches = list(generator.iter_batches(250, 100, n_steps=10))
+    assert [len(batch) for batch in batches] == [100, 100, 50]
+    assert np.all(batches[0].step_counts == 10)
+    with pytest.raises(ValueError):
+        generator.muon_batch(10)
+
+    # ready for the estimator
+    est = create_estimator()
+    assert np.all(est.calc_llp_probability_batch(muons) >= 0)
+############## END LLPMuonGenerator ##############
+
+############## TEST LLPGeometry ##############
+def test_llpgeometry():
+    origins = np.array([[0, 0, 1000.0], [-1000, 0, 0], [0, 600, 0], [0, 0, 0], [0, 0, -1000], [-1000, 0, 0]])
+    directions = np.array([[0, 0, -1.0], [1, 0, 0], [0, 0, -1], [0, 0, 1], [0, 0, -1], [-1, 0, 0]])
+    cylinder = LLPCylinder(500.0, 1000.0)
+    hexagon = LLPPrism.hexagon(500.0, -500.0, 500.0)
+    # vertical down, horizontal, vertical outside, starting inside, below going down, going away
+    t_in, t_out = cylinder.intersect(origins, directions)
+    assert np.allclose(t_in[[0, 1, 3]], [500, 500, 0]) and np.allclose(t_out[[0, 1, 3]], [1500, 1500, 500])
+    assert np.all(t_out[[2, 4, 5]] <= t_in[[2, 4, 5]])
+    t_in, t_out = hexagon.intersect(origins, directions)
+    assert np.allclose(t_in[[0, 1, 3]], [500, 500, 0]) and np.allclose(t_out[[0, 1, 3]], [1500, 1500, 500])
+    assert np.all(t_out[[2, 4, 5]] <= t_in[[2, 4, 5]])
+    # hexagon side is sqrt(3)/2 r from the center
+    t_in, t_out = hexagon.intersect([[0, -1000, 0]], [[0, 1, 0]])
+    assert np.allclose([t_in[0], t_out[0]], [1000 - 500*np.sqrt(3)/2, 1000 + 500*np.sqrt(3)/2])
+    with pytest.raises(ValueError):
+        LLPPrism(hexagon.vertices[::-1], -500.0, 500.0)
+
+    # random tracks against a scalar reference
+    rng = np.random.default_rng(2)
+    n = 500
+    cos_zenith = rng.uniform(-1, 1, n)
+    phi = rng.uniform(0, 2*np.pi, n)
+    directions = np.stack([np.sqrt(1 - cos_zenith**2)*np.cos(phi), np.sqrt(1 - cos_zenith**2)*np.sin(phi), cos_zenith], axis=1)
+    origins = rng.uniform(-900, 900, (n, 3))
+    for volume in [cylinder, hexagon]:
+        t_in, t_out = volume.intersect(origins, directions)
+        t = np.linspace(0, 4000, 40001)
+        for i in range(0, n, 25):
+            points = origins[i] + t[:, None]*directions[i]
+            if volume is cylinder:
+                inside = (np.hypot(points[:, 0], points[:, 1]) <= 500) & (np.abs(points[:, 2]) <= 500)
+            else:
+                inside = np.all(points[:, :2] @ volume.normals.T <= volume.offsets, axis=1) & (np.abs(points[:, 2]) <= 500)
+            if np.any(inside):
+                assert abs(t[inside][0] - t_in[i]) < 0.2 and abs(t[inside][-1] - t_out[i]) < 0.2
+            else:
+                assert t_out[i] <= t_in[i] + 0.2
+
+    # trimmed steps, misses and stopping muons dropped
+    energies = rng.uniform(10, 1000, n)
+    loss = LLPEnergyLoss()
+    muons, kept = cylinder.muon_batch(origins, directions, energies, step_length=25.0,
+                                      entry_margin=30.0, exit_margin=20.0, min_length=10.0)
+    t_in, t_out = cylinder.intersect(origins, directions)
+    end = np.minimum(t_out - 20.0, loss.range(energies))
+    assert np.array_equal(kept, np.flatnonzero(end - (t_in + 30.0) > 10.0))
+    assert 0 < len(kept) < n
+    for j in [0, len(kept)//2, len(kept) - 1]:
+        i = kept[j]
+        lengths, step_energies = muons.track(j)
+        assert lengths[0] == 0 and np.isclose(lengths[-1], end[i] - t_in[i] - 30.0)
+        assert np.all(np.diff(lengths) <= 25.0) and np.all(np.diff(lengths) > 0)
+        assert np.allclose(step_energies, loss.energy(energies[i], t_in[i] + 30.0 + lengths))
+    # ready for the estimator
+    est = create_estimator()
+    assert est.calc_llp_probability_batch(muons).shape == (len(kept), len(est.llpmodels))
+############## END LLPGeometry ##############
+
+############## TEST LLPCrossSectionTable ##############
+def test_llpcrosssectiontable():
+    masses = [0.107, 0.115, 0.13]
+    eps = 5e-6
+    paths = generate_DLS_WW_oxygen_paths(masses, folder = "../cross_section_tables/")
+    oxygen = get_ice_oxygen()
+    table = LLPCrossSectionTable.from_csv([[path] for path in paths], [oxygen])
+    assert len(table) == len(masses)
+
+    # all rows at once agree with one interp1d per table
+    energies = np.array([10.0, 15.0, 333.3, 1000.0, 4321.0, 1e5])
+    interactions = table.interactions_per_cm(energies)
+    assert interactions.shape == (len(masses), len(energies))
+    for row, path in enumerate(paths):
+        df = pd.read_csv(path, names=["E0", "totcs"])
+        func_to_xsec = interp1d(df["E0"], df["totcs"], kind="linear")
+        assert np.allclose(interactions[row], func_to_xsec(energies)*oxygen.number_density, rtol=1e-12, atol=0)
+
+    # below table no production, above table not allowed
+    assert np.all(table.interactions_per_cm([0.0, 5.0]) == 0)
+    with pytest.raises(ValueError):
+        table.interactions_per_cm([2e5])
+
+    # row view used by LLPModel, scaled with eps^2
+    llp_xsec = LLPTabulatedCrossSection(table, 1, eps**2)
+    assert np.isclose(llp_xsec.interactions_per_cm(700.0), eps**2*table.interactions_per_cm([700.0])[1, 0])
+    assert np.isclose(llp_xsec.func_tot_xsec_list[0](700.0)*oxygen.number_density, llp_xsec.interactions_per_cm(700.0))
+
+def test_llpcrosssectiontable_cache(tmp_path):
+    masses = np.arange(0.107, 0.15, 0.001)
+    folder = "../cross_section_tables/"
+    cache_path = str(tmp_path / "totcs_WW.npy")
+
+    # compile once, afterwards memory mapped
+    table = load_DLS_table_cache(cache_path, masses, folder)
+    assert isinstance(table.tot_xsec_tables.base, np.memmap) or isinstance(table.tot_xsec_tables, np.memmap)
+    table_csv = LLPCrossSectionTable.from_csv([[p] for p in generate_DLS_WW_oxygen_paths(masses, folder)],
+                                              [get_ice_oxygen()])
+    assert np.all(table.tot_xsec_tables == table_csv.tot_xsec_tables)
+    assert np.all(table.energies == table_csv.energies)
+    assert table.checksum == table_csv.checksum
+    assert table.row_of(0.115) == 8
+
+    # checksum of other source tables does not match
+    with pytest.raises(ValueError):
+        LLPCrossSectionTable.load(cache_path, [get_ice_oxygen()], checksum="0"*64)
+    # stale caches are replaced, not rewritten in place
+    mapped = load_DLS_table_cache(cache_path)
+    load_DLS_table_cache(cache_path, masses[:-1], folder)
+    assert load_DLS_table_cache(cache_path).tot_xsec_tables.shape[0] == len(masses) - 1
+    assert mapped.tot_xsec_tables.shape[0] == len(masses) and np.all(mapped.tot_xsec_tables == table_csv.tot_xsec_tables)
+    assert os.listdir(tmp_path) == ["totcs_WW.npy"]
+    load_DLS_table_cache(cache_path, masses, folder)
+    # wrong media
+    with pytest.raises(ValueError):
+        LLPCrossSectionTable.load(cache_path, south_pole_ice())
+
+    # models from the cache give the same probabilities as from csv
+    test_masses = [0.107, 0.110, 0.115, 0.13]
+    epsilons    = [5e-6 for m in test_masses]
+    names       = ["DarkLeptonicScalar" for m in test_masses]
+    est_cache = LLPEstimator(generate_DLSModels(test_masses, epsilons, names, table=table))
+    est_csv   = create_estimator()
+    length_list = np.linspace(0,800,100)
+    energy_list = np.linspace(1000,700,100)
+    assert np.all(est_cache.calc_llp_probability(length_list, energy_list)
+                  == est_csv.calc_llp_probability(length_list, energy_list))
+
+def test_llpcrosssectiontable_lazy(tmp_path):
+    masses = [0.107, 0.115, 0.13]
+    epsilons = [5e-6, 5e-6, 1e-5]
+    names = ["DarkLeptonicScalar" for m in masses]
+    cache_path = str(tmp_path / "totcs_WW.npy")
+
+    # models are created without compiling or loading the table
+    table = lazy_DLS_table(cache_path, masses, folder = "../cross_section_tables/")
+    models = generate_DLSModels(masses, epsilons, names, table=table)
+    assert not table.loaded and not os.path.exists(cache_path)
+    assert len(table) == len(masses) and table.row_of(0.13) == 2
+
+    # first evaluation loads it
+    length_list = np.linspace(0, 800, 100)
+    energy_list = np.linspace(1000, 700, 100)
+    assert models[1].interactions_per_cm(700.0) > 0
+    assert table.loaded and os.path.exists(cache_path)
+    paths = generate_DLS_WW_oxygen_paths(masses, folder = "../cross_section_tables/")
+    eager = LLPEstimator(generate_DLSModels(masses, epsilons, names, paths), 50.0)
+    assert np.allclose(LLPEstimator(models, 50.0).calc_llp_probability(length_list, energy_list),
+                       eager.calc_llp_probability(length_list, energy_list), rtol=1e-12, atol=0)
+
+    handle = LLPLazyCrossSectionTable.from_cache(cache_path, [get_ice_oxygen()])
+    assert not handle.loaded
+    assert handle.row_of(0.115) == 1 and handle.loaded
+
+def test_llpcrosssectiontable_media():
+    masses = [0.107, 0.115]
+    epsilons = [5e-6, 1e-5]
+    names = ["DarkLeptonicScalar" for m in masses]
+    paths = generate_DLS_WW_oxygen_paths(masses, folder = "../cross_section_tables/")
+    oxygen, hydrogen = south_pole_ice()
+
+    # oxygen tables stand in for hydrogen, media are combined into one table at load
+    models = generate_DLSModels(masses, epsilons, names, table_paths=paths)
+    models_ice = generate_DLSModels(masses, epsilons, names, table_paths=[[path, path] for path in paths],
+                                    medium_list=[oxygen, hydrogen])
+    table = models_ice[0].llp_xsec.table
+    assert table.tot_xsec_tables.shape[:2] == (len(masses), 2)
+    energies = np.array([15.0, 700.0, 4321.0])
+    scale = (oxygen.number_density + hydrogen.number_density) / oxygen.number_density
+    for model, model_ice in zip(models, models_ice):
+        assert np.allclose(model_ice.interactions_per_cm(energies), scale*model.interactions_per_cm(energies),
+                           rtol=1e-12, atol=0)
+    est = LLPEstimator(models, 50.0)
+    est_ice = LLPEstimator(models_ice, 50.0)
+    length_list = np.linspace(0, 800, 100)
+    energy_list = np.linspace(1000, 700, 100)
+    assert np.allclose(est_ice.calc_llp_probability(length_list, energy_list),
+                       scale*est.calc_llp_probability(length_list, energy_list), rtol=1e-12, atol=0)
+
+    # interpolator based cross sections tabulated into one table
+    grid = table.energies
+    llp_xsecs = []
+    for path in paths:
+        df = pd.read_csv(path, names=["E0", "totcs"])
+        func_to_xsec = interp1d(df["E0"], df["totcs"], kind="linear")
+        llp_xsecs.append(LLPProductionCrossSection([func_to_xsec, func_to_xsec], [oxygen, hydrogen]))
+    tabulated = LLPCrossSectionTable.tabulate(llp_xsecs, grid, row_keys=masses)
+    assert np.allclose(tabulated.interactions_table, table.interactions_table, rtol=1e-12, atol=0)
+    assert np.allclose(tabulated.interactions_per_cm(energies)[1], llp_xsecs[1].interactions_per_cm(energies),
+                       rtol=1e-12, atol=0)
+    with pytest.raises(ValueError):
+        LLPCrossSectionTable.tabulate([llp_xsecs[0], LLPProductionCrossSection([func_to_xsec], [oxygen])], grid)
+############## END LLPCrossSectionTable ##############
+
 ############## TEST LLPModel ##############
 def test_llpmodel_creation():
     # parameters for test
@@ -110,6 +407,27 @@ def test_llpmodel_decay_factor():
     assert DLS.decay_factor(-60,20,1000) == 0 # no negatives
     assert DLS.decay_factor(-60,100,1000) == 0 # no negatives
 
+def test_llpmodel_decay_factor_matrix():
+    from llpestimation.llpmodel import decay_factor_matrix, SPEED_OF_LIGHT
+    models = [create_test_DLS_model(), create_estimator().llpmodels[0]]
+    c_tau_over_mass = np.array([[SPEED_OF_LIGHT*m.tau/m.mass] for m in models])
+
+    l1 = 5000.0
+    l2 = np.array([80000.0, 6000.0, 5000.0, 4000.0, -100.0, 5000.0001, 1e5])
+    energy = np.array([1000.0, 500.0, 800.0, 1000.0, 1000.0, 300.0, 1e4])
+    matrix = decay_factor_matrix(l1, l2, energy, c_tau_over_mass)
+    assert matrix.shape == (len(models), len(energy))
+    for row, m in zip(matrix, models):
+        assert np.allclose(row, m.decay_factor(l1, l2, energy), rtol=1e-6, atol=0)
+
+    # expm1 keeps precision for l2 - l1 much smaller than the decay length
+    decay_length = c_tau_over_mass[0, 0]*energy[5]
+    x = (l2[5] - l1)/decay_length
+    expected = np.exp(-l1/decay_length) * (x - x**2/2) # series of -expm1(-x)
+    assert np.isclose(matrix[0, 5], expected, rtol=1e-9, atol=0)
+    # energy 0 gives 0 instead of nan
+    assert np.all(decay_factor_matrix(l1, l2[:1], np.zeros(1), c_tau_over_mass) == 0)
+
 def test_llpmodel_interactions_per_cm():
     DLS = create_test_DLS_model()
     assert DLS.interactions_per_cm(-1) == 0
@@ -126,6 +444,53 @@ def test_llpmodel_lifetime():
         DLS.get_lifetime(-5)
 ############## END LLPModel ##############
 
+############## TEST LLPModelSet ##############
+def test_llpmodelset(tmp_path):
+    masses   = [0.107, 0.110, 0.115, 0.13]
+    epsilons = [5e-6, 1e-5, 5e-6, 2e-5]
+    table = load_DLS_table_cache(str(tmp_path / "totcs_WW.npy"), masses, "../cross_section_tables/")
+    models = generate_DLSModels(masses, epsilons, ["DarkLeptonicScalar"]*4, table=table)
+    model_set = LLPModelSet.from_models(models)
+    assert len(model_set) == 4
+    assert model_set.unique_ids == [m.unique_id for m in models]
+    assert model_set.index(models[2].unique_id) == 2
+    with pytest.raises(KeyError):
+        model_set.index("DarkLeptonicScalar_1.0_1.0_1.0")
+    assert model_set[1].unique_id == models[1].unique_id
+    assert model_set[1].interactions_per_cm(500.0) == models[1].interactions_per_cm(500.0)
+
+    # same probabilities as the list of models, subsets keep their columns
+    length_list = np.linspace(0,800,100)
+    energy_list = np.linspace(1000,700,100)
+    est_list = LLPEstimator(models, 50.0)
+    est_set  = LLPEstimator(model_set, 50.0)
+    probabilities = est_set.calc_llp_probability(length_list, energy_list)
+    assert np.all(probabilities == est_list.calc_llp_probability(length_list, energy_list))
+    assert np.allclose(est_set.subset([3, 1]).calc_llp_probability(length_list, energy_list),
+                       probabilities[[3, 1]], rtol=1e-12, atol=0)
+    assert np.allclose(est_list.subset(slice(1, 3)).calc_llp_probability(length_list, energy_list),
+                       probabilities[1:3], rtol=1e-12, atol=0)
+    assert model_set.select([models[3].unique_id]).unique_ids == [models[3].unique_id]
+    assert len(model_set[model_set.masses > 0.112]) == 2
+
+    # round trip including the cross section reference, rows found by mass on a reordered table
+    model_set.save(str(tmp_path / "models.npz"))
+    reordered = table.take([3, 2, 1, 0])
+    reordered.checksum = table.checksum
+    loaded = LLPModelSet.load(str(tmp_path / "models.npz"), reordered)
+    assert loaded.unique_ids == model_set.unique_ids
+    assert np.allclose(LLPEstimator(loaded, 50.0).calc_llp_probability(length_list, energy_list),
+                       probabilities, rtol=1e-12, atol=0)
+    other = table.take([0, 1, 2, 3])
+    other.checksum = "0"*64
+    with pytest.raises(ValueError):
+        LLPModelSet.load(str(tmp_path / "models.npz"), other)
+
+    # LLPModel ids only round trip with the cross section passed along
+    model = LLPModel.from_unique_id(models[0].unique_id, models[0].llp_xsec)
+    assert model.interactions_per_cm(500.0) == models[0].interactions_per_cm(500.0)
+############## END LLPModelSet ##############
+
 ############## TEST LLPEstimator ##############
 def create_estimator():
     masses      = [0.107, 0.110, 0.115, 0.13]
@@ -158,6 +523,730 @@ def test_llpestimator():
     print(probabilities_map)
     assert np.all(probabilities >= 0.0)
 
+def test_llpestimator_debug():
+    est = create_estimator()
+    est_debug = LLPEstimator(est.llpmodels, 50.0, debug=True)
+    length_list = np.linspace(0,800,100)
+    energy_list = np.linspace(1000,700,100)
+    assert np.all(est.calc_llp_probability(length_list, energy_list)
+                  == est_debug.calc_llp_probability(length_list, energy_list))
+
+    # muon energy below LLP mass is only checked in debug mode
+    energy_list[-1] = 0.1
+    assert np.all(np.isfinite(est.calc_llp_probability(length_list, energy_list)))
+    with pytest.raises(ValueError):
+        est_debug.calc_llp_probability(length_list, energy_list)
+
+def test_llpestimator_workspace():
+    est = create_estimator()
+    est_ws = LLPEstimator(est.llpmodels, 50.0, max_steps=1000)
+    length_list = np.linspace(0,800,1000)
+    energy_list = np.linspace(1000,700,1000)
+    out = np.empty(len(est.llpmodels))
+
+    assert est_ws.calc_llp_probability(length_list, energy_list, out) is out
+    assert np.allclose(out, est.calc_llp_probability(length_list, energy_list), rtol=1e-12, atol=0)
+    # shorter tracks reuse the same buffers, stopping muons give 0 below the table
+    assert np.allclose(est_ws.calc_llp_probability(length_list[:10], energy_list[:10]),
+                       est.calc_llp_probability(length_list[:10], energy_list[:10]), rtol=1e-12, atol=0)
+    stopping = np.linspace(500,0,1000)
+    assert np.allclose(est_ws.calc_llp_probability(length_list, stopping),
+                       est.calc_llp_probability(length_list, stopping), rtol=1e-12, atol=0)
+    with pytest.raises(ValueError):
+        est_ws.calc_llp_probability(np.linspace(0,800,1001), np.linspace(1000,700,1001))
+
+    # steady state allocates nothing, one (models x steps) matrix alone would be 32 kB
+    tracemalloc.start()
+    for _ in range(2):
+        est_ws.calc_llp_probability(length_list, energy_list, out) # warm up
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    for _ in range(10):
+        est_ws.calc_llp_probability(length_list, energy_list, out)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert after == before
+    assert peak - before < 4096
+
+def test_llpestimator_stacked_table():
+    est = create_estimator()
+    assert est.xsec_table is not None
+
+    # same models with one interp1d each are evaluated model by model
+    oxygen = get_ice_oxygen()
+    models = []
+    for m in est.llpmodels:
+        path = generate_DLS_WW_oxygen_paths([m.mass], folder = "../cross_section_tables/")[0]
+        df = pd.read_csv(path, names=["E0", "totcs"])
+        func_to_xsec = interp1d(df["E0"], m.eps**2*df["totcs"], kind="linear")
+        models.append(LLPModel(m.name, m.mass, m.eps, m.tau, LLPProductionCrossSection([func_to_xsec], [oxygen])))
+    est_interp1d = LLPEstimator(models, 50.0)
+    assert est_interp1d.xsec_table is None
+
+    length_list = np.linspace(0,800,100)
+    energy_list = np.linspace(1000,700,100)
+    assert np.allclose(est.calc_llp_probability(length_list, energy_list),
+                       est_interp1d.calc_llp_probability(length_list, energy_list), rtol=1e-10, atol=0)
+
+def test_llpestimator_batch():
+    est = create_estimator()
+
+    # muons of different lengths, energies and number of steps
+    length_lists = [np.linspace(0,800,100), np.linspace(0,300,20), np.linspace(0,1000,57)]
+    energy_lists = [np.linspace(1000,700,100), np.linspace(200,150,20), np.linspace(5000,4000,57)]
+    muons = LLPMuonBatch.from_tracks(length_lists, energy_lists)
+
+    probabilities = est.calc_llp_probability_batch(muons)
+    assert probabilities.shape == (len(length_lists), len(est.llpmodels))
+
+    # same as looping over single muons
+    for i, (length_list, energy_list) in enumerate(zip(length_lists, energy_lists)):
+        assert np.allclose(probabilities[i], est.calc_llp_probability(length_list, energy_list), rtol=1e-12, atol=0)
+
+    # empty batch
+    assert est.calc_llp_probability_batch(LLPMuonBatch.from_tracks([], [])).shape == (0, len(est.llpmodels))
+
+    with pytest.raises(ValueError):
+        est.calc_llp_probability_batch(LLPMuonBatch.from_tracks([[0, 100]], [[-5, 10]]))
+
+def test_llpestimator_batch_blocks():
+    est = create_estimator()
+    muons = create_test_muons(200)
+    scale = np.linspace(0.9, 1.1, muons.n_steps)
+    expected = est.calc_llp_probability_batch(muons, scale)
+    expected_gaps = est.calc_llp_probability_batch_gaps(muons, [30.0, 50.0], scale)
+    # blocks of a few muons, and single muons larger than the budget
+    for max_block_bytes in [20000, 1]:
+        small = LLPEstimator(est.llpmodels, 50.0, max_block_bytes=max_block_bytes)
+        assert len(small._muon_blocks(muons, 3)) > 10
+        assert np.allclose(small.calc_llp_probability_batch(muons, scale), expected, rtol=1e-12, atol=0)
+        assert np.allclose(small.calc_llp_probability_batch_gaps(muons, [30.0, 50.0], scale), expected_gaps,
+                           rtol=1e-12, atol=0)
+    lookup = LLPLookupEstimator(est.llpmodels)
+    assert np.allclose(LLPLookupEstimator(est.llpmodels, max_block_bytes=20000).calc_llp_probability_batch(muons, scale),
+                       lookup.calc_llp_probability_batch(muons, scale), rtol=1e-12, atol=0)
+
+    # memory of the (models x steps) buffers stays within the budget for large batches
+    muons = LLPMuonGenerator(seed=1).muon_batch(2000, n_steps=100)
+    budget = LLPEstimator(est.llpmodels, 50.0, max_block_bytes=2**20)
+    tracemalloc.start()
+    budget.calc_llp_probability_batch(muons)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < 4*2**20 # about 45 MB in one block
+    with pytest.raises(ValueError):
+        LLPEstimator(est.llpmodels, 50.0, max_block_bytes=0)
+
+def test_llpestimator_adaptive():
+    est = create_estimator()
+    length_list = np.linspace(0,800,10000)
+    energy_list = np.linspace(1000,700,10000)
+    probabilities, errors, n_evaluated = est.calc_llp_probability_adaptive(length_list, energy_list, rtol=1e-4)
+    assert n_evaluated < 1000
+
+    # within the reported error of the thin target sum
+    expected = est.calc_llp_probability(length_list, energy_list)
+    assert np.all(np.abs(probabilities - expected) <= errors)
+    assert np.all(errors <= 1e-3*expected)
+
+    # few steps are evaluated exactly
+    length_list, energy_list = np.linspace(0,800,5), np.linspace(1000,700,5)
+    probabilities, errors, n_evaluated = est.calc_llp_probability_adaptive(length_list, energy_list)
+    assert n_evaluated == 5 and np.all(errors == 0.0)
+    assert np.allclose(probabilities, est.calc_llp_probability(length_list, energy_list), rtol=1e-12, atol=0)
+
+    # coarse steps on a track barely longer than 2*min_gap, far from the integral
+    length_list, energy_list = np.linspace(0,120,50), np.linspace(1000,700,50)
+    probabilities, errors, n_evaluated = est.calc_llp_probability_adaptive(length_list, energy_list)
+    assert np.allclose(probabilities, est.calc_llp_probability(length_list, energy_list), rtol=1e-6, atol=0)
+
+def test_llpestimator_instrumentation():
+    est = create_estimator()
+    assert est.instrumentation is None
+    instrumentation = est.enable_instrumentation()
+    length_list = np.linspace(0,800,100)
+    energy_list = np.linspace(1000,700,100)
+    est.calc_llp_probability(length_list, energy_list)
+    est.calc_llp_probability_batch(create_test_muons(10))
+
+    counters = instrumentation.to_dict()
+    assert counters["calls"] == {"calc_llp_probability": 1, "calc_llp_probability_batch": 1}
+    assert counters["muons"] == 11
+    assert counters["model_evaluations"] == 11*len(est.llpmodels)
+    assert counters["steps"] == 100 + create_test_muons(10).n_steps
+    assert sum(counters["steps_histogram"]) == 11
+    assert counters["steps_histogram"][np.searchsorted(instrumentation.steps_bins, 100)] >= 1
+    assert set(counters["stage_seconds"]) == {"input", "decay_factor", "cross_section", "reduction"}
+    assert all(counters["stage_laps"][stage] == 2 for stage in counters["stage_laps"])
+    text = instrumentation.to_prometheus()
+    assert 'llpestimation_calls_total{method="calc_llp_probability"} 1' in text
+    assert 'llpestimation_steps_per_track_bucket{le="+Inf"} 11' in text
+
+    # switched off at runtime, nothing is counted
+    est.disable_instrumentation()
+    est.calc_llp_probability(length_list, energy_list)
+    assert instrumentation.muons == 11
+
+def test_llpestimator_float32():
+    est = create_estimator()
+    est32 = LLPEstimator(est.llpmodels, 50.0, dtype=np.float32)
+    assert est32.xsec_table.interactions_table.dtype == np.float32
+    length_list = np.linspace(0,800,1000)
+    energy_list = np.linspace(1000,700,1000)
+
+    # sums are float64 in all paths
+    probabilities = est32.calc_llp_probability(length_list, energy_list)
+    assert probabilities.dtype == np.float64
+    assert np.allclose(probabilities, est.calc_llp_probability(length_list, energy_list), rtol=1e-5, atol=0)
+    est32_ws = LLPEstimator(est.llpmodels, 50.0, max_steps=1000, dtype=np.float32)
+    assert np.allclose(est32_ws.calc_llp_probability(length_list, energy_list), probabilities, rtol=1e-5, atol=0)
+    muons = create_test_muons(20)
+    assert est32.calc_llp_probability_batch(muons).dtype == np.float64
+
+    # lengths are float64, so far from the origin l2 - min_gap keeps its precision
+    length_list = 5000.0 + np.linspace(0,102,200)
+    energy_list = np.linspace(1000,700,200)
+    expected = est.calc_llp_probability(length_list, energy_list)
+    assert np.allclose(est32.calc_llp_probability(length_list, energy_list), expected, rtol=1e-6, atol=0)
+    est32_ws = LLPEstimator(est.llpmodels, 50.0, max_steps=200, dtype=np.float32)
+    assert np.allclose(est32_ws.calc_llp_probability(length_list, energy_list), expected, rtol=1e-6, atol=0)
+
+    # accuracy report against float64
+    errors = est32.validate_precision()
+    assert errors.shape == (len(est.llpmodels),)
+    assert np.all(errors < 1e-5)
+    assert np.all(est.validate_precision(muons) == 0.0)
+
+def test_llpestimator_gaps():
+    est = create_estimator()
+    length_list = np.linspace(0,800,1000)
+    energy_list = np.linspace(1000,700,1000)
+    # unsorted, including gaps too long for the track
+    min_gaps = np.array([120.0, 50.0, 0.0, 10.0, 390.0, 500.0, 300.0])
+    probabilities = est.calc_llp_probability_gaps(length_list, energy_list, min_gaps)
+    assert probabilities.shape == (len(min_gaps), len(est.llpmodels))
+    for gap, row in zip(min_gaps, probabilities):
+        expected = LLPEstimator(est.llpmodels, gap).calc_llp_probability(length_list, energy_list)
+        assert np.allclose(row, expected, rtol=1e-12, atol=0)
+    assert np.all(probabilities[5] == 0) and np.all(probabilities[4] > 0)
+    assert np.all(est.calc_llp_probability_gaps(length_list, energy_list, [-1.0]) == 0)
+
+    # batches, muons run out of steps at different gaps
+    muons = create_test_muons(30)
+    probabilities = est.calc_llp_probability_batch_gaps(muons, min_gaps)
+    assert probabilities.shape == (len(muons), len(min_gaps), len(est.llpmodels))
+    for k, gap in enumerate(min_gaps):
+        expected = LLPEstimator(est.llpmodels, gap).calc_llp_probability_batch(muons)
+        assert np.allclose(probabilities[:, k], expected, rtol=1e-12, atol=0)
+    assert np.allclose(probabilities[4], est.calc_llp_probability_gaps(*muons.track(4), min_gaps), rtol=1e-12, atol=0)
+    assert est.calc_llp_probability_batch_gaps(muons[:0], min_gaps).shape == (0, len(min_gaps), len(est.llpmodels))
+
+    # non-uniform media, one gap reproduces the single gap calculation
+    profile = LLPDensityProfile([0.0, 1000.0, 2000.0], [0.92, 0.95, 0.98], reference_density=0.92)
+    density_scale = profile.track_scale(length_list, 1500.0, 0.6)
+    expected = est.calc_llp_probability(length_list, energy_list, density_scale=density_scale)
+    assert not np.allclose(expected, est.calc_llp_probability(length_list, energy_list), rtol=1e-6, atol=0)
+    assert np.allclose(est.calc_llp_probability_gaps(length_list, energy_list, [50.0], density_scale)[0],
+                       expected, rtol=1e-12, atol=0)
+    batch_scale = profile.track_scale(muons.lengths, 1500.0, 0.6)
+    assert np.allclose(est.calc_llp_probability_batch_gaps(muons, [50.0], batch_scale)[:, 0],
+                       est.calc_llp_probability_batch(muons, batch_scale), rtol=1e-12, atol=0)
+    with pytest.raises(ValueError):
+        est.calc_llp_probability_gaps(length_list, energy_list, [50.0], density_scale[:-1])
+
+def test_llpestimator_density_scale():
+    est = create_estimator()
+    length_list = np.linspace(0,800,1000)
+    energy_list = np.linspace(1000,700,1000)
+    probabilities = est.calc_llp_probability(length_list, energy_list)
+
+    # uniform density scales the probability
+    doubled = np.full(len(length_list), 2.0)
+    assert np.allclose(est.calc_llp_probability(length_list, energy_list, density_scale=doubled),
+                       2*probabilities, rtol=1e-12, atol=0)
+
+    # depth dependent density, same in all paths
+    profile = LLPDensityProfile([1450.0, 2450.0], [0.88, 0.93], 0.92)
+    density_scale = profile.track_scale(length_list, 1450.0, 0.8)
+    scaled = est.calc_llp_probability(length_list, energy_list, density_scale=density_scale)
+    assert np.all(scaled < probabilities)
+    est_ws = LLPEstimator(est.llpmodels, 50.0, max_steps=1000)
+    assert np.allclose(est_ws.calc_llp_probability(length_list, energy_list, density_scale=density_scale),
+                       scaled, rtol=1e-12, atol=0)
+    adaptive, errors, n_evaluated = est.calc_llp_probability_adaptive(length_list, energy_list, rtol=1e-6,
+                                                                      density_scale=density_scale)
+    assert np.allclose(adaptive, scaled, rtol=1e-2, atol=0)
+    muons = LLPMuonBatch.from_tracks([length_list, length_list[:500]], [energy_list, energy_list[:500]])
+    batch_scale = np.concatenate([density_scale, density_scale[:500]])
+    batch = est.calc_llp_probability_batch(muons, density_scale=batch_scale)
+    assert np.allclose(batch[0], scaled, rtol=1e-12, atol=0)
+    assert np.allclose(batch[1], est.calc_llp_probability(length_list[:500], energy_list[:500],
+                                                          density_scale=density_scale[:500]), rtol=1e-12, atol=0)
+    with pytest.raises(ValueError):
+        est.calc_llp_probability(length_list, energy_list, density_scale=density_scale[:10])
+
 ############## END LLPEstimator ##############
 
+############## TEST LLPGridEstimator ##############
+def test_llpgridestimator(tmp_path):
+    masses   = [0.107, 0.110, 0.115, 0.13]
+    epsilons = np.logspace(-6, -4, 7)
+    table = load_DLS_table_cache(str(tmp_path / "totcs_WW.npy"), masses, "../cross_section_tables/")
+    grid = generate_DLSModelGrid(masses, epsilons, table)
+    assert grid.shape == (4, 7) and len(grid) == 28
+
+    # grid points are the same models as generate_DLSModels
+    models = grid.models()
+    reference = generate_DLSModels(np.repeat(masses, len(epsilons)), np.tile(epsilons, len(masses)),
+                                   ["DarkLeptonicScalar"]*len(grid), table=table)
+    for m, ref in zip(models, reference):
+        assert m.mass == ref.mass and m.eps == ref.eps
+        assert np.isclose(m.tau, ref.tau, rtol=1e-12, atol=0)
+
+    est_grid = LLPGridEstimator(grid, 50.0)
+    est = LLPEstimator(reference, 50.0)
+    length_list = np.linspace(0,800,100)
+    energy_list = np.linspace(1000,700,100)
+    probabilities = est_grid.calc_llp_probability_grid(length_list, energy_list)
+    assert probabilities.shape == grid.shape
+    assert np.allclose(probabilities.ravel(), est.calc_llp_probability(length_list, energy_list), rtol=1e-10, atol=0)
+
+    muons = create_test_muons(10)
+    batch_probabilities = est_grid.calc_llp_probability_batch_grid(muons)
+    assert batch_probabilities.shape == (10,) + grid.shape
+    assert np.allclose(batch_probabilities.reshape(10, -1), est.calc_llp_probability_batch(muons), rtol=1e-10, atol=0)
+
+    # the stacked table of all grid points is only built for the methods that need it
+    assert est_grid._xsec_table is None
+    assert np.allclose(est_grid.calc_llp_probability_batch_gaps(muons, [20.0, 50.0]),
+                       est.calc_llp_probability_batch_gaps(muons, [20.0, 50.0]), rtol=1e-10, atol=0)
+    est_grid32 = LLPGridEstimator(grid, 50.0, dtype=np.float32)
+    est32 = LLPEstimator(grid.model_set(), 50.0, dtype=np.float32)
+    assert np.allclose(est_grid32.calc_llp_probability_batch(muons), est32.calc_llp_probability_batch(muons), rtol=1e-5, atol=0)
+############## END LLPGridEstimator ##############
+
+############## TEST LLPLookupEstimator ##############
+def test_llplookupestimator():
+    est = create_estimator()
+    est_lookup = LLPLookupEstimator(est.llpmodels, 50.0, max_length_meters=1500.0)
+    assert est_lookup.lookup_table.shape == (len(est.llpmodels), 200*200)
+    errors = est_lookup.interpolation_error()
+    assert np.all(errors < 5e-2)
+    # geometric l2 spacing resolves tracks just longer than 2*min_gap
+    assert np.max(errors) < np.max(LLPLookupEstimator(est.llpmodels, 50.0, max_length_meters=1500.0,
+                                                      l2_scale_meters=1e9).interpolation_error())
+    length_list, energy_list = np.linspace(0,101,30), np.linspace(1000,700,30)
+    assert np.allclose(est_lookup.calc_llp_probability(length_list, energy_list),
+                       est.calc_llp_probability(length_list, energy_list), rtol=1e-2, atol=0)
+    with pytest.raises(ValueError):
+        LLPLookupEstimator(est.llpmodels, 50.0, l2_scale_meters=0.0)
+
+    # close to the exact calculation, single muons and batches agree
+    length_list = np.linspace(0,800,1000)
+    energy_list = np.linspace(1000,700,1000)
+    assert np.allclose(est_lookup.calc_llp_probability(length_list, energy_list),
+                       est.calc_llp_probability(length_list, energy_list), rtol=1e-2, atol=0)
+    muons = create_test_muons(20)
+    probabilities = est_lookup.calc_llp_probability_batch(muons)
+    assert np.allclose(probabilities, est.calc_llp_probability_batch(muons), rtol=1e-2, atol=0)
+    for i in [0, 7, 19]:
+        assert np.allclose(probabilities[i], est_lookup.calc_llp_probability(muons.track(i)[0], muons.track(i)[1]),
+                           rtol=1e-12, atol=0)
+    # the integrand matrix interpolates the same table
+    assert np.allclose(est_lookup.calc_llp_probability_adaptive(length_list, energy_list)[0],
+                       est_lookup.calc_llp_probability(length_list, energy_list), rtol=1e-2, atol=0)
+    # density scale on the lookup path
+    density_scale = np.linspace(0.9, 1.0, len(muons.lengths))
+    assert np.allclose(est_lookup.calc_llp_probability_batch(muons, density_scale=density_scale),
+                       est.calc_llp_probability_batch(muons, density_scale=density_scale), rtol=1e-2, atol=0)
+
+    # tracks longer than the table are not allowed
+    with pytest.raises(ValueError):
+        est_lookup.calc_llp_probability(np.linspace(0,1600,10), np.linspace(1000,700,10))
+############## END LLPLookupEstimator ##############
+
+############## TEST LLPCachedEstimator ##############
+def test_llpcachedestimator(tmp_path):
+    est = create_estimator()
+    length_list = np.linspace(0,800,100)
+    energy_list = np.linspace(1000,700,100)
+    expected = est.calc_llp_probability(length_list, energy_list)
+
+    with LLPCachedEstimator(est, maxsize=2, disk_path=str(tmp_path / "cache.sqlite")) as cached:
+        assert np.all(cached.calc_llp_probability(length_list, energy_list) == expected)
+        # below the quantization the first result is reused
+        assert np.all(cached.calc_llp_probability(length_list + 1e-7, energy_list*(1 + 1e-9)) == expected)
+        assert cached.stats()["hits"] == 1 and cached.stats()["misses"] == 1
+        cached.calc_llp_probability(length_list, energy_list*1.1)
+        cached.calc_llp_probability(length_list, energy_list*1.2)
+        assert cached.stats()["evictions"] == 1 and cached.stats()["size"] == 2
+
+        # batches with repeated tracks only compute each track once
+        muons = create_test_muons(10)
+        repeated = LLPMuonBatch.from_tracks([muons.track(i % 10)[0] for i in range(30)],
+                                            [muons.track(i % 10)[1] for i in range(30)])
+        probabilities = cached.calc_llp_probability_batch(repeated)
+        assert np.allclose(probabilities, est.calc_llp_probability_batch(repeated), rtol=1e-12, atol=0)
+        assert cached.stats()["misses"] == 13
+
+    # a new pass finds everything on disk, other estimators don't share entries
+    with LLPCachedEstimator(est, disk_path=str(tmp_path / "cache.sqlite")) as cached:
+        assert np.all(cached.calc_llp_probability_batch(repeated) == probabilities)
+        assert cached.stats()["disk_hits"] == 10 and cached.stats()["misses"] == 0
+    with LLPCachedEstimator(LLPEstimator(est.llpmodels, 60.0), disk_path=str(tmp_path / "cache.sqlite")) as cached:
+        cached.calc_llp_probability(length_list, energy_list)
+        assert cached.stats()["misses"] == 1
+
+    # lookup estimators with different grids give different probabilities
+    coarse = LLPLookupEstimator(est.llpmodels, n_energies=10, n_lengths=10)
+    fine = LLPLookupEstimator(est.llpmodels, n_energies=300, n_lengths=300)
+    assert LLPCachedEstimator.estimator_fingerprint(coarse) != LLPCachedEstimator.estimator_fingerprint(fine)
+    assert LLPCachedEstimator.estimator_fingerprint(fine) == \
+        LLPCachedEstimator.estimator_fingerprint(LLPLookupEstimator(est.llpmodels, n_energies=300, n_lengths=300))
+    assert LLPCachedEstimator.estimator_fingerprint(est) != \
+        LLPCachedEstimator.estimator_fingerprint(LLPEstimator(est.llpmodels, 50.0, dtype=np.float32))
+
+def test_llpcachedestimator_service(tmp_path):
+    est = create_estimator()
+    muons = create_test_muons(20)
+    expected = est.calc_llp_probability_batch(muons)
+    socket_path = str(tmp_path / "llpservice.sock")
+
+    async def run(cached):
+        # the service evaluates batches in executor threads
+        service = LLPService(cached, max_delay=0.01)
+        await service.start_unix(socket_path)
+        client = await LLPServiceClient.connect_unix(socket_path)
+        results = await asyncio.gather(*(client.query(*muons.track(i % len(muons))) for i in range(2*len(muons))))
+        await client.close()
+        await service.close()
+        return results
+
+    with LLPCachedEstimator(est, disk_path=str(tmp_path / "cache.sqlite")) as cached:
+        results = asyncio.run(run(cached))
+        assert cached.stats()["misses"] == len(muons)
+    assert np.allclose(results, np.concatenate([expected, expected]), rtol=1e-12, atol=0)
+    with LLPCachedEstimator(est, disk_path=str(tmp_path / "cache.sqlite")) as cached:
+        asyncio.run(run(cached))
+        assert cached.stats()["disk_hits"] == len(muons) and cached.stats()["misses"] == 0
+############## END LLPCachedEstimator ##############
+
+############## TEST LLPParallelEstimator ##############
+def test_llpparallelestimator(tmp_path):
+    masses      = [0.107, 0.110, 0.115, 0.13]
+    epsilons    = [5e-6, 5e-6, 5e-6, 5e-6]
+    names       = ["DarkLeptonicScalar" for m in masses]
+    cache_path  = str(tmp_path / "totcs_WW.npy")
+    compile_DLS_table_cache(masses, cache_path, folder = "../cross_section_tables/")
+    build_args  = (masses, epsilons, names, cache_path, 50.0)
+
+    rng = np.random.default_rng(1)
+    counts = rng.integers(2, 60, size=57)
+    length_lists = [np.linspace(0, rng.uniform(100,1000), n) for n in counts]
+    energy_lists = [np.linspace(e, 0.6*e, n) for e, n in zip(rng.uniform(500,5000,len(counts)), counts)]
+    muons = LLPMuonBatch.from_tracks(length_lists, energy_lists)
+
+    serial = build_DLS_estimator(*build_args).calc_llp_probability_batch(muons)
+    for n_workers in [1, 2]:
+        with LLPParallelEstimator(build_DLS_estimator, build_args, n_workers, chunk_size=10) as parallel:
+            probabilities = parallel.calc_llp_probability_batch(muons)
+            empty = parallel.calc_llp_probability_batch(muons[:0])
+        # input order and deterministic regardless of workers
+        assert np.array_equal(probabilities, serial)
+        assert empty.shape == (0, len(masses))
+
+    # per chunk accumulators merged in the driver
+    weights = rng.uniform(0.5, 2.0, len(muons))
+    with LLPParallelEstimator(build_DLS_estimator, build_args, 2, chunk_size=10) as parallel:
+        accumulator = parallel.accumulate(muons, weights)
+    assert accumulator.count == len(muons)
+    assert np.allclose(accumulator.rate, weights @ serial, rtol=1e-12, atol=0)
+############## END LLPParallelEstimator ##############
+
+############## TEST LLPRateAccumulator ##############
+def test_llprateaccumulator():
+    est = create_estimator()
+    muons = create_test_muons(50)
+    weights = np.random.default_rng(2).uniform(0.5, 2.0, len(muons))
+    probabilities = est.calc_llp_probability_batch(muons)
+    x = probabilities * weights[:, None]
+
+    # batches added one by one and merged accumulators give the same statistics
+    accumulator = est.accumulate(muons[:20], weights[:20])
+    est.accumulate(muons[20:], weights[20:], accumulator)
+    other = est.accumulate(muons[:35], weights[:35])
+    other.merge(est.accumulate(muons[35:], weights[35:]))
+    for acc in [accumulator, other]:
+        assert acc.count == len(muons)
+        assert np.allclose(acc.rate, x.sum(axis=0), rtol=1e-12, atol=0)
+        assert np.allclose(acc.rate_variance, (x**2).sum(axis=0), rtol=1e-12, atol=0)
+        assert np.allclose(acc.mean, x.mean(axis=0), rtol=1e-10, atol=0)
+        assert np.allclose(acc.variance, x.var(axis=0, ddof=1), rtol=1e-8, atol=0)
+    assert list(accumulator.to_dict().keys()) == est.llpmodel_unique_ids
+
+    # compensated sum keeps small contributions added to a large total
+    acc = LLPRateAccumulator(1)
+    acc.add([[1.0]])
+    for _ in range(1000):
+        acc.add([[1e-17]])
+    naive = 1.0
+    for _ in range(1000):
+        naive += 1e-17
+    assert naive == 1.0
+    assert acc.rate[0] == math.fsum([1.0] + [1e-17]*1000)
+############## END LLPRateAccumulator ##############
+
+############## TEST LLPStreamingPipeline ##############
+def create_test_muons(n_muons, seed = 1):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(2, 60, size=n_muons)
+    length_lists = [np.linspace(0, rng.uniform(100,1000), n) for n in counts]
+    energy_lists = [np.linspace(e, 0.6*e, n) for e, n in zip(rng.uniform(500,5000,n_muons), counts)]
+    return LLPMuonBatch.from_tracks(length_lists, energy_lists)
+
+class InterruptingEstimator():
+    """ Raises after a number of chunks, like a job that gets killed. """
+    def __init__(self, estimator, n_chunks):
+        self.estimator = estimator
+        self.llpmodel_unique_ids = estimator.llpmodel_unique_ids
+        self.n_chunks = n_chunks
+        self.n_muons = 0
+    def calc_llp_probability_batch(self, muons):
+        if self.n_chunks == 0:
+            raise RuntimeError("interrupted")
+        self.n_chunks -= 1
+        self.n_muons += len(muons)
+        return self.estimator.calc_llp_probability_batch(muons)
+
+def test_llpstreamingpipeline(tmp_path):
+    est = create_estimator()
+    muons = create_test_muons(95)
+    expected = est.calc_llp_probability_batch(muons)
+    input_path = str(tmp_path / "muons.npz")
+    np.savez_compressed(input_path, lengths=muons.lengths, energies=muons.energies, offsets=muons.offsets)
+
+    # chunks read back in order, also from the middle of the file
+    chunks = list(iter_muon_chunks(input_path, 20, start=30))
+    assert [start for start, chunk in chunks] == [30, 50, 70, 90]
+    assert np.all(np.concatenate([chunk.energies for start, chunk in chunks]) == muons[30:].energies)
+
+    output_path = str(tmp_path / "probabilities.npy")
+    assert LLPStreamingPipeline(est, chunk_size=20).run(input_path, output_path) == len(muons)
+    assert np.array_equal(np.load(output_path), expected)
+
+    # default chunks shrink with the number of models
+    assert default_chunk_size(4) == 10000 and default_chunk_size(None) == 10000
+    assert default_chunk_size(100000) == 2**27 // 800000
+    assert default_chunk_size(10**9) == 1
+    assert LLPStreamingPipeline(est).run(input_path, output_path, resume=False) == len(muons)
+    assert np.array_equal(np.load(output_path), expected)
+
+    # interrupted run continues from the last finished chunk
+    output_path = str(tmp_path / "interrupted.npy")
+    interrupting = InterruptingEstimator(est, 2)
+    with pytest.raises(RuntimeError):
+        LLPStreamingPipeline(interrupting, chunk_size=20).run(input_path, output_path)
+    resumed = InterruptingEstimator(est, -1)
+    assert LLPStreamingPipeline(resumed, chunk_size=20).run(input_path, output_path) == len(muons) - 40
+    assert resumed.n_muons == len(muons) - 40
+    assert np.array_equal(np.load(output_path), expected)
+
+    # an empty input replaces the output of the earlier run
+    empty_path = str(tmp_path / "empty.npz")
+    np.savez_compressed(empty_path, lengths=np.zeros(0), energies=np.zeros(0), offsets=np.zeros(1, dtype=np.int64))
+    assert LLPStreamingPipeline(est, chunk_size=20).run(empty_path, output_path) == 0
+    assert np.load(output_path).shape == (0, len(est.llpmodels))
+############## END LLPStreamingPipeline ##############
+
+############## TEST LLPService ##############
+def test_llpservice(tmp_path):
+    est = create_estimator()
+    muons = create_test_muons(50)
+    expected = est.calc_llp_probability_batch(muons)
+    socket_path = str(tmp_path / "llpservice.sock")
+
+    async def run():
+        service = LLPService(est, max_batch_size=16, max_delay=0.05)
+        await service.start_unix(socket_path)
+        client = await LLPServiceClient.connect_unix(socket_path)
+        # concurrent queries are answered in order of the ids and coalesced into batches
+        results = await asyncio.gather(*(client.query(*muons.track(i)) for i in range(len(muons))))
+        # a bad query only fails itself
+        bad, good = await asyncio.gather(client.query([0, 100], [1000, 1e6]), client.query(*muons.track(0)),
+                                         return_exceptions=True)
+        load = await generate_load(client, muons, 100, concurrency=10)
+        stats = await client.stats()
+        await client.close()
+        await service.close()
+        return results, bad, good, load, stats
+
+    results, bad, good, load, stats = asyncio.run(run())
+    assert np.allclose(results, expected, rtol=1e-12, atol=0)
+    assert isinstance(bad, ValueError)
+    assert np.allclose(good, expected[0], rtol=1e-12, atol=0)
+    assert load["n_queries"] == 100
+    assert stats["n_queries"] == 152 and stats["n_errors"] == 1
+    assert stats["n_batches"] < stats["n_queries"] / 2
+
+def test_llpservice_long_track(tmp_path):
+    est = create_estimator()
+    # 3000 steps are about 120 kB of JSON, above the 64 kB default of asyncio streams
+    length_list = np.linspace(0, 800, 3000)
+    energy_list = np.linspace(1000, 700, 3000)
+    expected = est.calc_llp_probability(length_list, energy_list)
+
+    class SlowEstimator():
+        def calc_llp_probability_batch(self, muons):
+            time.sleep(0.5)
+            return est.calc_llp_probability_batch(muons)
+
+    async def run():
+        service = LLPService(est, max_delay=0.01)
+        port = await service.start_tcp()
+        client = await LLPServiceClient.connect_tcp(port=port)
+        long = await client.query(length_list, energy_list)
+        await client.close()
+        await service.close()
+
+        # longer than the limit only fails that query, the connection stays open
+        service = LLPService(est, max_delay=0.01, line_limit=100000)
+        await service.start_unix(str(tmp_path / "llpservice.sock"))
+        client = await LLPServiceClient.connect_unix(str(tmp_path / "llpservice.sock"))
+        too_long, short = await asyncio.gather(client.query(length_list, energy_list),
+                                               client.query(length_list[::10], energy_list[::10]),
+                                               return_exceptions=True)
+        again = await client.query(length_list[::10], energy_list[::10])
+        await client.close()
+        await service.close()
+
+        # closing fails queries of the batch that is being evaluated
+        service = LLPService(SlowEstimator(), max_delay=0.01)
+        running = asyncio.create_task(service.query(length_list, energy_list))
+        await asyncio.sleep(0.1)
+        await service.close()
+        closed = await asyncio.gather(running, return_exceptions=True)
+        return long, too_long, short, again, closed[0]
+
+    long, too_long, short, again, closed = asyncio.run(run())
+    assert np.allclose(long, expected, rtol=1e-12, atol=0)
+    assert isinstance(too_long, ValueError) and "line limit" in str(too_long)
+    assert np.allclose(short, again, rtol=1e-12, atol=0)
+    assert isinstance(closed, RuntimeError)
+############## END LLPService ##############
+
+############## TEST LLPVertexSampler ##############
+def test_llpvertexsampler():
+    est = create_estimator()
+    muons = LLPMuonGenerator(energy_range=(500.0, 5e3), length_range=(400.0, 1000.0), seed=1).muon_batch(20, step_length=10.0)
+    weights = np.linspace(0.5, 2.0, len(muons))
+    probabilities = est.calc_llp_probability_batch(muons)
+    n_events = 20000
+    events = LLPVertexSampler(est, seed=3).sample(muons, n_events, weights)
+    assert events.production.shape == (len(est.llpmodels), n_events)
+    assert np.allclose(events.rates, weights @ probabilities)
+    # same seed, same events
+    again = LLPVertexSampler(est, seed=3).sample(muons, n_events, weights)
+    assert np.array_equal(events.decay, again.decay)
+
+    # vertices inside the detectable range of their muon
+    track_lengths = muons.lengths[muons.offsets[1:] - 1][events.muon]
+    assert np.all(events.gap >= est.min_gap/100.0 - 1e-9)
+    assert np.all(events.decay <= track_lengths - est.min_gap/100.0 + 1e-9)
+    # muons are chosen with their weighted probability
+    for row in range(len(est.llpmodels)):
+        fractions = np.bincount(events.muon[row], minlength=len(muons)) / n_events
+        expected = weights*probabilities[:, row] / np.sum(weights*probabilities[:, row])
+        assert np.allclose(fractions, expected, atol=5*np.sqrt(expected/n_events) + 1e-3)
+    # production vertices follow the integrand within a muon
+    first = muons.offsets[0]
+    integrand = est.calc_llp_integrand_batch(muons)[0, first:muons.offsets[1]]
+    lengths = muons.lengths[first:muons.offsets[1]]
+    chosen = events.production[0][events.muon[0] == 0]
+    assert np.all(np.isin(chosen, lengths[integrand > 0]))
+    # gaps follow the truncated exponential: its CDF of the samples is uniform
+    decay_length = est.c_tau_over_mass[:, :1]*events.energy/100.0
+    span = track_lengths - events.production - 2*est.min_gap/100.0
+    cdf = np.expm1(-(events.gap - est.min_gap/100.0)/decay_length) / np.expm1(-span/decay_length)
+    assert np.all((cdf >= 0) & (cdf <= 1 + 1e-9))
+    assert np.allclose(cdf.mean(axis=1), 0.5, atol=0.01)
+
+    # short lived model, decays pile up near min_gap
+    short = LLPEstimator([LLPModel("short", 0.107, 1.0, 1e-11, est.llpmodels[0].llp_xsec)], 50.0)
+    events = LLPVertexSampler(short, seed=3).sample(muons, 2000)
+    decay_length = short.c_tau_over_mass[0, 0]*events.energy/100.0
+    assert np.median(events.gap - 50.0) < np.median(decay_length)
+
+    # models without detectable events and empty batches
+    events = LLPVertexSampler(est).sample(muons[:3], 5, muon_weights=np.zeros(3))
+    assert np.all(events.muon == -1) and np.all(np.isnan(events.decay)) and np.all(events.rates == 0)
+    events = LLPVertexSampler(est).sample(muons[:0], 5)
+    assert events.weight.shape == (len(est.llpmodels), 5)
+    with pytest.raises(ValueError):
+        LLPVertexSampler(est).sample(muons, 0)
+    with pytest.raises(ValueError):
+        LLPVertexSampler(est).sample(muons, 5, muon_weights=-weights)
+############## END LLPVertexSampler ##############
+
+############## TEST llpestimation command ##############
+def test_llpcli(tmp_path, capsys):
+    masses = [0.107, 0.11, 0.13]
+    epsilons = [1e-6, 5e-6]
+    spec_path = str(tmp_path / "grid.json")
+    write_DLS_grid_spec(spec_path, masses, epsilons)
+    muons = create_test_muons(45)
+    muon_path = str(tmp_path / "muons.npz")
+    np.savez_compressed(muon_path, lengths=muons.lengths, energies=muons.energies, offsets=muons.offsets)
+
+    # same models as the grid
+    table = LLPCrossSectionTable.from_csv([[path] for path in generate_DLS_WW_oxygen_paths(masses, "../cross_section_tables/")],
+                                          [get_ice_oxygen()], row_keys=masses)
+    expected = LLPEstimator(generate_DLSModelGrid(masses, epsilons, table).model_set()).calc_llp_probability_batch(muons)
+    for backend in ["serial", "batch", "process"]:
+        output_path = str(tmp_path / (backend + ".npy"))
+        assert llpcli.main([spec_path, "--tables", "../cross_section_tables", "--muons", muon_path,
+                            "--output", output_path, "--backend", backend, "--chunk-size", "20", "--workers", "2"]) == 0
+        assert np.allclose(np.load(output_path), expected, rtol=1e-12, atol=0)
+        assert "45 of 45 muons computed with the " + backend + " backend" in capsys.readouterr().out
+
+    # finished runs are not computed again
+    llpcli.main([spec_path, "--tables", "../cross_section_tables", "--muons", muon_path, "--output", output_path])
+    assert "0 of 45 muons" in capsys.readouterr().out
+
+    with pytest.raises(SystemExit):
+        llpcli.main([spec_path, "--tables", "../cross_section_tables", "--muons", muon_path,
+                     "--output", output_path, "--backend", "gpu"])
+    # invalid values get the usage message and exit status 2
+    for option in ["--chunk-size", "--workers"]:
+        with pytest.raises(SystemExit) as exit_info:
+            llpcli.main([spec_path, "--tables", "../cross_section_tables", "--muons", muon_path,
+                         "--output", output_path, option, "0"])
+        assert exit_info.value.code == 2
+        assert "usage: llpestimation" in capsys.readouterr().err
+############## END llpestimation command ##############
+
+############## TEST import time ##############
+def import_times(code):
+    """ Top level imports of python -X importtime with their cumulative time in us. """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd="..",
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = (int(cumulative), len(name) - len(name.lstrip()) == 1)
+    return times
+
+def test_import_time():
+    # budget documented in llpestimation/__init__.py
+    heavy = ["pandas", "scipy", "matplotlib", "asyncio", "concurrent.futures", "sqlite3", "zipfile"]
+    times = import_times("import numpy; import estimation_utilities")
+    assert not [module for module in heavy if module in times]
+    startup = sum(cumulative for name, (cumulative, top_level) in times.items()
+                  if top_level and name != "numpy" and not name.startswith("numpy."))
+    assert startup < 100000
 
+    # heavy modules are only imported with the classes that need them
+    times = import_times("import llpestimation; llpestimation.LLPService")
+    assert "asyncio" in times and "sqlite3" not in times
+############## END import time ##############